@@ -0,0 +1,323 @@
+"""
+Benchmarks for the core Model operations.
+
+Runs against a local redis-server (the database is FLUSHED, use a scratch db)
+and writes machine-readable JSON, so results can be compared across commits:
+
+    python benchmarks/bench_models.py --db 15 --output bench.json
+    python benchmarks/bench_models.py --only get_single,save_new --iterations 5000
+    python benchmarks/bench_models.py --backend memory   # rohm.memory, no server needed
+
+Each benchmark reports throughput (ops/sec) and latency percentiles in
+microseconds. Field codec benchmarks don't touch Redis.
+"""
+from __future__ import print_function
+
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import redis   # noqa
+from pytz import utc   # noqa
+
+from rohm import fields   # noqa
+from rohm.connection import set_default_connection   # noqa
+from rohm.memory import MemoryRedis   # noqa
+from rohm.models import Model   # noqa
+from rohm.version import __version__   # noqa
+
+
+NUM_OBJECTS = 1000
+MULTI_GET_SIZE = 50
+
+benchmarks = []
+
+
+def benchmark(func):
+    benchmarks.append(func)
+    return func
+
+
+# ------
+# Models
+# ------
+class BenchStore(Model):
+    name = fields.CharField()
+    is_open = fields.BooleanField()
+    rating = fields.FloatField()
+
+
+def order_model(name, save_modified_only):
+    # Models don't inherit fields, so build both order models from one definition
+    return type(name, (Model,), dict(
+        save_modified_only=save_modified_only,
+        name=fields.CharField(),
+        num_items=fields.IntegerField(),
+        total=fields.FloatField(),
+        is_paid=fields.BooleanField(),
+        created_at=fields.DateTimeField(),
+        items=fields.JSONField(),
+        store=fields.RelatedModelField(BenchStore),
+    ))
+
+
+BenchOrder = order_model('BenchOrder', save_modified_only=False)
+BenchOrderModifiedOnly = order_model('BenchOrderModifiedOnly', save_modified_only=True)
+
+
+def make_order(id, cls=BenchOrder):
+    return cls(
+        id=id,
+        name='order {}'.format(id),
+        num_items=3,
+        total=12.5,
+        is_paid=True,
+        created_at=utc.localize(datetime.datetime(2015, 1, 1, 12, 30)),
+        items=[{'name': 'item', 'price': 250, 'quantity': i} for i in range(3)],
+        store_id=(id % 10) + 1,
+    )
+
+
+def populate():
+    for i in range(1, 11):
+        BenchStore(id=i, name='store {}'.format(i), is_open=True, rating=4.5).save()
+
+    for i in range(1, NUM_OBJECTS + 1):
+        make_order(i).save(force_create=True)
+        make_order(i, cls=BenchOrderModifiedOnly).save(force_create=True)
+
+
+def ids_cycle(num):
+    """ Cycle through existing ids """
+    return [(i % NUM_OBJECTS) + 1 for i in range(num)]
+
+
+# -----------
+# Model suite
+# -----------
+@benchmark
+def get_single(iterations):
+    for id in ids_cycle(iterations):
+        yield lambda id=id: BenchOrder.get(id)
+
+
+@benchmark
+def get_multi(iterations):
+    for start in ids_cycle(iterations):
+        ids = [((start + i) % NUM_OBJECTS) + 1 for i in range(MULTI_GET_SIZE)]
+        yield lambda ids=ids: BenchOrder.get(ids)
+
+
+@benchmark
+def get_partial(iterations):
+    for id in ids_cycle(iterations):
+        yield lambda id=id: BenchOrder.get(id, fields=['name', 'total'])
+
+
+new_ids = itertools.count(NUM_OBJECTS + 1)
+
+
+@benchmark
+def values_multi(iterations):
+    for start in ids_cycle(iterations):
+        ids = [((start + i) % NUM_OBJECTS) + 1 for i in range(MULTI_GET_SIZE)]
+        yield lambda ids=ids: BenchOrder.values_list(ids, ['name', 'total'])
+
+
+@benchmark
+def save_new(iterations):
+    for i in range(iterations):
+        order = make_order(next(new_ids))
+        yield order.save
+
+
+@benchmark
+def save_existing(iterations):
+    for id in ids_cycle(iterations):
+        order = BenchOrder.get(id)
+        order.total += 1
+        yield order.save
+
+
+@benchmark
+def save_modified_only(iterations):
+    for id in ids_cycle(iterations):
+        order = BenchOrderModifiedOnly.get(id)
+        order.total += 1
+        yield order.save
+
+
+@benchmark
+def related_load(iterations):
+    for id in ids_cycle(iterations):
+        order = BenchOrder.get(id)
+        yield lambda order=order: order.store
+
+
+# -------------------------
+# Field codecs (no Redis)
+# -------------------------
+codec_values = [
+    ('IntegerField', fields.IntegerField(), 123456),
+    ('CharField', fields.CharField(), u'some store name'),
+    ('BooleanField', fields.BooleanField(), True),
+    ('FloatField', fields.FloatField(), 12.75),
+    ('DateTimeField', fields.DateTimeField(), utc.localize(datetime.datetime(2015, 1, 1, 12, 30))),
+    ('JSONField', fields.JSONField(), {'items': [{'name': 'item', 'price': 250}] * 5}),
+]
+
+
+# Codecs are too fast to time one call at a time, so each timed call runs a batch
+CODEC_BATCH_SIZE = 100
+
+
+def make_codec_benchmarks():
+    batch = range(CODEC_BATCH_SIZE)
+
+    for name, field, value in codec_values:
+        raw = field.to_redis(value)
+
+        def encode(iterations, field=field, value=value):
+            def call():
+                for i in batch:
+                    field.to_redis(value)
+
+            for i in range(iterations):
+                yield call
+
+        def decode(iterations, field=field, raw=raw):
+            def call():
+                for i in batch:
+                    field.from_redis(raw)
+
+            for i in range(iterations):
+                yield call
+
+        for func, direction in ((encode, 'to_redis'), (decode, 'from_redis')):
+            func.__name__ = 'codec_{}_{}'.format(name, direction)
+            func.batch_size = CODEC_BATCH_SIZE
+            benchmarks.append(func)
+
+
+make_codec_benchmarks()
+
+
+# ------
+# Runner
+# ------
+def percentile(sorted_vals, percent):
+    if not sorted_vals:
+        return None
+    index = int(round((len(sorted_vals) - 1) * percent / 100.0))
+    return sorted_vals[index]
+
+
+def run_benchmark(func, iterations, warmup):
+    batch_size = getattr(func, 'batch_size', 1)
+
+    for call in func(warmup):
+        call()
+
+    timings = []
+    start = default_timer()
+    for call in func(iterations):
+        t0 = default_timer()
+        call()
+        timings.append((default_timer() - t0) / batch_size)
+    elapsed = default_timer() - start
+    iterations *= batch_size
+
+    timings.sort()
+    measured = sum(timings) * batch_size
+    to_us = lambda val: round(val * 1e6, 3)   # noqa
+
+    return {
+        'iterations': iterations,
+        'ops_per_sec': round(iterations / measured, 1) if measured else None,
+        'wall_time': round(elapsed, 6),
+        'mean_us': to_us(measured / iterations),
+        'min_us': to_us(timings[0]),
+        'p50_us': to_us(percentile(timings, 50)),
+        'p90_us': to_us(percentile(timings, 90)),
+        'p99_us': to_us(percentile(timings, 99)),
+        'max_us': to_us(timings[-1]),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode('ascii').strip()
+    except Exception:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=15, help='Scratch database (gets flushed)')
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--warmup', type=int, default=200)
+    parser.add_argument('--only', help='Comma separated benchmark names')
+    parser.add_argument('--output', help='Write JSON results to this file (default: stdout)')
+    parser.add_argument('--backend', choices=['redis', 'memory'], default='redis',
+                        help='memory: measure rohm alone, against the in-memory backend')
+    args = parser.parse_args(argv)
+
+    if args.backend == 'memory':
+        conn = MemoryRedis()
+    else:
+        conn = redis.StrictRedis(host=args.host, port=args.port, db=args.db)
+    set_default_connection(conn)
+    conn.flushdb()
+    populate()
+
+    selected = benchmarks
+    if args.only:
+        names = set(args.only.split(','))
+        selected = [func for func in benchmarks if func.__name__ in names]
+
+    results = {}
+    for func in selected:
+        results[func.__name__] = run_benchmark(func, args.iterations, args.warmup)
+        print('{:<40} {:>12} ops/sec  p50 {:>10}us  p99 {:>10}us'.format(
+            func.__name__, results[func.__name__]['ops_per_sec'],
+            results[func.__name__]['p50_us'], results[func.__name__]['p99_us']),
+            file=sys.stderr)
+
+    conn.flushdb()
+
+    output = {
+        'meta': {
+            'rohm_version': __version__,
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'backend': args.backend,
+            'redis_version': conn.info().get('redis_version'),
+            'timestamp': int(time.time()),
+            'iterations': args.iterations,
+        },
+        'results': results,
+    }
+
+    data = json.dumps(output, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data)
+    else:
+        print(data)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,16 @@
+import os
+
 import pytest
-from rohm.connection import get_default_connection
+from rohm.connection import get_default_connection, set_default_connection
+from rohm.memory import MemoryRedis
 from rohm import model_registry
+from rohm.testing import round_trips   # noqa
 import mock
 import logging
 
+# ROHM_TEST_BACKEND=memory runs the tests against rohm.memory instead of a local redis-server
+memory_backend = os.environ.get('ROHM_TEST_BACKEND') == 'memory'
+
 
 @pytest.fixture(scope='session', autouse=True)
 def initialsetup():
@@ -16,8 +23,11 @@ def initialsetup():
 
 @pytest.yield_fixture(autouse=True)
 def commonsetup():
-    conn = get_default_connection()
-    conn.flushdb()
+    if memory_backend:
+        set_default_connection(MemoryRedis())
+    else:
+        conn = get_default_connection()
+        conn.flushdb()
 
     model_registry.clear()
 
@@ -1,4 +1,5 @@
 model_registry = {}
 
 from rohm.exceptions import *   # noqa
-from rohm.models import Model   # noqa
+from rohm.models import Model, get_many, execute_pipeline   # noqa
+from rohm.batching import batch   # noqa
@@ -0,0 +1,71 @@
+"""
+Implicit batching of lazy loads.
+
+Inside a `rohm.batch()` block, every instance returned by Model.get is
+remembered. When one of them lazily loads a field (a partially loaded field,
+or a RelatedModelField), the same field is loaded for all the other batched
+instances of that model that don't have it yet, in one pipeline. So a loop like
+
+    with rohm.batch():
+        orders = Order.get(order_ids)
+        for order in orders:
+            print(order.store.name)
+
+does 2 round trips instead of 1 + len(orders). Instances loaded some other way
+can be added explicitly: `rohm.batch(orders)` or `current_batch.add(*orders)`.
+
+Unlike unbatched loads, which give each instance its own copy, batched instances
+related to the same model share one instance of it: above, orders of the same
+store have the same `order.store` object (changes to it are seen by all of them).
+"""
+from contextlib import contextmanager
+import threading
+
+_local = threading.local()
+
+
+class Batch(object):
+    def __init__(self):
+        self._instances = {}    # {model class: [instances]}
+        self._seen = set()      # ids (memory addresses) of the instances above
+
+    def add(self, *instances):
+        for instance in instances:
+            if instance is None or id(instance) in self._seen:
+                continue
+            self._seen.add(id(instance))
+            self._instances.setdefault(type(instance), []).append(instance)
+
+    def peers(self, instance):
+        """
+        All batched instances of the same model (including `instance` if batched)
+        """
+        return self._instances.get(type(instance), [])
+
+    def __len__(self):
+        return len(self._seen)
+
+
+def get_current_batch():
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+
+@contextmanager
+def batch(instances=None):
+    """
+    Batch lazy loads of the instances fetched (or passed in) inside this block
+    """
+    current = Batch()
+    if instances:
+        current.add(*instances)
+
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+
+    stack.append(current)
+    try:
+        yield current
+    finally:
+        stack.pop()
@@ -0,0 +1,43 @@
+"""
+Columnar decoding of numeric fields into NumPy arrays (optional, needs numpy)
+
+Used by Model.get_columns(). Values are converted a whole column at a time
+(numpy parses the raw strings) rather than one from_redis() call per value.
+"""
+from rohm.fields import BooleanField, DateTimeField, FloatField, IntegerField
+
+try:
+    import numpy as np
+except ImportError:   # pragma: no cover
+    np = None
+
+
+def require_numpy():
+    if np is None:
+        raise ImportError('numpy is required for columnar loading (pip install rohm[numpy])')
+
+
+def decode_column(field, raw_values):
+    """
+    Decode a list of raw Redis values (None for missing) into a numpy masked array,
+    masked where the value is missing/None
+    """
+    require_numpy()
+
+    mask = np.fromiter((val is None for val in raw_values), dtype=bool, count=len(raw_values))
+
+    if isinstance(field, BooleanField):
+        raw = np.array([val or '0' for val in raw_values])
+        data = raw != np.array('0', dtype=raw.dtype)
+    elif isinstance(field, IntegerField):
+        data = np.array([val or '0' for val in raw_values]).astype(np.int64)
+    elif isinstance(field, FloatField):
+        data = np.array([val or '0' for val in raw_values]).astype(np.float64)
+    elif isinstance(field, DateTimeField):
+        # Stored as naive UTC isoformat, which numpy parses directly
+        data = np.array([val or 'NaT' for val in raw_values], dtype='datetime64[us]')
+    else:
+        raise TypeError('{} ({}) cannot be loaded as a column'.format(
+            field.field_name, type(field).__name__))
+
+    return np.ma.MaskedArray(data, mask=mask)
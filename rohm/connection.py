@@ -2,37 +2,224 @@
 Terminology notes: "connection" and "client" are synonymous here. Client is
 probably more accurate technically (a redis-py Redis instance) but just using
 connection for consistency
+
+Connections are kept in a registry keyed by an alias. Each alias gets its own
+bounded, blocking connection pool, configured once (register_connection) and
+shared by every Model that points at that alias (Model.connection_alias).
 """
+from contextlib import contextmanager
+import os
+import threading
+import time
 
 from redis import StrictRedis
+from redis.connection import BlockingConnectionPool
+from redis.exceptions import ConnectionError
 
-connection = None
+from rohm.exceptions import ConnectionNotConfigured
 
+DEFAULT_ALIAS = 'default'
 
-def set_default_connection_settings(**kwargs):
-    global connection
+connections = {}      # {alias: redis client}
+_registry_lock = threading.Lock()
+_local = threading.local()
 
-    set_default_connection(StrictRedis(**kwargs))
 
+class RohmConnectionPool(BlockingConnectionPool):
+    """
+    A BlockingConnectionPool that:
+    - keeps usage statistics (in use, idle, time spent waiting for a connection)
+    - resets itself in a forked child *without* shutting down the sockets it
+      inherited. The stock _checkpid() calls disconnect(), and shutdown() on an
+      inherited socket also kills the parent's connection.
+    """
+    def __init__(self, max_connections=50, timeout=20, **kwargs):
+        self._stats_lock = threading.Lock()
+        super(RohmConnectionPool, self).__init__(max_connections=max_connections,
+                                                 timeout=timeout, **kwargs)
 
-def set_default_connection(redis_client):
-    global connection
-    connection = redis_client
+    def reset(self):
+        super(RohmConnectionPool, self).reset()
 
+        with self._stats_lock:
+            self._in_use_count = 0
+            self._wait_count = 0
+            self._wait_time_total = 0.0
+            self._wait_time_max = 0.0
+            self._timeout_count = 0
 
-def get_default_connection():
-    """ Get the default connection """
-    global connection
-    if not connection:
-        connection = StrictRedis()
+    def _checkpid(self):
+        if self.pid != os.getpid():
+            with self._check_lock:
+                if self.pid == os.getpid():
+                    # another thread already did the work while we waited on the lock
+                    return
+                self._abandon_connections()
+                self.reset()
+
+    def _abandon_connections(self):
+        """
+        Close (but don't shutdown) the sockets inherited from the parent process
+        """
+        for connection in self._connections:
+            sock = connection._sock
+            connection._sock = None
+            if sock is not None:
+                try:
+                    sock.close()
+                except Exception:
+                    pass
+
+    def get_connection(self, command_name, *keys, **options):
+        start = time.time()
+        try:
+            connection = super(RohmConnectionPool, self).get_connection(
+                command_name, *keys, **options)
+        except ConnectionError:
+            with self._stats_lock:
+                self._timeout_count += 1
+            raise
+
+        waited = time.time() - start
+        with self._stats_lock:
+            self._in_use_count += 1
+            self._wait_count += 1
+            self._wait_time_total += waited
+            self._wait_time_max = max(self._wait_time_max, waited)
+
+        return connection
+
+    def release(self, connection):
+        self._checkpid()
+        if connection.pid != self.pid:
+            return
+
+        with self._stats_lock:
+            self._in_use_count = max(self._in_use_count - 1, 0)
+
+        super(RohmConnectionPool, self).release(connection)
+
+    def get_stats(self):
+        """
+        Return a dictionary of pool statistics, for monitoring
+        """
+        with self._stats_lock:
+            in_use = self._in_use_count
+            created = len(self._connections)
+            wait_count = self._wait_count
+
+            return {
+                'max_connections': self.max_connections,
+                'created': created,
+                'in_use': in_use,
+                'idle': max(created - in_use, 0),
+                'checkouts': wait_count,
+                'timeouts': self._timeout_count,
+                'wait_time_total': self._wait_time_total,
+                'wait_time_avg': self._wait_time_total / wait_count if wait_count else 0.0,
+                'wait_time_max': self._wait_time_max,
+            }
+
+
+def create_connection(url=None, max_connections=50, pool_timeout=20, **settings):
+    """
+    Create a client backed by its own RohmConnectionPool.
+
+    - url: Optional redis:// URL, otherwise `settings` are Connection kwargs
+      (host, port, db, password, socket_timeout, socket_connect_timeout...)
+    - max_connections: Upper bound on open connections
+    - pool_timeout: Seconds to wait for a free connection before ConnectionError
+    """
+    if url:
+        pool = RohmConnectionPool.from_url(url, max_connections=max_connections,
+                                           timeout=pool_timeout, **settings)
+    else:
+        pool = RohmConnectionPool(max_connections=max_connections, timeout=pool_timeout,
+                                  **settings)
+
+    return StrictRedis(connection_pool=pool)
+
+
+def register_connection(alias=DEFAULT_ALIAS, **settings):
+    """
+    Configure the named connection `alias`. Takes the same arguments as
+    create_connection(). Re-registering an alias replaces the old client.
+    """
+    set_connection(alias, create_connection(**settings))
 
-    return connection
 
+def set_connection(alias, redis_client):
+    """ Register an already created client under `alias` """
+    with _registry_lock:
+        connections[alias] = redis_client
 
-def get_connection():
-    """ Alias for get_default_connection() """
-    return get_default_connection()
 
+def get_connection(alias=DEFAULT_ALIAS):
+    """
+    Get the client registered under `alias`. The default alias is created
+    lazily (localhost settings), any other alias must be registered first.
+    """
+    try:
+        return connections[alias]
+    except KeyError:
+        pass
 
-def create_connection(**settings):
-    return StrictRedis(**settings)
+    if alias != DEFAULT_ALIAS:
+        raise ConnectionNotConfigured(alias)
+
+    with _registry_lock:
+        if alias not in connections:
+            connections[alias] = create_connection()
+        return connections[alias]
+
+
+def get_connection_override():
+    """
+    The client every model uses in this thread instead of its own, or None
+    """
+    return getattr(_local, 'override', None)
+
+
+@contextmanager
+def override_connection(redis_client):
+    """
+    Make every model use `redis_client` in this thread for the duration of a block
+    (whatever its connection, connection_alias or get_connection() override)
+    """
+    previous = get_connection_override()
+    _local.override = redis_client
+    try:
+        yield redis_client
+    finally:
+        _local.override = previous
+
+
+def get_pool_stats(alias=None):
+    """
+    Pool statistics of one alias, or {alias: stats} for every registered alias.
+    Clients not backed by a RohmConnectionPool report None.
+    """
+    if alias is not None:
+        return _get_client_pool_stats(get_connection(alias))
+
+    return {_alias: _get_client_pool_stats(client) for _alias, client in connections.items()}
+
+
+def _get_client_pool_stats(client):
+    pool = client.connection_pool
+    if isinstance(pool, RohmConnectionPool):
+        return pool.get_stats()
+    return None
+
+
+def set_default_connection_settings(**kwargs):
+    register_connection(DEFAULT_ALIAS, **kwargs)
+
+
+def set_default_connection(redis_client):
+    set_connection(DEFAULT_ALIAS, redis_client)
+
+
+def get_default_connection():
+    """ Get the default connection """
+    return get_connection(DEFAULT_ALIAS)
@@ -1,4 +1,5 @@
-__all__ = ['DoesNotExist', 'AlreadyExists', 'FieldValidationError']
+__all__ = ['DoesNotExist', 'AlreadyExists', 'FieldValidationError', 'ConnectionNotConfigured',
+           'ConflictError']
 
 
 class DoesNotExist(Exception):
@@ -11,3 +12,14 @@ class AlreadyExists(Exception):
 
 class FieldValidationError(Exception):
     pass
+
+
+class ConnectionNotConfigured(Exception):
+    pass
+
+
+class ConflictError(Exception):
+    """
+    A versioned model was changed (or deleted) by someone else since it was loaded
+    """
+    pass
@@ -17,14 +17,36 @@ class BaseField(object):
     allowed_types = None
 
     def __init__(self, primary_key=False, required=False, allow_none=True, default=None,
-                 *args, **kwargs):
+                 lazy=False, *args, **kwargs):
+        """
+        - lazy: Deferred field, not loaded by default by Model.get(). All deferred fields
+          are fetched together the first time one of them is accessed
+        """
         self.is_primary_key = primary_key
         self.required = required
         self.allow_none = allow_none
         self.default = default
+        self.lazy = lazy
 
         self.field_name = None   # needs to be set
 
+    # Fields that keep entries outside the model hash (indexes) set has_index, and
+    # maintain them in the model's save/delete pipeline
+    has_index = False
+
+    def save_index(self, pipe, model_cls, id, old_val, new_val):
+        """
+        Update the index entries of the instance `id` when its value changes from
+        `old_val` (None for new instances) to `new_val`
+        """
+        pass
+
+    def delete_index(self, pipe, model_cls, id, val):
+        """
+        Remove the index entries of the instance `id` whose stored value is `val`
+        """
+        pass
+
     def __get__(self, instance, owner):
         field_name = self.field_name
 
@@ -74,6 +96,12 @@ class BaseField(object):
     def _validate(self, val):
         pass
 
+    def check_model(self, model_cls):
+        """
+        Raise ValueError if the field can't be used on `model_cls` as configured
+        """
+        pass
+
     def _to_redis(self, val):
         raise NotImplementedError
 
@@ -95,6 +123,45 @@ class CharField(BaseField):
     # Unicode
     allowed_types = six.string_types
 
+    def __init__(self, *args, **kwargs):
+        """
+        - prefix_index: Keep a lexicographically sorted index of the (lowercased) values,
+          for Model.search_prefix(). Not for models with a ttl: index entries don't expire
+          with the hashes
+        """
+        self.prefix_index = kwargs.pop('prefix_index', False)
+        super(CharField, self).__init__(*args, **kwargs)
+        self.has_index = self.prefix_index
+
+    def get_prefix_key(self, model_cls):
+        return '{}:_prefix:{}'.format(model_cls._key_prefix, self.field_name)
+
+    @staticmethod
+    def normalize(val):
+        """ Indexed form of a value (or a searched prefix) """
+        return safe_unicode(val).lower().replace(u'\x00', u'').encode('utf-8')
+
+    def _get_prefix_member(self, id, val):
+        # Sorts by value, then id. Ids are split off at the (last) NUL
+        return '{}\x00{}'.format(self.normalize(val), id)
+
+    def check_model(self, model_cls):
+        if self.prefix_index and model_cls.ttl:
+            raise ValueError('{}.{}: prefix_index can\'t be used on a model with a ttl'.format(
+                model_cls.__name__, self.field_name))
+
+    def save_index(self, pipe, model_cls, id, old_val, new_val):
+        self.check_model(model_cls)
+        key = self.get_prefix_key(model_cls)
+        if old_val is not None:
+            pipe.zrem(key, self._get_prefix_member(id, old_val))
+        if new_val is not None:
+            pipe.zadd(key, 0, self._get_prefix_member(id, new_val))
+
+    def delete_index(self, pipe, model_cls, id, val):
+        if val is not None:
+            pipe.zrem(self.get_prefix_key(model_cls), self._get_prefix_member(id, val))
+
     def _to_redis(self, val):
         return safe_string(val)
 
@@ -105,6 +172,43 @@ class CharField(BaseField):
 class BooleanField(BaseField):
     allowed_types = bool
 
+    def __init__(self, *args, **kwargs):
+        """
+        - storage: 'bitmap' also keeps the flag in one Redis bitmap per field, at the bit
+          of each (non-negative integer) id, so Model.get_flags() and Model.count_flag()
+          don't touch the hashes. The bitmap is as large as the highest id / 8 bytes.
+          Not for models with a ttl: bits don't expire with the hashes, so they'd still
+          be counted after the models expire
+        """
+        storage = kwargs.pop('storage', 'hash')
+        if storage not in ('hash', 'bitmap'):
+            raise ValueError('Unknown BooleanField storage {!r}'.format(storage))
+
+        super(BooleanField, self).__init__(*args, **kwargs)
+        self.storage = storage
+        self.has_index = storage == 'bitmap'
+
+    def get_bitmap_key(self, model_cls):
+        return '{}:_bitmap:{}'.format(model_cls._key_prefix, self.field_name)
+
+    @staticmethod
+    def get_bit_offset(id):
+        if not isinstance(id, six.integer_types) or id < 0:
+            raise ValueError('Bitmap storage needs non-negative integer ids, got {!r}'.format(id))
+        return id
+
+    def check_model(self, model_cls):
+        if self.storage == 'bitmap' and model_cls.ttl:
+            raise ValueError('{}.{}: bitmap storage can\'t be used on a model with a ttl'.format(
+                model_cls.__name__, self.field_name))
+
+    def save_index(self, pipe, model_cls, id, old_val, new_val):
+        self.check_model(model_cls)
+        pipe.setbit(self.get_bitmap_key(model_cls), self.get_bit_offset(id), 1 if new_val else 0)
+
+    def delete_index(self, pipe, model_cls, id, val):
+        pipe.setbit(self.get_bitmap_key(model_cls), self.get_bit_offset(id), 0)
+
     def _to_redis(self, val):
         return '1' if val else '0'
 
@@ -112,6 +216,15 @@ class BooleanField(BaseField):
         return bool(int(val))
 
 
+class VersionField(IntegerField):
+    """
+    Optimistic concurrency: saving an existing instance only succeeds if the stored
+    version is still the one loaded (else ConflictError), and increments it.
+    Set to 1 on creation. Maintained by rohm, don't set it yourself
+    """
+    pass
+
+
 class JSONField(BaseField):
     allowed_types = (dict, list, tuple)
 
@@ -157,11 +270,61 @@ class FloatField(BaseField):
         return float(val)
 
 
+class GeoField(BaseField):
+    """
+    A (longitude, latitude) location. Also indexed in a Redis GEO set per field
+    ("prefix:_geo:field_name"), for Model.nearby(). Not for models with a ttl: set
+    members don't expire with the hashes
+    """
+    allowed_types = (tuple, list)
+    has_index = True
+
+    def _validate(self, val):
+        if len(val) != 2:
+            raise ValueError('{} is not a (longitude, latitude) pair'.format(val))
+        lon, lat = val
+        if not -180 <= lon <= 180 or not -85.05112878 <= lat <= 85.05112878:
+            raise ValueError('{} is out of the range Redis can index'.format(val))
+
+    def _to_redis(self, val):
+        return '{!r},{!r}'.format(float(val[0]), float(val[1]))
+
+    def _from_redis(self, val):
+        lon, lat = val.split(',')
+        return (float(lon), float(lat))
+
+    def get_geo_key(self, model_cls):
+        return '{}:_geo:{}'.format(model_cls._key_prefix, self.field_name)
+
+    def check_model(self, model_cls):
+        if model_cls.ttl:
+            raise ValueError('{}.{}: a GeoField can\'t be used on a model with a ttl'.format(
+                model_cls.__name__, self.field_name))
+
+    def save_index(self, pipe, model_cls, id, old_val, new_val):
+        self.check_model(model_cls)
+        if new_val is None:
+            if old_val is not None:
+                pipe.zrem(self.get_geo_key(model_cls), id)
+        else:
+            pipe.execute_command('GEOADD', self.get_geo_key(model_cls),
+                                 float(new_val[0]), float(new_val[1]), id)
+
+    def delete_index(self, pipe, model_cls, id, val):
+        pipe.zrem(self.get_geo_key(model_cls), id)
+
+
 class RelatedModelField(BaseField):
-    def __init__(self, model_cls, *args, **kwargs):
+    def __init__(self, model_cls, related_name=None, *args, **kwargs):
+        """
+        - related_name: Maintain a reverse index, so that related instances get a
+          collection of the instances pointing at them under this name
+          (e.g. foo.bar -> bar.foos)
+        """
         super(RelatedModelField, self).__init__(*args, **kwargs)
 
         self._model_cls = model_cls
+        self.related_name = related_name
 
     @property
     def model_cls(self):
@@ -198,10 +361,28 @@ class RelatedModelIdField(IntegerField):
     def _get_model_field(self, instance):
         return instance._get_field(self.model_field_name)
 
-    def __init__(self, model_field_name, *args, **kwargs):
+    def __init__(self, model_field_name, related_field=None, *args, **kwargs):
         # the actual RelatedModelField this corresponds to..
         super(RelatedModelIdField, self).__init__(*args, **kwargs)
         self.model_field_name = model_field_name
+        self.related_field = related_field
+
+        # The reverse index is keyed by the stored id
+        self.has_index = bool(related_field and related_field.related_name)
+
+    def _get_reverse_key(self, related_id):
+        related_field = self.related_field
+        return related_field.model_cls.generate_sibling_key(related_id, related_field.related_name)
+
+    def save_index(self, pipe, model_cls, id, old_val, new_val):
+        if old_val is not None:
+            pipe.srem(self._get_reverse_key(old_val), id)
+        if new_val is not None:
+            pipe.sadd(self._get_reverse_key(new_val), id)
+
+    def delete_index(self, pipe, model_cls, id, val):
+        if val is not None:
+            pipe.srem(self._get_reverse_key(val), id)
 
     # TODO unset the model when we change this..
     def __set__(self, instance, value):
@@ -209,3 +390,310 @@ class RelatedModelIdField(IntegerField):
 
         if self.model_field_name in instance._loaded_related_field_data:
             del instance._loaded_related_field_data[self.model_field_name]
+
+
+class ReverseRelatedDescriptor(object):
+    """
+    Installed on the target of a RelatedModelField(related_name=...): bar.foos
+    """
+    def __init__(self, model_cls, related_name):
+        self.model_cls = model_cls          # the model with the RelatedModelField
+        self.related_name = related_name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        key = owner.generate_sibling_key(instance._id, self.related_name)
+        return RelatedCollection(self.model_cls, key)
+
+
+class RelatedCollection(object):
+    """
+    The instances of `model_cls` whose ids are in the Redis set `key`. Nothing is
+    loaded until used: count() only does SCARD, ids() SMEMBERS, and iterating loads all
+    instances with one multi-get.
+    """
+    def __init__(self, model_cls, key):
+        self.model_cls = model_cls
+        self.key = key
+        self._instances = None
+
+    def _get_connection(self):
+        return self.model_cls.get_connection()
+
+    def count(self):
+        return self._get_connection().scard(self.key)
+
+    def ids(self):
+        id_field = self.model_cls._get_field(self.model_cls._id_field_name)
+        raw_ids = self._get_connection().smembers(self.key)
+        return sorted(id_field.from_redis(raw_id) for raw_id in raw_ids)
+
+    def all(self, fields=None):
+        """
+        Load (once) and return the list of instances, ordered by id
+        """
+        if self._instances is None:
+            ids = self.ids()
+            instances = self.model_cls.get(ids, fields=fields, raise_missing_exception=False) \
+                if ids else []
+            self._instances = [instance for instance in instances if instance is not None]
+        return self._instances
+
+    def __iter__(self):
+        return iter(self.all())
+
+    def __len__(self):
+        if self._instances is not None:
+            return len(self._instances)
+        return self.count()
+
+    def __repr__(self):
+        return '<RelatedCollection {}>'.format(self.key)
+
+
+class CollectionField(object):
+    """
+    Base of fields stored in their own Redis structure, in a sibling key of the model
+    hash ("prefix:id:field_name"), so changing one element doesn't rewrite the model.
+
+    Nothing is loaded by Model.get(): the attribute is a collection object whose methods
+    each issue one command on the key (plus an EXPIRE, in the same round trip, if the
+    model has a ttl). Assigning an iterable replaces the whole collection on save().
+
+    - member_field: Field used to encode members/values (default: unicode strings)
+    """
+    collection_cls = None
+
+    def __init__(self, member_field=None):
+        self.member_field = member_field or CharField()
+        self.field_name = None   # needs to be set
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return self.collection_cls(instance, self)
+
+    def __set__(self, instance, value):
+        instance._pending_collections[self.field_name] = value
+
+    def queue_replace(self, pipe, key, value):
+        """
+        Queue the commands that replace the collection at `key` with `value`
+        """
+        pipe.delete(key)
+        if value:
+            self._queue_fill(pipe, key, value)
+
+    def _queue_fill(self, pipe, key, value):
+        raise NotImplementedError
+
+
+class SetField(CollectionField):
+    def _queue_fill(self, pipe, key, value):
+        pipe.sadd(key, *[self.member_field.to_redis(member) for member in value])
+
+
+class ListField(CollectionField):
+    def _queue_fill(self, pipe, key, value):
+        pipe.rpush(key, *[self.member_field.to_redis(member) for member in value])
+
+
+class SortedSetField(CollectionField):
+    """
+    Members with float scores. Assign a {member: score} dict
+    """
+    def _queue_fill(self, pipe, key, value):
+        pipe.zadd(key, *self._flatten_scores(value))
+
+    def _flatten_scores(self, scores):
+        args = []
+        for member, score in scores.items():
+            args.extend([score, self.member_field.to_redis(member)])
+        return args
+
+
+class HashField(CollectionField):
+    """
+    A dict of string keys to values. Assign a dict
+    """
+    def _queue_fill(self, pipe, key, value):
+        pipe.hmset(key, self._encode_mapping(value))
+
+    def _encode_mapping(self, mapping):
+        return {safe_string(name): self.member_field.to_redis(val) for name, val in mapping.items()}
+
+
+class Collection(object):
+    def __init__(self, instance, field):
+        self.instance = instance
+        self.field = field
+        self.key = instance.generate_sibling_key(instance._id, field.field_name)
+
+    def _get_connection(self):
+        return self.instance.get_connection()
+
+    def _read(self, command, *args, **kwargs):
+        return getattr(self._get_connection(), command)(self.key, *args, **kwargs)
+
+    def _write(self, command, *args):
+        """
+        Run a command that may create the key, keeping the model's ttl on it
+        """
+        ttl = self.instance.ttl
+        if not ttl:
+            return self._read(command, *args)
+
+        pipe = self._get_connection().pipeline()
+        getattr(pipe, command)(self.key, *args)
+        pipe.expire(self.key, ttl)
+        return pipe.execute()[0]
+
+    def _encode(self, member):
+        return self.field.member_field.to_redis(member)
+
+    def _decode(self, raw):
+        return self.field.member_field.from_redis(raw)
+
+    def delete(self):
+        return self._read('delete')
+
+    def __iter__(self):
+        return iter(self.all())
+
+    def __len__(self):
+        return self.count()
+
+    def __repr__(self):
+        return '<{} {}>'.format(type(self).__name__, self.key)
+
+
+class SetCollection(Collection):
+    def add(self, *members):
+        return self._write('sadd', *[self._encode(member) for member in members])
+
+    def remove(self, *members):
+        return self._read('srem', *[self._encode(member) for member in members])
+
+    def all(self):
+        return {self._decode(raw) for raw in self._read('smembers')}
+
+    def count(self):
+        return self._read('scard')
+
+    def __contains__(self, member):
+        return self._read('sismember', self._encode(member))
+
+
+class ListCollection(Collection):
+    def push(self, *values):
+        """ Append (RPUSH). Returns the new length """
+        return self._write('rpush', *[self._encode(value) for value in values])
+
+    def push_left(self, *values):
+        return self._write('lpush', *[self._encode(value) for value in values])
+
+    def pop(self):
+        raw = self._read('rpop')
+        return None if raw is None else self._decode(raw)
+
+    def pop_left(self):
+        raw = self._read('lpop')
+        return None if raw is None else self._decode(raw)
+
+    def range(self, start=0, end=-1):
+        """ Values from index `start` to `end` (inclusive, like LRANGE) """
+        return [self._decode(raw) for raw in self._read('lrange', start, end)]
+
+    def remove(self, value, count=0):
+        return self._read('lrem', count, self._encode(value))
+
+    def trim(self, start, end):
+        return self._read('ltrim', start, end)
+
+    def all(self):
+        return self.range()
+
+    def count(self):
+        return self._read('llen')
+
+
+class SortedSetCollection(Collection):
+    def add(self, scores):
+        """ Add or update {member: score} """
+        return self._write('zadd', *self.field._flatten_scores(scores))
+
+    def increment(self, member, amount=1):
+        return self._write('zincrby', self._encode(member), amount)
+
+    def remove(self, *members):
+        return self._read('zrem', *[self._encode(member) for member in members])
+
+    def score(self, member):
+        return self._read('zscore', self._encode(member))
+
+    def rank(self, member, desc=False):
+        return self._read('zrevrank' if desc else 'zrank', self._encode(member))
+
+    def range(self, start=0, end=-1, desc=False, withscores=False):
+        """ Members by rank, from `start` to `end` (inclusive, like ZRANGE) """
+        results = self._read('zrange', start, end, desc=desc, withscores=withscores)
+        return self._decode_results(results, withscores)
+
+    def range_by_score(self, min='-inf', max='+inf', start=None, num=None, withscores=False):
+        results = self._read('zrangebyscore', min, max, start=start, num=num,
+                             withscores=withscores)
+        return self._decode_results(results, withscores)
+
+    def _decode_results(self, results, withscores):
+        if withscores:
+            return [(self._decode(raw), score) for raw, score in results]
+        return [self._decode(raw) for raw in results]
+
+    def all(self):
+        return self.range()
+
+    def count(self):
+        return self._read('zcard')
+
+
+class HashCollection(Collection):
+    def set(self, name, value):
+        return self._write('hset', safe_string(name), self._encode(value))
+
+    def update(self, mapping):
+        if mapping:
+            return self._write('hmset', self.field._encode_mapping(mapping))
+
+    def get(self, name, default=None):
+        raw = self._read('hget', safe_string(name))
+        return default if raw is None else self._decode(raw)
+
+    def increment(self, name, amount=1):
+        return self._write('hincrby', safe_string(name), amount)
+
+    def remove(self, *names):
+        return self._read('hdel', *[safe_string(name) for name in names])
+
+    def all(self):
+        return {safe_unicode(name): self._decode(raw)
+                for name, raw in self._read('hgetall').items()}
+
+    def keys(self):
+        return [safe_unicode(name) for name in self._read('hkeys')]
+
+    def count(self):
+        return self._read('hlen')
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, name):
+        return self._read('hexists', safe_string(name))
+
+
+SetField.collection_cls = SetCollection
+ListField.collection_cls = ListCollection
+SortedSetField.collection_cls = SortedSetCollection
+HashField.collection_cls = HashCollection
@@ -0,0 +1,292 @@
+"""
+Per-operation instrumentation.
+
+Model operations (get, save, delete, load_field, load_related) report an
+Operation to every registered collector: number of Redis commands and round
+trips, (estimated) bytes sent/received, and time spent in each phase:
+
+- encode: cleaning/serializing data and building the pipeline
+- network: waiting on Redis
+- decode: converting replies and constructing Model instances
+
+With no collectors registered, start() returns None and the models skip all
+bookkeeping, so disabled instrumentation is a function call and an `if`.
+
+    from rohm import instrumentation
+    collector = instrumentation.HistogramCollector()
+    instrumentation.add_collector(collector)
+    ...
+    collector.summary()
+"""
+import bisect
+import threading
+from timeit import default_timer
+
+import six
+
+collectors = []
+
+PHASES = ('encode', 'network', 'decode')
+
+
+def add_collector(collector):
+    if collector not in collectors:
+        collectors.append(collector)
+
+
+def remove_collector(collector):
+    if collector in collectors:
+        collectors.remove(collector)
+
+
+def start(model_cls, name):
+    """
+    Start tracking an operation, returns None if instrumentation is disabled
+    """
+    if not collectors:
+        return None
+    return Operation(model_cls.__name__, name)
+
+
+class Operation(object):
+    """
+    Stats of one model operation. Phase time is accumulated by calling mark(phase)
+    at the end of each phase (time since the previous mark goes to that phase)
+    """
+    __slots__ = ('model', 'name', 'commands', 'round_trips', 'bytes_sent', 'bytes_received',
+                 'encode_time', 'network_time', 'decode_time', '_last_mark')
+
+    def __init__(self, model, name):
+        self.model = model
+        self.name = name
+        self.commands = 0
+        self.round_trips = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.encode_time = 0.0
+        self.network_time = 0.0
+        self.decode_time = 0.0
+        self._last_mark = default_timer()
+
+    @property
+    def total_time(self):
+        return self.encode_time + self.network_time + self.decode_time
+
+    def mark(self, phase):
+        now = default_timer()
+        attr = '{}_time'.format(phase)
+        setattr(self, attr, getattr(self, attr) + now - self._last_mark)
+        self._last_mark = now
+
+    def resume(self):
+        """ Restart the clock, the time since the last mark (spent elsewhere) isn't counted """
+        self._last_mark = default_timer()
+
+    def record_pipeline(self, pipe, start=0, end=None):
+        """
+        Record the commands of a pipeline about to be executed (one round trip). Operations
+        sharing a pipeline record their commands (start:end) of it, the round trip goes
+        to the one at the start
+        """
+        stack = pipe.command_stack[start:end]
+        if not stack:
+            return
+
+        if not start:
+            self.round_trips += 1
+        self.commands += len(stack)
+        for args, options in stack:
+            self.bytes_sent += command_size(args)
+
+    def record_command(self, *args):
+        """ Record a single immediately-executed command (one round trip) """
+        self.round_trips += 1
+        self.commands += 1
+        self.bytes_sent += command_size(args)
+
+    def record_reply(self, reply):
+        self.bytes_received += reply_size(reply)
+
+    def finish(self):
+        for collector in collectors:
+            collector.record(self)
+
+    def as_dict(self):
+        data = {name: getattr(self, name) for name in self.__slots__ if not name.startswith('_')}
+        data['total_time'] = self.total_time
+        return data
+
+
+def command_size(args):
+    """
+    Estimated size on the wire of a command, using the RESP framing
+    """
+    size = len(str(len(args))) + 3
+    for arg in args:
+        size += _bulk_size(arg)
+    return size
+
+
+def reply_size(reply):
+    """
+    Estimated size on the wire of a (parsed) reply
+    """
+    if reply is None:
+        return 5
+    elif isinstance(reply, dict):
+        return 3 + sum(_bulk_size(k) + reply_size(v) for k, v in reply.items())
+    elif isinstance(reply, (list, tuple)):
+        return 3 + sum(reply_size(val) for val in reply)
+    elif isinstance(reply, (bool,) + six.integer_types):
+        return len(str(int(reply))) + 3
+    else:
+        return _bulk_size(reply)
+
+
+def _bulk_size(val):
+    if not isinstance(val, six.string_types + (six.binary_type,)):
+        val = str(val)
+    length = len(val)
+    return length + len(str(length)) + 5
+
+
+class Collector(object):
+    """
+    Base class for collectors, receives every finished Operation
+    """
+    def record(self, operation):
+        raise NotImplementedError
+
+
+class Histogram(object):
+    """
+    Fixed-bucket histogram (exponential bucket bounds) with count/sum/min/max
+    and approximate percentiles
+    """
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, val):
+        self.buckets[bisect.bisect_left(self.bounds, val)] += 1
+        self.count += 1
+        self.total += val
+        self.min = val if self.min is None else min(self.min, val)
+        self.max = val if self.max is None else max(self.max, val)
+
+    def percentile(self, percent):
+        """
+        Upper bound of the bucket containing the given percentile
+        """
+        if not self.count:
+            return None
+
+        threshold = self.count * percent / 100.0
+        seen = 0
+        for i, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= threshold:
+                if i < len(self.bounds):
+                    return min(self.bounds[i], self.max)
+                return self.max
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'min': self.min,
+            'max': self.max,
+            'mean': float(self.total) / self.count if self.count else None,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+        }
+
+
+def exponential_bounds(start, factor, count):
+    return [start * factor ** i for i in range(count)]
+
+
+TIME_BOUNDS = exponential_bounds(0.00001, 2, 24)     # 10us to ~80s
+SIZE_BOUNDS = exponential_bounds(16, 2, 24)          # 16 bytes to ~128MB
+COUNT_BOUNDS = exponential_bounds(1, 2, 16)          # 1 to 32768
+
+
+class HistogramCollector(Collector):
+    """
+    Keeps in-memory histograms per (model, operation) and metric
+    """
+    metrics = (
+        ('commands', COUNT_BOUNDS),
+        ('round_trips', COUNT_BOUNDS),
+        ('bytes_sent', SIZE_BOUNDS),
+        ('bytes_received', SIZE_BOUNDS),
+        ('encode_time', TIME_BOUNDS),
+        ('network_time', TIME_BOUNDS),
+        ('decode_time', TIME_BOUNDS),
+        ('total_time', TIME_BOUNDS),
+    )
+
+    def __init__(self):
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def record(self, operation):
+        key = (operation.model, operation.name)
+
+        with self._lock:
+            histograms = self.histograms.get(key)
+            if histograms is None:
+                histograms = {name: Histogram(bounds) for name, bounds in self.metrics}
+                self.histograms[key] = histograms
+
+            for name, bounds in self.metrics:
+                histograms[name].add(getattr(operation, name))
+
+    def get(self, model, operation, metric):
+        """ Get a single Histogram, e.g. get('Store', 'get', 'network_time') """
+        return self.histograms[(model, operation)][metric]
+
+    def summary(self):
+        """
+        {(model, operation): {metric: summary dict}}
+        """
+        with self._lock:
+            return {
+                key: {name: hist.summary() for name, hist in histograms.items()}
+                for key, histograms in self.histograms.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+
+
+class StatsdCollector(Collector):
+    """
+    Adapter for statsd-style clients: anything with timing(name, ms) and
+    incr(name, count) (e.g. the `statsd` package)
+
+    Metric names look like: <prefix>.<model>.<operation>.<metric>
+    """
+    counters = ('commands', 'round_trips', 'bytes_sent', 'bytes_received')
+    timers = ('encode_time', 'network_time', 'decode_time', 'total_time')
+
+    def __init__(self, client, prefix='rohm'):
+        self.client = client
+        self.prefix = prefix
+
+    def record(self, operation):
+        base = '{}.{}.{}'.format(self.prefix, operation.model.lower(), operation.name)
+
+        self.client.incr('{}.calls'.format(base), 1)
+        for name in self.counters:
+            self.client.incr('{}.{}'.format(base, name), getattr(operation, name))
+
+        for name in self.timers:
+            self.client.timing('{}.{}'.format(base, name), getattr(operation, name) * 1000)
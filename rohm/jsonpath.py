@@ -0,0 +1,109 @@
+"""
+Path-level changes to JSONField documents, so that a small change to a big
+document doesn't re-send all of it.
+
+A path is a list of dict keys (strings) and list indexes, e.g. ['items', 3, 'price'].
+An operation is ('set', path, value) or ('del', path). They're applied in Redis by
+the json_patch script (see rohm.scripts), which re-encodes the document with cjson.
+cjson can't round-trip every document (floats, integers past 14 digits and empty lists
+would change), so operations are only used for "safe" documents; anything else is
+written in full, like before.
+"""
+import copy
+
+import six
+
+# cjson encodes numbers with 14 significant digits (and Redis doesn't allow more)
+MAX_SAFE_INTEGER = 10 ** 14
+
+
+def is_safe(value):
+    """
+    Does `value` survive a cjson decode/encode unchanged?
+    """
+    if isinstance(value, bool) or value is None or isinstance(value, six.string_types):
+        return True
+    elif isinstance(value, six.integer_types):
+        return abs(value) < MAX_SAFE_INTEGER
+    elif isinstance(value, dict):
+        return bool(value) and all(isinstance(key, six.string_types) and is_safe(val)
+                                   for key, val in value.items())
+    elif isinstance(value, (list, tuple)):
+        return bool(value) and all(is_safe(val) for val in value)
+    return False
+
+
+def get_ops(old, new, path=None):
+    """
+    Operations that turn `old` into `new`, or None if they can't be expressed
+    safely as operations below the document root. The whole of `new` has to be safe,
+    since the script re-encodes all of it
+    """
+    if not is_safe(new):
+        return None
+    ops = _diff(old, new, path or [])
+    if ops is None or any(not op[1] for op in ops):
+        return None
+    return ops
+
+
+def _diff(old, new, path):
+    if isinstance(old, dict) and isinstance(new, dict):
+        if not all(isinstance(key, six.string_types) for key in new):
+            return None
+
+        ops = [('del', path + [key]) for key in sorted(old) if key not in new]
+        for key in sorted(new):
+            if key in old:
+                sub_ops = _diff(old[key], new[key], path + [key])
+                if sub_ops is None:
+                    return None
+                ops.extend(sub_ops)
+            else:
+                ops.append(('set', path + [key], new[key]))
+        return ops
+
+    elif isinstance(old, (list, tuple)) and isinstance(new, (list, tuple)):
+        common = min(len(old), len(new))
+        ops = []
+        for i in range(common):
+            sub_ops = _diff(old[i], new[i], path + [i])
+            if sub_ops is None:
+                return None
+            ops.extend(sub_ops)
+
+        # Appended items, or removed ones (from the end, so indexes stay valid)
+        ops.extend(('set', path + [i], new[i]) for i in range(common, len(new)))
+        ops.extend(('del', path + [i]) for i in reversed(range(common, len(old))))
+        return ops
+
+    elif type(old) is type(new) and old == new:
+        return []
+
+    return [('set', path, new)]
+
+
+def apply_ops(doc, ops):
+    """
+    Apply operations to a (loaded) document, in place. Returns the document
+    """
+    for op in ops:
+        path = op[1]
+        if not path:
+            raise ValueError('Empty JSON path')
+
+        node = doc
+        for step in path[:-1]:
+            node = node[step]
+
+        last = path[-1]
+        if op[0] == 'set':
+            value = copy.deepcopy(op[2])
+            if isinstance(node, list) and last == len(node):
+                node.append(value)
+            else:
+                node[last] = value
+        else:
+            del node[last]
+
+    return doc
@@ -0,0 +1,280 @@
+"""
+Helpers for loading missing models from their source of truth (create_from_id/s)
+"""
+from collections import Counter
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import threading
+import time
+import uuid
+
+from rohm.scripts import release_lock
+
+
+logger = logging.getLogger(__name__)
+
+
+class NegativeCache(object):
+    """
+    In-process cache of ids known not to exist in the source of truth, so they
+    aren't re-queried on every Model.get(..., allow_create=True).
+    Entries expire after their ttl (seconds).
+    """
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._expires = {}     # {(key prefix, id): expiry timestamp}
+        self._lock = threading.Lock()
+
+    def add(self, model_cls, id, ttl):
+        with self._lock:
+            if len(self._expires) >= self.max_size:
+                self._purge()
+            self._expires[(model_cls._key_prefix, id)] = time.time() + ttl
+
+    def contains(self, model_cls, id):
+        key = (model_cls._key_prefix, id)
+        expires = self._expires.get(key)
+        if expires is None:
+            return False
+
+        if expires < time.time():
+            with self._lock:
+                self._expires.pop(key, None)
+            return False
+
+        return True
+
+    def discard(self, model_cls, id):
+        with self._lock:
+            self._expires.pop((model_cls._key_prefix, id), None)
+
+    def clear(self):
+        with self._lock:
+            self._expires.clear()
+
+    def _purge(self):
+        now = time.time()
+        self._expires = {key: expires for key, expires in self._expires.items() if expires >= now}
+        if len(self._expires) >= self.max_size:
+            # Still full of live entries: start over rather than grow unbounded
+            self._expires = {}
+
+    def __len__(self):
+        return len(self._expires)
+
+
+negative_cache = NegativeCache()
+
+
+# Counters of stampede protection, for monitoring:
+# - loads: loads done by the first caller of an id (in this process)
+# - collapsed: callers that waited for another thread's load instead of loading
+# - locks_acquired: ids this process got the cross-process rebuild lock for
+# - lock_waits: ids another process was rebuilding, that we waited for
+# - lock_wait_hits: ...and that appeared in Redis within the wait
+# - lock_timeouts: ...and that didn't, so we rebuilt them ourselves
+# - refreshes: ids refreshed in the background before they expire (refresh_window)
+# - refresh_errors: ...whose refresh raised
+stampede_stats = Counter()
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.done = False
+        self.result = None
+
+
+class SingleFlight(object):
+    """
+    Collapses concurrent loads of the same model id in this process: the first
+    caller loads, the others wait for its result
+    """
+    def __init__(self):
+        self._calls = {}    # {(key prefix, id): _Call}
+        self._lock = threading.Lock()
+
+    def load(self, model_cls, ids, loader, timeout=10):
+        """
+        loader(ids) returns {id: instance}. Returns {id: instance} for `ids`; callers that
+        waited on another thread get their own copy of the instance
+        """
+        own_calls = {}
+        waiting = {}
+        with self._lock:
+            for id in ids:
+                key = (model_cls._key_prefix, id)
+                call = self._calls.get(key)
+                if call is None:
+                    own_calls[id] = self._calls[key] = _Call()
+                else:
+                    waiting[id] = call
+
+            stampede_stats['loads'] += len(own_calls)
+            stampede_stats['collapsed'] += len(waiting)
+
+        results = {}
+        if own_calls:
+            loaded = {}
+            try:
+                loaded = loader(list(own_calls.keys()))
+                results.update(loaded)
+            finally:
+                with self._lock:
+                    for id, call in own_calls.items():
+                        if id in loaded:
+                            call.result = loaded[id]
+                            call.done = True
+                        del self._calls[(model_cls._key_prefix, id)]
+                        call.event.set()
+
+        not_loaded = []
+        for id, call in waiting.items():
+            call.event.wait(timeout)
+            if call.done:
+                results[id] = model_cls._copy_instance(call.result)
+            else:
+                not_loaded.append(id)
+
+        if not_loaded:
+            # The other caller failed (or timed out), try ourselves
+            results.update(loader(not_loaded))
+
+        return results
+
+
+single_flight = SingleFlight()
+
+
+class RebuildLock(object):
+    """
+    Cross-process lock (SET NX PX) per model id, so only one worker rebuilds a
+    missing model while the others wait for it to appear in Redis
+    """
+    def __init__(self, model_cls, ids, lease):
+        self.model_cls = model_cls
+        self.lease_ms = int(lease * 1000)
+        self.token = uuid.uuid4().hex
+        self.keys = {id: model_cls.generate_sibling_key(id, 'rebuild_lock') for id in ids}
+        self.acquired = []
+
+    def acquire(self):
+        """
+        Try to lock every id (one round trip). Returns the ids we got the lock for
+        """
+        ids = list(self.keys.keys())
+        pipe = self.model_cls.get_connection().pipeline(transaction=False)
+        for id in ids:
+            pipe.set(self.keys[id], self.token, px=self.lease_ms, nx=True)
+
+        self.acquired = [id for id, ok in zip(ids, pipe.execute()) if ok]
+        stampede_stats['locks_acquired'] += len(self.acquired)
+        return self.acquired
+
+    def release(self):
+        if not self.acquired:
+            return
+
+        pipe = self.model_cls.get_connection().pipeline(transaction=False)
+        for id in self.acquired:
+            release_lock(pipe, keys=[self.keys[id]], args=[self.token])
+        pipe.execute()
+        self.acquired = []
+
+
+def wait_for_rebuild(model_cls, ids, timeout, interval=0.05):
+    """
+    Poll Redis until the models `ids` (being rebuilt by another process) exist, for up
+    to `timeout` seconds. Returns ({id: instance} that appeared, [ids still missing])
+    """
+    stampede_stats['lock_waits'] += len(ids)
+    found = {}
+    missing = list(ids)
+    deadline = time.time() + timeout
+
+    while missing and time.time() < deadline:
+        time.sleep(interval)
+        instances = model_cls.get(missing, raise_missing_exception=False)
+        for id, instance in zip(list(missing), instances):
+            if instance is not None:
+                found[id] = instance
+                missing.remove(id)
+
+    stampede_stats['lock_wait_hits'] += len(found)
+    stampede_stats['lock_timeouts'] += len(missing)
+    return found, missing
+
+
+class BackgroundRefresher(object):
+    """
+    Runs refreshes of models about to expire on a thread pool (created on first use,
+    and again after a fork), at most one at a time per model id in this process
+    """
+    def __init__(self, num_threads=4):
+        self.num_threads = num_threads
+        self._pool = None
+        self._pid = os.getpid()
+        self._pending = set()   # {(key prefix, id)}
+        self._lock = threading.Lock()
+
+    def schedule(self, model_cls, ids, refresh):
+        """
+        Call refresh(ids) in the background for the `ids` not being refreshed already.
+        Returns those ids
+        """
+        if self._pid != os.getpid():
+            self._after_fork()
+
+        with self._lock:
+            new_ids = []
+            for id in ids:
+                key = (model_cls._key_prefix, id)
+                if key not in self._pending:
+                    self._pending.add(key)
+                    new_ids.append(id)
+            ids = new_ids
+            if not ids:
+                return []
+
+            if self._pool is None:
+                self._pool = ThreadPool(self.num_threads)
+            pool = self._pool
+
+        stampede_stats['refreshes'] += len(ids)
+        pool.apply_async(self._run, (model_cls, ids, refresh))
+        return ids
+
+    def _after_fork(self):
+        """
+        The parent's threads aren't running in this process: forget their refreshes, and
+        don't use their lock (it may have been held at the fork) or pool
+        """
+        self._pool = None
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _run(self, model_cls, ids, refresh):
+        try:
+            refresh(ids)
+        except Exception:
+            stampede_stats['refresh_errors'] += len(ids)
+            logger.exception('Refreshing %s %s failed', model_cls.__name__, ids)
+        finally:
+            with self._lock:
+                self._pending.difference_update((model_cls._key_prefix, id) for id in ids)
+
+    def wait(self, timeout=None, interval=0.01):
+        """
+        Wait until no refresh is running (for tests and shutdown). Returns whether it got there
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while self._pending:
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(interval)
+        return True
+
+
+background_refresher = BackgroundRefresher()
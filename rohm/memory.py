@@ -0,0 +1,1157 @@
+"""
+In-memory Redis for tests and benchmarks.
+
+MemoryRedis is a StrictRedis whose connections run commands against Python data
+structures instead of a socket. Everything above the connection (command methods,
+pipelines, WATCH/MULTI/EXEC, reply parsing) is redis-py's own code, so models
+behave like they do against a server:
+
+    from rohm.memory import MemoryRedis
+
+    conn = MemoryRedis()
+    Foo.set_connection(conn)        # or set_default_connection(conn)
+
+Every MemoryRedis has its own data (unless given the same `server`), so tests can
+run in parallel without flushing a shared database. Only the commands rohm uses are
+implemented (others raise ResponseError), and EVAL only runs rohm's own scripts
+(see rohm.scripts), with Python implementations.
+
+Expiry follows `clock`. Use a FakeClock to control it:
+
+    clock = FakeClock()
+    conn = MemoryRedis(clock=clock)
+    ...
+    clock.advance(60)
+"""
+from collections import deque
+import binascii
+import fnmatch
+import hashlib
+import inspect
+import json
+import math
+import os
+import threading
+import time
+import weakref
+
+import six
+from redis import StrictRedis, ConnectionPool
+from redis.connection import BaseParser
+from redis.exceptions import ResponseError
+
+from rohm import scripts, jsonpath
+
+WRONGTYPE = 'WRONGTYPE Operation against a key holding the wrong kind of value'
+
+EARTH_RADIUS_M = 6372797.560856
+GEO_LAT_MIN, GEO_LAT_MAX = -85.05112878, 85.05112878
+GEO_STEPS = 26
+GEO_UNITS = {'m': 1.0, 'km': 1000.0, 'mi': 1609.34, 'ft': 0.3048}
+
+_parser = BaseParser()
+
+getargspec = getattr(inspect, 'getfullargspec', None) or inspect.getargspec
+
+
+class CommandError(Exception):
+    pass
+
+
+class FakeClock(object):
+    """
+    A clock that only moves when told to
+    """
+    def __init__(self, now=None):
+        self.now = time.time() if now is None else now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class SortedSet(dict):
+    """ {member: score} """
+
+    def ordered(self):
+        return sorted(self.items(), key=lambda item: (item[1], item[0]))
+
+
+def _int(value):
+    try:
+        return int(value)
+    except ValueError:
+        raise CommandError('ERR value is not an integer or out of range')
+
+
+def _arity(method):
+    """ (min, max) number of arguments of a cmd_<name> method """
+    spec = getargspec(method)
+    num_args = len(spec.args) - 1     # self
+    max_args = float('inf') if spec.varargs else num_args
+    return num_args - len(spec.defaults or ()), max_args
+
+
+def _key_cursor(key):
+    """ SCAN cursor (a number, like Redis') resuming after `key` """
+    return str(int(binascii.hexlify(b'\x01' + key), 16))
+
+
+def _cursor_key(cursor):
+    digits = '%x' % _int(cursor)
+    try:
+        return binascii.unhexlify('0' * (len(digits) % 2) + digits)[1:]
+    except (TypeError, ValueError):
+        raise CommandError('ERR invalid cursor')
+
+
+def _float(value):
+    try:
+        return float(value)
+    except ValueError:
+        raise CommandError('ERR value is not a valid float')
+
+
+def _format_float(value):
+    return '%.17g' % value
+
+
+def _slice(items, start, end):
+    """ Redis-style inclusive range, with negative indexes """
+    size = len(items)
+    start, end = _int(start), _int(end)
+    if start < 0:
+        start = max(size + start, 0)
+    if end < 0:
+        end = size + end
+    end = min(end, size - 1)
+    if start > end:
+        return []
+    return items[start:end + 1]
+
+
+def _protocol_reply(reply):
+    """ Integers come off the wire as longs on Python 2, some reply callbacks rely on it """
+    if isinstance(reply, six.integer_types) and not isinstance(reply, bool):
+        return six.integer_types[-1](reply)
+    elif isinstance(reply, list):
+        return [_protocol_reply(item) for item in reply]
+    return reply
+
+
+def _score_bound(value):
+    """ (score, exclusive) of a ZRANGEBYSCORE bound """
+    if value.startswith('('):
+        return _float(value[1:]), True
+    return _float(value), False
+
+
+def _lex_bound(value):
+    """ (member or None for unbounded, exclusive) of a ZRANGEBYLEX bound """
+    if value in ('-', '+'):
+        return None, False
+    if value[:1] not in ('[', '('):
+        raise CommandError('ERR min or max not valid string range item')
+    return value[1:], value[0] == '('
+
+
+class MemoryServer(object):
+    """
+    The data of one in-memory "Redis". Commands are run by cmd_<name> methods
+    with the raw (bytes) arguments, and return raw replies like the protocol does
+    """
+    def __init__(self, clock=None):
+        self.clock = clock or time.time
+        self.lock = threading.RLock()
+        self.flush()
+
+    def flush(self):
+        # Like Redis, flushing counts as a write to every WATCHed key
+        for connections in getattr(self, 'watchers', {}).values():
+            for connection in connections:
+                connection.dirty = True
+        self.data = {}
+        self.expires = {}       # {key: timestamp}
+        self.watchers = {}      # {key: connections WATCHing it}
+
+    # ---------
+    # Execution
+    # ---------
+    def execute(self, connection, args):
+        name = args[0].upper()
+        with self.lock:
+            if connection.queued is not None and name not in ('EXEC', 'DISCARD', 'MULTI', 'WATCH'):
+                if not hasattr(self, 'cmd_' + name.lower()):
+                    return self._unknown_command(name)
+                connection.queued.append(args)
+                return 'QUEUED'
+
+            if name == 'MULTI':
+                if connection.queued is not None:
+                    return _parser.parse_error('ERR MULTI calls can not be nested')
+                connection.queued = []
+                return 'OK'
+            elif name == 'EXEC':
+                return self._exec(connection)
+            elif name == 'DISCARD':
+                connection.queued = None
+                self.unwatch(connection)
+                return 'OK'
+            elif name == 'WATCH':
+                for key in args[1:]:
+                    self._expire_if_needed(key)
+                    self.watchers.setdefault(key, weakref.WeakSet()).add(connection)
+                    connection.watched.add(key)
+                return 'OK'
+            elif name == 'UNWATCH':
+                self.unwatch(connection)
+                return 'OK'
+
+            return self.run(args)
+
+    def _exec(self, connection):
+        queued, connection.queued = connection.queued, None
+        if queued is None:
+            return _parser.parse_error('ERR EXEC without MULTI')
+
+        # Keys that expired since WATCH abort too
+        for key in connection.watched:
+            self._expire_if_needed(key)
+        dirty = connection.dirty
+        self.unwatch(connection)
+        if dirty:
+            return None
+
+        return [self.run(args) for args in queued]
+
+    def unwatch(self, connection):
+        for key in connection.watched:
+            connections = self.watchers.get(key)
+            if connections is not None:
+                connections.discard(connection)
+                if not connections:
+                    del self.watchers[key]
+        connection.watched = set()
+        connection.dirty = False
+
+    def run(self, args):
+        name = args[0].upper()
+        method = getattr(self, 'cmd_' + name.lower(), None)
+        if method is None:
+            return self._unknown_command(name)
+        min_args, max_args = _arity(method)
+        if not min_args <= len(args) - 1 <= max_args:
+            return _parser.parse_error(
+                "ERR wrong number of arguments for '{}' command".format(name.lower()))
+        try:
+            return method(*args[1:])
+        except CommandError as e:
+            return _parser.parse_error(str(e))
+
+    def _unknown_command(self, name):
+        return _parser.parse_error("ERR unknown command '{}'".format(name))
+
+    # ------------
+    # Key helpers
+    # ------------
+    def _expire_if_needed(self, key):
+        expires = self.expires.get(key)
+        if expires is not None and expires <= self.clock():
+            del self.expires[key]
+            self.data.pop(key, None)
+            self._touch(key)
+
+    def _get(self, key, value_type):
+        self._expire_if_needed(key)
+        value = self.data.get(key)
+        if value is not None and type(value) is not value_type:
+            raise CommandError(WRONGTYPE)
+        return value
+
+    def _get_or_create(self, key, value_type):
+        value = self._get(key, value_type)
+        if value is None:
+            value = self.data[key] = value_type()
+        return value
+
+    def _touch(self, key):
+        """ Fails the transactions WATCHing `key` """
+        for connection in self.watchers.pop(key, ()):
+            connection.dirty = True
+
+    def _delete_if_empty(self, key):
+        if key in self.data and not self.data[key]:
+            self._delete(key)
+
+    def _delete(self, key):
+        self._expire_if_needed(key)
+        if key not in self.data:
+            return 0
+        del self.data[key]
+        self.expires.pop(key, None)
+        self._touch(key)
+        return 1
+
+    def _live_keys(self):
+        for key in list(self.data):
+            self._expire_if_needed(key)
+        return sorted(self.data)
+
+    # ------
+    # Server
+    # ------
+    def cmd_ping(self, message=None):
+        return message if message is not None else 'PONG'
+
+    def cmd_echo(self, message):
+        return message
+
+    def cmd_select(self, db):
+        return 'OK'
+
+    def cmd_flushdb(self, *options):
+        self.flush()
+        return 'OK'
+
+    cmd_flushall = cmd_flushdb
+
+    def cmd_dbsize(self):
+        return len(self._live_keys())
+
+    def cmd_info(self, *sections):
+        return '# Server\r\nredis_version:6.2.0\r\nredis_mode:standalone\r\nrohm_memory:1\r\n'
+
+    def cmd_time(self):
+        now = self.clock()
+        return [str(int(now)), str(int((now % 1) * 1000000))]
+
+    # ----
+    # Keys
+    # ----
+    def cmd_del(self, *keys):
+        return sum(self._delete(key) for key in keys)
+
+    cmd_unlink = cmd_del
+
+    def cmd_exists(self, *keys):
+        count = 0
+        for key in keys:
+            self._expire_if_needed(key)
+            count += key in self.data
+        return count
+
+    def cmd_type(self, key):
+        self._expire_if_needed(key)
+        type_names = {bytes: 'string', dict: 'hash', set: 'set', list: 'list', SortedSet: 'zset'}
+        return type_names.get(type(self.data.get(key)), 'none')
+
+    def cmd_expire(self, key, seconds):
+        return self.cmd_pexpire(key, _int(seconds) * 1000)
+
+    def cmd_pexpire(self, key, milliseconds):
+        self._expire_if_needed(key)
+        if key not in self.data:
+            return 0
+        milliseconds = _int(milliseconds)
+        if milliseconds <= 0:
+            return self._delete(key)
+        self.expires[key] = self.clock() + milliseconds / 1000.0
+        self._touch(key)
+        return 1
+
+    def cmd_persist(self, key):
+        self._expire_if_needed(key)
+        if self.expires.pop(key, None) is None:
+            return 0
+        self._touch(key)
+        return 1
+
+    def cmd_pttl(self, key):
+        self._expire_if_needed(key)
+        if key not in self.data:
+            return -2
+        if key not in self.expires:
+            return -1
+        return int(round((self.expires[key] - self.clock()) * 1000))
+
+    def cmd_ttl(self, key):
+        pttl = self.cmd_pttl(key)
+        return pttl if pttl < 0 else int((pttl + 500) // 1000)
+
+    def cmd_keys(self, pattern):
+        return [key for key in self._live_keys() if fnmatch.fnmatchcase(key, pattern)]
+
+    def cmd_scan(self, cursor, *options):
+        match, count = '*', 10
+        options = list(options)
+        while options:
+            option = options.pop(0).upper()
+            if option == 'MATCH':
+                match = options.pop(0)
+            elif option == 'COUNT':
+                count = _int(options.pop(0))
+            else:
+                raise CommandError('ERR syntax error')
+
+        # Cursors encode the last key returned, so keys deleted meanwhile don't make
+        # the scan skip others (and the server keeps no state per scan)
+        last_key = _cursor_key(cursor) if cursor != '0' else None
+        keys = [key for key in self._live_keys() if last_key is None or key > last_key]
+        batch, rest = keys[:count], keys[count:]
+
+        next_cursor = _key_cursor(batch[-1]) if rest else '0'
+
+        return [next_cursor, [key for key in batch if fnmatch.fnmatchcase(key, match)]]
+
+    # -------
+    # Strings
+    # -------
+    def cmd_get(self, key):
+        return self._get(key, bytes)
+
+    def cmd_mget(self, *keys):
+        return [self.cmd_get(key) if type(self.data.get(key)) is bytes else None
+                for key in keys]
+
+    def cmd_set(self, key, value, *options):
+        ttl_ms = None
+        nx = xx = False
+        options = list(options)
+        while options:
+            option = options.pop(0).upper()
+            if option == 'EX':
+                ttl_ms = _int(options.pop(0)) * 1000
+            elif option == 'PX':
+                ttl_ms = _int(options.pop(0))
+            elif option == 'NX':
+                nx = True
+            elif option == 'XX':
+                xx = True
+            else:
+                raise CommandError('ERR syntax error')
+
+        self._expire_if_needed(key)
+        exists = key in self.data
+        if (nx and exists) or (xx and not exists):
+            return None
+
+        self.data[key] = value
+        self.expires.pop(key, None)
+        if ttl_ms is not None:
+            self.expires[key] = self.clock() + ttl_ms / 1000.0
+        self._touch(key)
+        return 'OK'
+
+    def cmd_incrby(self, key, amount):
+        value = _int(self._get(key, bytes) or 0) + _int(amount)
+        self.data[key] = str(value)
+        self._touch(key)
+        return value
+
+    def cmd_incr(self, key):
+        return self.cmd_incrby(key, '1')
+
+    def cmd_decr(self, key):
+        return self.cmd_incrby(key, '-1')
+
+    # -------
+    # Bitmaps
+    # -------
+    def _get_bits(self, key):
+        return bytearray(self._get(key, bytes) or b'')
+
+    def _set_bits(self, key, bits):
+        self.data[key] = bytes(bits)
+        self._touch(key)
+
+    def cmd_setbit(self, key, offset, value):
+        offset, value = _int(offset), _int(value)
+        if value not in (0, 1) or offset < 0:
+            raise CommandError('ERR bit is not an integer or out of range')
+
+        bits = self._get_bits(key)
+        byte, bit = divmod(offset, 8)
+        if len(bits) <= byte:
+            bits.extend(b'\x00' * (byte + 1 - len(bits)))
+
+        mask = 1 << (7 - bit)
+        old = 1 if bits[byte] & mask else 0
+        bits[byte] = (bits[byte] | mask) if value else (bits[byte] & ~mask)
+        self._set_bits(key, bits)
+        return old
+
+    def cmd_getbit(self, key, offset):
+        bits = self._get_bits(key)
+        byte, bit = divmod(_int(offset), 8)
+        if byte >= len(bits):
+            return 0
+        return 1 if bits[byte] & (1 << (7 - bit)) else 0
+
+    def cmd_bitcount(self, key, start=None, end=None):
+        bits = self._get_bits(key)
+        if start is not None:
+            bits = _slice(bits, start, end)
+        return sum(bin(byte).count('1') for byte in bits)
+
+    def cmd_bitfield(self, key, *args):
+        replies = []
+        args = list(args)
+        while args:
+            subcommand = args.pop(0).upper()
+            if subcommand not in ('GET', 'SET'):
+                raise CommandError('ERR syntax error')
+
+            bit_type, offset = args.pop(0), args.pop(0)
+            signed, width = bit_type[:1].lower() == 'i', _int(bit_type[1:])
+            offset = _int(offset[1:]) * width if offset.startswith('#') else _int(offset)
+
+            value = 0
+            for i in range(width):
+                value = (value << 1) | self.cmd_getbit(key, offset + i)
+            if signed and value >= 1 << (width - 1):
+                value -= 1 << width
+            replies.append(value)
+
+            if subcommand == 'SET':
+                new = _int(args.pop(0)) & ((1 << width) - 1)
+                for i in range(width):
+                    self.cmd_setbit(key, offset + i, (new >> (width - 1 - i)) & 1)
+        return replies
+
+    # ------
+    # Hashes
+    # ------
+    def cmd_hset(self, key, *pairs):
+        if not pairs or len(pairs) % 2:
+            raise CommandError("ERR wrong number of arguments for 'hset' command")
+        hash = self._get_or_create(key, dict)
+        added = 0
+        for name, value in zip(pairs[::2], pairs[1::2]):
+            added += name not in hash
+            hash[name] = value
+        self._touch(key)
+        return added
+
+    def cmd_hmset(self, key, *pairs):
+        self.cmd_hset(key, *pairs)
+        return 'OK'
+
+    def cmd_hget(self, key, name):
+        return (self._get(key, dict) or {}).get(name)
+
+    def cmd_hmget(self, key, *names):
+        hash = self._get(key, dict) or {}
+        return [hash.get(name) for name in names]
+
+    def cmd_hgetall(self, key):
+        reply = []
+        for item in (self._get(key, dict) or {}).items():
+            reply.extend(item)
+        return reply
+
+    def cmd_hkeys(self, key):
+        return list((self._get(key, dict) or {}).keys())
+
+    def cmd_hvals(self, key):
+        return list((self._get(key, dict) or {}).values())
+
+    def cmd_hlen(self, key):
+        return len(self._get(key, dict) or {})
+
+    def cmd_hexists(self, key, name):
+        return int(name in (self._get(key, dict) or {}))
+
+    def cmd_hdel(self, key, *names):
+        hash = self._get(key, dict) or {}
+        deleted = sum(hash.pop(name, None) is not None for name in names)
+        if deleted:
+            self._touch(key)
+            self._delete_if_empty(key)
+        return deleted
+
+    def cmd_hincrby(self, key, name, amount):
+        hash = self._get_or_create(key, dict)
+        value = _int(hash.get(name, 0)) + _int(amount)
+        hash[name] = str(value)
+        self._touch(key)
+        return value
+
+    def cmd_hincrbyfloat(self, key, name, amount):
+        hash = self._get_or_create(key, dict)
+        value = _float(hash.get(name, 0)) + _float(amount)
+        hash[name] = _format_float(value)
+        self._touch(key)
+        return hash[name]
+
+    # ----
+    # Sets
+    # ----
+    def cmd_sadd(self, key, *members):
+        members_set = self._get_or_create(key, set)
+        added = len(set(members) - members_set)
+        members_set.update(members)
+        self._touch(key)
+        return added
+
+    def cmd_srem(self, key, *members):
+        members_set = self._get(key, set) or set()
+        removed = len(members_set & set(members))
+        members_set.difference_update(members)
+        if removed:
+            self._touch(key)
+            self._delete_if_empty(key)
+        return removed
+
+    def cmd_smembers(self, key):
+        return list(self._get(key, set) or [])
+
+    def cmd_sismember(self, key, member):
+        return int(member in (self._get(key, set) or ()))
+
+    def cmd_scard(self, key):
+        return len(self._get(key, set) or ())
+
+    # -----
+    # Lists
+    # -----
+    def cmd_rpush(self, key, *values):
+        items = self._get_or_create(key, list)
+        items.extend(values)
+        self._touch(key)
+        return len(items)
+
+    def cmd_lpush(self, key, *values):
+        items = self._get_or_create(key, list)
+        for value in values:
+            items.insert(0, value)
+        self._touch(key)
+        return len(items)
+
+    def _pop(self, key, index):
+        items = self._get(key, list)
+        if not items:
+            return None
+        value = items.pop(index)
+        self._touch(key)
+        self._delete_if_empty(key)
+        return value
+
+    def cmd_rpop(self, key):
+        return self._pop(key, -1)
+
+    def cmd_lpop(self, key):
+        return self._pop(key, 0)
+
+    def cmd_lrange(self, key, start, end):
+        return _slice(self._get(key, list) or [], start, end)
+
+    def cmd_lindex(self, key, index):
+        items = self._get(key, list) or []
+        index = _int(index)
+        return items[index] if -len(items) <= index < len(items) else None
+
+    def cmd_llen(self, key):
+        return len(self._get(key, list) or [])
+
+    def cmd_lrem(self, key, count, value):
+        items = self._get(key, list) or []
+        count = _int(count)
+        indexes = [i for i, item in enumerate(items) if item == value]
+        if count < 0:
+            indexes = indexes[count:]
+        elif count > 0:
+            indexes = indexes[:count]
+
+        for i in reversed(indexes):
+            del items[i]
+        if indexes:
+            self._touch(key)
+            self._delete_if_empty(key)
+        return len(indexes)
+
+    def cmd_ltrim(self, key, start, end):
+        items = self._get(key, list)
+        if items is not None:
+            items[:] = _slice(items, start, end)
+            self._touch(key)
+            self._delete_if_empty(key)
+        return 'OK'
+
+    # -----------
+    # Sorted sets
+    # -----------
+    def cmd_zadd(self, key, *args):
+        args = list(args)
+        flags = set()
+        while args and args[0].upper() in ('NX', 'XX', 'CH'):
+            flags.add(args.pop(0).upper())
+        if not args or len(args) % 2:
+            raise CommandError('ERR syntax error')
+
+        zset = self._get_or_create(key, SortedSet)
+        changed = 0
+        for score, member in zip(args[::2], args[1::2]):
+            score = _float(score)
+            exists = member in zset
+            if ('NX' in flags and exists) or ('XX' in flags and not exists):
+                continue
+            if not exists or ('CH' in flags and zset[member] != score):
+                changed += 1
+            zset[member] = score
+
+        self._touch(key)
+        self._delete_if_empty(key)
+        return changed
+
+    def cmd_zincrby(self, key, amount, member):
+        zset = self._get_or_create(key, SortedSet)
+        zset[member] = zset.get(member, 0.0) + _float(amount)
+        self._touch(key)
+        return _format_float(zset[member])
+
+    def cmd_zrem(self, key, *members):
+        zset = self._get(key, SortedSet) or {}
+        removed = sum(zset.pop(member, None) is not None for member in members)
+        if removed:
+            self._touch(key)
+            self._delete_if_empty(key)
+        return removed
+
+    def cmd_zscore(self, key, member):
+        score = (self._get(key, SortedSet) or {}).get(member)
+        return None if score is None else _format_float(score)
+
+    def cmd_zcard(self, key):
+        return len(self._get(key, SortedSet) or {})
+
+    def _zrank(self, key, member, reverse):
+        members = [item[0] for item in (self._get(key, SortedSet) or SortedSet()).ordered()]
+        if member not in members:
+            return None
+        rank = members.index(member)
+        return len(members) - 1 - rank if reverse else rank
+
+    def cmd_zrank(self, key, member):
+        return self._zrank(key, member, reverse=False)
+
+    def cmd_zrevrank(self, key, member):
+        return self._zrank(key, member, reverse=True)
+
+    def _range_reply(self, items, withscores):
+        if not withscores:
+            return [member for member, score in items]
+        reply = []
+        for member, score in items:
+            reply.extend([member, _format_float(score)])
+        return reply
+
+    def _parse_range_options(self, options):
+        withscores, offset, count = False, 0, None
+        options = list(options)
+        while options:
+            option = options.pop(0).upper()
+            if option == 'WITHSCORES':
+                withscores = True
+            elif option == 'LIMIT':
+                offset, count = _int(options.pop(0)), _int(options.pop(0))
+            else:
+                raise CommandError('ERR syntax error')
+        return withscores, offset, count
+
+    def _zrange(self, key, start, end, options, reverse):
+        withscores, offset, count = self._parse_range_options(options)
+        items = (self._get(key, SortedSet) or SortedSet()).ordered()
+        if reverse:
+            items.reverse()
+        return self._range_reply(_slice(items, start, end), withscores)
+
+    def cmd_zrange(self, key, start, end, *options):
+        return self._zrange(key, start, end, options, reverse=False)
+
+    def cmd_zrevrange(self, key, start, end, *options):
+        return self._zrange(key, start, end, options, reverse=True)
+
+    def _limit(self, items, offset, count):
+        if count is None or count < 0:
+            return items[offset:]
+        return items[offset:offset + count]
+
+    def cmd_zrangebyscore(self, key, min, max, *options):
+        withscores, offset, count = self._parse_range_options(options)
+        (low, low_exclusive), (high, high_exclusive) = _score_bound(min), _score_bound(max)
+
+        items = [(member, score) for member, score in
+                 (self._get(key, SortedSet) or SortedSet()).ordered()
+                 if (score > low if low_exclusive else score >= low) and
+                 (score < high if high_exclusive else score <= high)]
+        return self._range_reply(self._limit(items, offset, count), withscores)
+
+    def cmd_zrangebylex(self, key, min, max, *options):
+        withscores, offset, count = self._parse_range_options(options)
+        (low, low_exclusive), (high, high_exclusive) = _lex_bound(min), _lex_bound(max)
+        if min == '+' or max == '-':
+            return []
+
+        members = sorted((self._get(key, SortedSet) or {}).keys())
+        members = [member for member in members
+                   if (low is None or (member > low if low_exclusive else member >= low)) and
+                   (high is None or (member < high if high_exclusive else member <= high))]
+        return self._limit(members, offset, count)
+
+    # ---
+    # Geo
+    # ---
+    @staticmethod
+    def _geo_encode(lon, lat):
+        """ 52-bit interleaved geohash score, like Redis """
+        lat_bits = int((lat - GEO_LAT_MIN) / (GEO_LAT_MAX - GEO_LAT_MIN) * (1 << GEO_STEPS))
+        lon_bits = int((lon + 180.0) / 360.0 * (1 << GEO_STEPS))
+        lat_bits = min(lat_bits, (1 << GEO_STEPS) - 1)
+        lon_bits = min(lon_bits, (1 << GEO_STEPS) - 1)
+
+        score = 0
+        for i in reversed(range(GEO_STEPS)):
+            score = (score << 2) | (((lon_bits >> i) & 1) << 1) | ((lat_bits >> i) & 1)
+        return float(score)
+
+    @staticmethod
+    def _geo_decode(score):
+        score = int(score)
+        lat_bits = lon_bits = 0
+        for i in reversed(range(GEO_STEPS)):
+            lon_bits = (lon_bits << 1) | ((score >> (2 * i + 1)) & 1)
+            lat_bits = (lat_bits << 1) | ((score >> (2 * i)) & 1)
+
+        # Center of the cell
+        cell = 1.0 / (1 << GEO_STEPS)
+        lon = -180.0 + (lon_bits + 0.5) * cell * 360.0
+        lat = GEO_LAT_MIN + (lat_bits + 0.5) * cell * (GEO_LAT_MAX - GEO_LAT_MIN)
+        return lon, lat
+
+    @staticmethod
+    def _geo_distance(lon1, lat1, lon2, lat2):
+        lat1, lat2 = math.radians(lat1), math.radians(lat2)
+        u = math.sin((lat2 - lat1) / 2)
+        v = math.sin(math.radians(lon2 - lon1) / 2)
+        return 2.0 * EARTH_RADIUS_M * math.asin(
+            math.sqrt(u * u + math.cos(lat1) * math.cos(lat2) * v * v))
+
+    def cmd_geoadd(self, key, *args):
+        if not args or len(args) % 3:
+            raise CommandError("ERR wrong number of arguments for 'geoadd' command")
+
+        zadd_args = []
+        for lon, lat, member in zip(args[::3], args[1::3], args[2::3]):
+            lon, lat = _float(lon), _float(lat)
+            if not -180 <= lon <= 180 or not GEO_LAT_MIN <= lat <= GEO_LAT_MAX:
+                raise CommandError('ERR invalid longitude,latitude pair {},{}'.format(lon, lat))
+            zadd_args.extend([repr(self._geo_encode(lon, lat)), member])
+        return self.cmd_zadd(key, *zadd_args)
+
+    def cmd_georadius(self, key, lon, lat, radius, unit, *options):
+        unit = unit.lower()
+        if unit not in GEO_UNITS:
+            raise CommandError('ERR unsupported unit provided. please use m, km, ft, mi')
+
+        with_dist = with_coord = descending = False
+        count = None
+        options = list(options)
+        while options:
+            option = options.pop(0).upper()
+            if option == 'WITHDIST':
+                with_dist = True
+            elif option == 'WITHCOORD':
+                with_coord = True
+            elif option == 'COUNT':
+                count = _int(options.pop(0))
+            elif option in ('ASC', 'DESC'):
+                descending = option == 'DESC'
+            else:
+                raise CommandError('ERR syntax error')
+
+        lon, lat = _float(lon), _float(lat)
+        max_distance = _float(radius) * GEO_UNITS[unit]
+
+        matches = []
+        for member, score in (self._get(key, SortedSet) or {}).items():
+            member_lon, member_lat = self._geo_decode(score)
+            distance = self._geo_distance(lon, lat, member_lon, member_lat)
+            if distance <= max_distance:
+                matches.append((distance, member, member_lon, member_lat))
+
+        matches.sort(reverse=descending)
+        if count:
+            matches = matches[:count]
+
+        if not with_dist and not with_coord:
+            return [member for distance, member, _, _ in matches]
+
+        reply = []
+        for distance, member, member_lon, member_lat in matches:
+            item = [member]
+            if with_dist:
+                item.append('%.4f' % (distance / GEO_UNITS[unit]))
+            if with_coord:
+                item.append([repr(member_lon), repr(member_lat)])
+            reply.append(item)
+        return reply
+
+    # ---------
+    # Scripting
+    # ---------
+    def cmd_eval(self, script, numkeys, *args):
+        numkeys = _int(numkeys)
+        implementation = script_implementations.get(script)
+        if implementation is None:
+            raise CommandError('ERR The in-memory backend only runs rohm\'s scripts')
+        return implementation(self, list(args[:numkeys]), list(args[numkeys:]))
+
+
+class MemoryConnection(object):
+    """
+    Stands in for redis-py's Connection: commands are run against `server` when sent,
+    and their replies are read back in order
+    """
+    description_format = 'MemoryConnection<id=%(id)s>'
+
+    def __init__(self, server, encoding='utf-8', encoding_errors='strict', **kwargs):
+        self.server = server
+        self.encoding = encoding
+        self.encoding_errors = encoding_errors
+        self.pid = os.getpid()
+        self.retry_on_timeout = False
+        self._replies = deque()
+        self.queued = None      # commands queued after MULTI
+        self.watched = set()    # WATCHed keys
+        self.dirty = False      # a WATCHed key was written since
+
+    def __repr__(self):
+        return self.description_format % {'id': id(self)}
+
+    def connect(self):
+        pass
+
+    def disconnect(self):
+        self._replies.clear()
+        self.queued = None
+        with self.server.lock:
+            self.server.unwatch(self)
+
+    def register_connect_callback(self, callback):
+        pass
+
+    def clear_connect_callbacks(self):
+        pass
+
+    def can_read(self, timeout=0):
+        return bool(self._replies)
+
+    def encode(self, value):
+        if isinstance(value, bytes):
+            return value
+        elif isinstance(value, six.integer_types):
+            value = str(value)
+        elif isinstance(value, float):
+            value = repr(value)
+        elif not isinstance(value, six.string_types):
+            value = str(value)
+        if isinstance(value, six.text_type):
+            value = value.encode(self.encoding, self.encoding_errors)
+        return value
+
+    def pack_command(self, *args):
+        # Like redis-py, the command name may include literal arguments ('CLIENT KILL')
+        args = tuple(args[0].split()) + args[1:]
+        return [tuple(self.encode(arg) for arg in args)]
+
+    def pack_commands(self, commands):
+        packed = []
+        for args in commands:
+            packed.extend(self.pack_command(*args))
+        return packed
+
+    def send_packed_command(self, commands):
+        for args in commands:
+            self._replies.append(_protocol_reply(self.server.execute(self, args)))
+
+    def send_command(self, *args):
+        self.send_packed_command(self.pack_command(*args))
+
+    def read_response(self):
+        reply = self._replies.popleft()
+        if isinstance(reply, ResponseError):
+            raise reply
+        return reply
+
+
+class MemoryRedis(StrictRedis):
+    """
+    StrictRedis backed by a MemoryServer (a new, empty one unless given)
+
+    - clock: Function returning the current time (default time.time), see FakeClock
+    """
+    def __init__(self, clock=None, server=None, **kwargs):
+        self.server = server or MemoryServer(clock=clock)
+        pool = ConnectionPool(connection_class=MemoryConnection, server=self.server)
+        super(MemoryRedis, self).__init__(connection_pool=pool, **kwargs)
+
+    def __repr__(self):
+        return 'MemoryRedis<{}>'.format(id(self.server))
+
+
+# -------------------------------------------------
+# Python implementations of rohm's scripts, by body
+# -------------------------------------------------
+script_implementations = {}
+
+
+def implements(script):
+    def decorator(func):
+        script_implementations[script.lua] = func
+        return func
+    return decorator
+
+
+@implements(scripts.release_lock)
+def _release_lock(server, keys, args):
+    if server.cmd_get(keys[0]) == args[0]:
+        return server.cmd_del(keys[0])
+    return 0
+
+
+def _write_hash(server, key, args, ttl):
+    """ The "num_set, field, value, ..., fields to delete..." part of the save scripts """
+    num_set = _int(args[0])
+    pairs, to_delete = args[1:1 + num_set * 2], args[1 + num_set * 2:]
+    if pairs:
+        server.cmd_hset(key, *pairs)
+    if to_delete:
+        server.cmd_hdel(key, *to_delete)
+    if _int(ttl) > 0:
+        server.cmd_expire(key, ttl)
+
+
+@implements(scripts.update_if_exists)
+def _update_if_exists(server, keys, args):
+    if not server.cmd_exists(keys[0]):
+        return 0
+    if args[1]:
+        server.cmd_hincrby(keys[0], args[1], '1')
+    _write_hash(server, keys[0], args[2:], args[0])
+    return 1
+
+
+@implements(scripts.save_if_version)
+def _save_if_version(server, keys, args):
+    current = server.cmd_hget(keys[0], args[0])
+    if current is None:
+        if not server.cmd_exists(keys[0]):
+            raise CommandError('CONFLICT deleted')
+        current = '0'
+    if current != args[1]:
+        raise CommandError('CONFLICT stored version {}'.format(current))
+
+    version = _int(current) + 1
+    server.cmd_hset(keys[0], args[0], str(version))
+
+    last_set = 4 + _int(args[3]) * 2
+    last_delete = last_set + 1 + _int(args[last_set])
+    _write_hash(server, keys[0], args[3:last_set] + args[last_set + 1:last_delete], args[2])
+
+    i = last_delete
+    while i < len(args):
+        num_words = _int(args[i])
+        reply = server.run(args[i + 1:i + 1 + num_words])
+        if isinstance(reply, Exception):
+            raise CommandError(str(reply))
+        i += num_words + 1
+    return version
+
+
+def _json_safe(value):
+    """ Would cjson re-encode it unchanged? (Lua numbers are doubles) """
+    if isinstance(value, bool):
+        return True
+    elif isinstance(value, (six.integer_types, float)):
+        return value == math.floor(value) and abs(value) < jsonpath.MAX_SAFE_INTEGER
+    elif isinstance(value, (dict, list)):
+        return bool(value) and all(_json_safe(val) for val in
+                                   (value.values() if isinstance(value, dict) else value))
+    return True
+
+
+def _cjson_encode(value):
+    """
+    Encode like Redis' cjson: numbers are doubles written with 14 significant digits
+    """
+    if isinstance(value, bool) or value is None:
+        return json.dumps(value)
+    elif isinstance(value, (six.integer_types, float)):
+        return '%.14g' % value
+    elif isinstance(value, dict):
+        return '{' + ','.join('{}:{}'.format(_cjson_encode(key), _cjson_encode(val))
+                              for key, val in value.items()) + '}'
+    elif isinstance(value, list):
+        return '[' + ','.join(_cjson_encode(val) for val in value) + ']'
+
+    encoded = json.dumps(value, ensure_ascii=False)
+    return encoded.encode('utf-8') if isinstance(encoded, six.text_type) else encoded
+
+
+def _sha1(raw):
+    return hashlib.sha1(raw or b'').hexdigest()
+
+
+@implements(scripts.json_patch)
+def _json_patch(server, keys, args):
+    raw = server.cmd_hget(keys[0], args[0])
+    if raw is None:
+        return _sha1(raw)
+    doc = json.loads(raw)
+
+    for op in json.loads(args[1]):
+        path = op[1]
+        node = doc
+        for i, step in enumerate(path):
+            if isinstance(step, six.integer_types):
+                if not isinstance(node, list):
+                    return _sha1(raw)
+            elif not isinstance(node, dict):
+                return _sha1(raw)
+
+            if i < len(path) - 1:
+                try:
+                    node = node[step]
+                except (KeyError, IndexError):
+                    return _sha1(raw)
+            elif op[0] == 'set':
+                if isinstance(node, list):
+                    if step > len(node):
+                        return _sha1(raw)
+                    if step == len(node):
+                        node.append(op[2])
+                        continue
+                node[step] = op[2]
+            elif isinstance(node, list):
+                if step >= len(node):
+                    return _sha1(raw)
+                del node[step]
+            else:
+                node.pop(step, None)
+
+    if not _json_safe(doc):
+        return _sha1(raw)
+    server.cmd_hset(keys[0], args[0], _cjson_encode(doc))
+    return 1
+
+
+@implements(scripts.hset_if_unchanged)
+def _hset_if_unchanged(server, keys, args):
+    if not server.cmd_exists(keys[0]):
+        return 0
+    if _sha1(server.cmd_hget(keys[0], args[0])) != args[1]:
+        return 0
+    server.cmd_hset(keys[0], args[0], args[2])
+    return 1
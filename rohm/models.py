@@ -1,18 +1,48 @@
 import copy
+import functools
+import json
 import logging
+import time
+from multiprocessing.pool import ThreadPool
 
 import six
 import redis
 
-from rohm import model_registry
-from rohm.fields import BaseField, IntegerField, RelatedModelField, RelatedModelIdField
-from rohm.connection import get_default_connection, create_connection
-from rohm.exceptions import AlreadyExists, DoesNotExist
-from rohm.utils import redis_operation, hmget_result_is_nonexistent
+from rohm import model_registry, instrumentation, loading, jsonpath
+from rohm.fields import (
+    BaseField, IntegerField, RelatedModelField, RelatedModelIdField, ReverseRelatedDescriptor,
+    VersionField, CollectionField, JSONField, GeoField,
+)
+from rohm.batching import get_current_batch
+from rohm.connection import (
+    DEFAULT_ALIAS, get_connection, create_connection, get_connection_override,
+)
+from rohm.exceptions import AlreadyExists, DoesNotExist, FieldValidationError, ConflictError
+from rohm.loading import negative_cache, RebuildLock, wait_for_rebuild
+from rohm.recording import RecordingConnection, RecordingPipeline, command_key
+from rohm.scripts import update_if_exists, save_if_version, json_patch, hset_if_unchanged
+from rohm.utils import hmget_result_is_nonexistent, chunked, supports_unlink
 
 
 logger = logging.getLogger(__name__)
 
+# Reverse relations to models not defined yet: {model name: [(model_cls, RelatedModelField)]}
+pending_reverse_relations = {}
+
+
+def _with_connection_override(method):
+    """
+    Wrap a get_connection() classmethod so that rohm.connection.override_connection()
+    applies to it, even when a model overrides get_connection()
+    """
+    func = method.__func__
+
+    @functools.wraps(func)
+    def get_connection(cls):
+        return get_connection_override() or func(cls)
+
+    return classmethod(get_connection)
+
 
 class ModelMetaclass(type):
     def __new__(meta, name, bases, attrs):
@@ -25,7 +55,7 @@ class ModelMetaclass(type):
             if isinstance(val, RelatedModelField):
                 # Generate the actual ID field for a relation, suffixed with '_id'
                 related_id_field_name = '{}_id'.format(key)
-                attrs[related_id_field_name] = RelatedModelIdField(key)
+                attrs[related_id_field_name] = RelatedModelIdField(key, related_field=val)
 
         if id_field_name is None:
             # Make an id_field if not specified
@@ -36,6 +66,9 @@ class ModelMetaclass(type):
         # Store name of our id_field
         attrs['_id_field_name'] = id_field_name
 
+        if isinstance(attrs.get('get_connection'), classmethod):
+            attrs['get_connection'] = _with_connection_override(attrs['get_connection'])
+
         return super(ModelMetaclass, meta).__new__(meta, name, bases, attrs)
 
     def __init__(cls, name, bases, attrs):
@@ -56,9 +89,57 @@ class ModelMetaclass(type):
                 if not isinstance(val, RelatedModelField):
                     cls._real_fields[key] = val
 
+        # Deferred (lazy=True) fields, and the rest that get loaded by default
+        cls._deferred_field_names = sorted(
+            name for name, field in cls._real_fields.items() if field.lazy)
+        cls._eager_field_names = sorted(
+            name for name, field in cls._real_fields.items() if not field.lazy)
+
+        # Optimistic concurrency version (VersionField), if any
+        cls._version_field_name = next(
+            (name for name, field in sorted(cls._real_fields.items())
+             if isinstance(field, VersionField)), None)
+
+        # Fields that maintain index entries outside the hash
+        cls._indexed_field_names = sorted(
+            name for name, field in cls._real_fields.items() if field.has_index)
+
+        for field in cls._real_fields.values():
+            field.check_model(cls)
+
+        # Names of keys that belong to an instance, next to its hash ("prefix:id:name")
+        cls._sibling_key_names = []
+
+        # Fields stored in their own sibling key (SetField, ListField...)
+        cls._collection_fields = {}
+        for key, val in attrs.items():
+            if isinstance(val, CollectionField):
+                val.field_name = key
+                cls._collection_fields[key] = val
+                cls._sibling_key_names.append(key)
+
         # Track this Model in a global registry
         model_registry[name] = cls
 
+        # Reverse relations, both from this model and to it
+        for field in cls._fields.values():
+            if isinstance(field, RelatedModelField) and field.related_name:
+                target = field._model_cls
+                if isinstance(target, six.string_types):
+                    target = model_registry.get(target)
+
+                if target is None:
+                    pending_reverse_relations.setdefault(field._model_cls, []).append((cls, field))
+                else:
+                    target._add_reverse_relation(cls, field)
+
+        for model_cls, field in pending_reverse_relations.pop(name, []):
+            cls._add_reverse_relation(model_cls, field)
+
+    def _add_reverse_relation(cls, model_cls, field):
+        setattr(cls, field.related_name, ReverseRelatedDescriptor(model_cls, field.related_name))
+        cls._sibling_key_names.append(field.related_name)
+
 
 class Model(six.with_metaclass(ModelMetaclass)):
     """
@@ -77,11 +158,33 @@ class Model(six.with_metaclass(ModelMetaclass)):
     - track_modified_fields - Track what fields are modified (by storing the original)
     - save_modified_only - On save, only save modified fields. Assumes track_modified_fields==True
     - ttl - Time to live in seconds (uses Redis' built-in ttl)
+    - connection_alias - Name of a connection in the registry (see rohm.connection).
+      Ignored if a connection is set directly with set_connection()
+    - missing_cache_ttl - With allow_create, remember ids that don't exist in the source
+      of truth for this many seconds (in-process), instead of asking again every time
+    - single_flight - With allow_create, concurrent loads of the same missing id in this
+      process share one create_from_ids() call
+    - rebuild_lock_timeout - With allow_create, lock each missing id in Redis for this many
+      seconds while rebuilding it, so only one process rebuilds it. Other processes wait up
+      to rebuild_lock_wait seconds for it to appear before rebuilding it themselves
+    - shared_cache - A rohm.sharedcache.SharedMemoryCache that full loads go through
+      first, shared by the processes of a host
+    - refresh_window - With ttl and create_from_ids(), get() also fetches the remaining ttl,
+      and models that expire within this many seconds are rebuilt and saved again in the
+      background (stale-while-revalidate), once at a time per id in this process, and
+      only by the process holding the rebuild lock if rebuild_lock_timeout is set
     """
     track_modified_fields = True
     save_modified_only = True
     ttl = None
     connection = None
+    connection_alias = DEFAULT_ALIAS
+    missing_cache_ttl = None
+    single_flight = False
+    rebuild_lock_timeout = None
+    rebuild_lock_wait = 0.5
+    shared_cache = None
+    refresh_window = None
 
     def __init__(self, _new=True, _partial=False, **field_data):
         """
@@ -102,11 +205,12 @@ class Model(six.with_metaclass(ModelMetaclass)):
         self._orig_data = {}                   # the original data
         self._loaded_field_names = set()       # only for "real" fields, fields that have been loaded
         self._loaded_related_field_data = {}   # for Related stuff
+        self._pending_collections = {}         # collection fields to replace on save
 
         for key, val in field_data.items():
             # Populate self._data and self._loaded_related_field_data
             # field_data can be both real fields and Models (RelateModelField)
-            if key in self._fields:
+            if key in self._fields or key in self._collection_fields:
                 setattr(self, key, val)
 
         if not _new and not _partial:
@@ -117,8 +221,8 @@ class Model(six.with_metaclass(ModelMetaclass)):
         for field_name, field in self._real_fields.items():
 
             if field_name not in self._data:
-                # Handle missing values
-                if field.default:
+                # Handle missing values (a partial load just didn't fetch them)
+                if field.default and not _partial:
                     # Set default value
                     default_val = field.get_default_value()
                     setattr(self, field_name, default_val)
@@ -134,13 +238,16 @@ class Model(six.with_metaclass(ModelMetaclass)):
     # Classmethods
     # ------------
     @classmethod
-    def get(cls, ids=None, id=None, fields=None, allow_create=False, raise_missing_exception=None):
+    def get(cls, ids=None, id=None, fields=None, allow_create=False, raise_missing_exception=None,
+            include_deferred=False):
         """
         Get a rohm Model from Redis. Can specify one ID or multiple
 
         - fields: A list/tuple to only load these fields (partial load)
-        - allow_create: If missing, allows it to be created. "create_from_id()" must be implemented
+        - allow_create: If missing, allows it to be created. "create_from_ids()" (or
+          "create_from_id()") must be implemented
         - raise_missing_exception: If missing, raise an exception, otherwise return None
+        - include_deferred: Also load deferred (lazy=True) fields
         """
         conn = cls.get_connection()
         ids = id or ids
@@ -158,22 +265,534 @@ class Model(six.with_metaclass(ModelMetaclass)):
         if single:
             ids = [ids]
 
+        fields = cls._get_fields_to_load(fields, include_deferred)
+
+        op = instrumentation.start(cls, 'get')
+        try:
+            results = cls._load_results(conn, ids, fields, op)
+
+            instances = cls._get_instances(ids, results, fields, allow_create,
+                                           raise_missing_exception)
+
+            if op:
+                op.mark('decode')
+        finally:
+            # Also record loads that raise (DoesNotExist)
+            if op:
+                op.finish()
+
+        if single:
+            return instances[0]
+        else:
+            return instances
+
+    @classmethod
+    def values(cls, ids, fields, missing=None):
+        """
+        Load some fields for many ids as plain {field_name: value} dicts, without
+        creating Model instances. Missing ids are returned as `missing`
+        """
+        fields = list(fields)
+        rows = cls._get_value_rows(ids, fields, 'values')
+        return [missing if row is None else dict(zip(fields, row)) for row in rows]
+
+    @classmethod
+    def values_list(cls, ids, fields, flat=False, missing=None):
+        """
+        Like values() but returns tuples of values (in `fields` order), or just the
+        values with flat=True (only for a single field). Missing ids are returned as `missing`
+        """
+        fields = list(fields)
+        if flat and len(fields) != 1:
+            raise ValueError('flat=True requires exactly one field')
+
+        rows = cls._get_value_rows(ids, fields, 'values_list')
+        if flat:
+            return [missing if row is None else row[0] for row in rows]
+        return [missing if row is None else row for row in rows]
+
+    @classmethod
+    def _get_value_rows(cls, ids, fields, operation):
+        """
+        HMGET `fields` for each id in one pipeline. Returns a list with a tuple of
+        decoded values per id, or None if the id doesn't exist
+        """
+        op = instrumentation.start(cls, operation)
+
+        decoders = [cls._real_fields[name].from_redis for name in fields]
+        num_fields = len(fields)
+
+        results = cls._hmget_many(ids, fields, op=op)
+
+        rows = []
+        for result in results:
+            if hmget_result_is_nonexistent(result):
+                rows.append(None)
+            else:
+                rows.append(tuple(decode(raw) for decode, raw in zip(decoders, result[:num_fields])))
+
+        if op:
+            op.mark('decode')
+            op.finish()
+
+        return rows
+
+    @classmethod
+    def get_columns(cls, ids, fields, chunk_size=10000):
+        """
+        Load numeric fields (IntegerField, FloatField, BooleanField, DateTimeField) for
+        many ids as NumPy masked arrays: {field_name: array}, one value per id.
+        Missing ids and None values are masked. Datetimes are UTC datetime64[us].
+        Requires numpy.
+
+        - chunk_size: ids per pipeline
+        """
+        from rohm.columns import decode_column, require_numpy
+        require_numpy()
+
+        fields = list(fields)
+        ids = list(ids)
+        op = instrumentation.start(cls, 'get_columns')
+
+        results = []
+        for i in range(0, len(ids), chunk_size):
+            results.extend(cls._hmget_many(ids[i:i + chunk_size], fields, op=op))
+
+        # Missing ids come back as all None, so they're masked like None values
+        raw_columns = zip(*results) if results else [[] for name in fields]
+        columns = {}
+        for name, raw_values in zip(fields, raw_columns):
+            columns[name] = decode_column(cls._real_fields[name], list(raw_values))
+
+        if op:
+            op.mark('decode')
+            op.finish()
+
+        return columns
+
+    @classmethod
+    def _hmget_many(cls, ids, fields, op=None):
+        """
+        HMGET `fields` (plus the id field) of each id, in one pipeline. Returns the raw
+        results; a non-existent id has all None values
+        """
+        conn = cls.get_connection()
+
+        fetch_fields = list(fields)
+        if cls._id_field_name not in fetch_fields:
+            # The id is always stored, so it tells us if the hash exists
+            fetch_fields.append(cls._id_field_name)
+
+        pipe = conn.pipeline()
+        for id in ids:
+            pipe.hmget(cls.generate_redis_key(id), fetch_fields)
+
+        if op:
+            op.mark('encode')
+            op.record_pipeline(pipe)
+
+        results = pipe.execute()
+
+        if op:
+            op.mark('network')
+            op.record_reply(results)
+
+        return results
+
+    @classmethod
+    def get_flags(cls, field_name, ids, chunk_size=10000):
+        """
+        Values of a BooleanField(storage='bitmap') for many ids, read from its bitmap
+        (one BITFIELD command per `chunk_size` ids, in one pipeline) without loading
+        the models. Ids without a stored model read as False
+        """
+        field = cls._get_bitmap_field(field_name)
+        key = field.get_bitmap_key(cls)
+        ids = list(ids)
+        op = instrumentation.start(cls, 'get_flags')
+
+        pipe = cls.get_connection().pipeline(transaction=False)
+        for chunk in chunked(ids, chunk_size):
+            args = []
+            for id in chunk:
+                args.extend(['GET', 'u1', field.get_bit_offset(id)])
+            pipe.execute_command('BITFIELD', key, *args)
+
+        if op:
+            op.mark('encode')
+            op.record_pipeline(pipe)
+
+        results = pipe.execute() if ids else []
+
+        if op:
+            op.mark('network')
+            op.record_reply(results)
+            op.finish()
+
+        return [bool(bit) for bits in results for bit in bits]
+
+    @classmethod
+    def count_flag(cls, field_name):
+        """
+        Number of models with a BooleanField(storage='bitmap') set to True (BITCOUNT)
+        """
+        field = cls._get_bitmap_field(field_name)
+        return cls.get_connection().bitcount(field.get_bitmap_key(cls))
+
+    @classmethod
+    def nearby(cls, lon, lat, radius, unit='m', limit=None, with_distance=False, load=False,
+               field_name=None):
+        """
+        Models whose GeoField is within `radius` (unit: m, km, mi or ft) of (lon, lat),
+        closest first, found with one GEORADIUS.
+
+        - limit: Return at most this many
+        - with_distance: Return (item, distance in `unit`) pairs
+        - load: Return instances (loaded with one multi-get) instead of ids
+        - field_name: The GeoField to search, if the model has more than one
+        """
+        field = cls._get_geo_field(field_name)
+        id_field = cls._get_field(cls._id_field_name)
+        op = instrumentation.start(cls, 'nearby')
+
+        args = [field.get_geo_key(cls), lon, lat, radius, unit]
+        if with_distance:
+            args.append('WITHDIST')
+        if limit:
+            args.extend(['COUNT', limit])
+        args.append('ASC')
+
+        if op:
+            op.mark('encode')
+            op.record_command('GEORADIUS', *args)
+
+        results = cls.get_connection().execute_command('GEORADIUS', *args)
+
+        if op:
+            op.mark('network')
+            op.record_reply(results)
+
+        if with_distance:
+            items = [(id_field.from_redis(member), float(distance)) for member, distance in results]
+        else:
+            items = [(id_field.from_redis(member), None) for member in results]
+
+        if op:
+            op.mark('decode')
+            op.finish()
+
+        if load:
+            instances = cls.get([id for id, distance in items], raise_missing_exception=False) \
+                if items else []
+            # Skip models deleted since the search
+            items = [(instance, distance) for instance, (id, distance) in zip(instances, items)
+                     if instance is not None]
+
+        if with_distance:
+            return items
+        return [item for item, distance in items]
+
+    @classmethod
+    def search_prefix(cls, field_name, prefix, limit=10, load=True):
+        """
+        Models whose CharField(prefix_index=True) starts with `prefix` (case-insensitive),
+        ordered by value, with one ZRANGEBYLEX. Returns instances (loaded with one
+        multi-get), or ids if not `load`
+
+        - limit: Return at most this many (None for all)
+        """
+        field = cls._real_fields.get(field_name)
+        if not getattr(field, 'prefix_index', False):
+            raise ValueError('{}.{} is not a CharField(prefix_index=True)'.format(
+                cls.__name__, field_name))
+
+        id_field = cls._get_field(cls._id_field_name)
+        prefix = field.normalize(prefix)
+        op = instrumentation.start(cls, 'search_prefix')
+
+        args = [field.get_prefix_key(cls), '[' + prefix, '[' + prefix + '\xff']
+        options = {'start': 0, 'num': limit} if limit else {}
+        if op:
+            op.mark('encode')
+            op.record_command('ZRANGEBYLEX', *(args + (['LIMIT', 0, limit] if limit else [])))
+
+        members = cls.get_connection().zrangebylex(*args, **options)
+
+        if op:
+            op.mark('network')
+            op.record_reply(members)
+            op.finish()
+
+        ids = [id_field.from_redis(member.rsplit('\x00', 1)[1]) for member in members]
+        if not load:
+            return ids
+
+        instances = cls.get(ids, raise_missing_exception=False) if ids else []
+        return [instance for instance in instances if instance is not None]
+
+    @classmethod
+    def _get_geo_field(cls, field_name=None):
+        geo_fields = [field for name, field in sorted(cls._real_fields.items())
+                      if isinstance(field, GeoField) and field_name in (None, name)]
+        if not geo_fields:
+            raise ValueError('{} has no GeoField {}'.format(cls.__name__, field_name or ''))
+        if len(geo_fields) > 1:
+            raise ValueError('{} has several GeoFields, pass field_name'.format(cls.__name__))
+        return geo_fields[0]
+
+    @classmethod
+    def _get_bitmap_field(cls, field_name):
+        field = cls._real_fields.get(field_name)
+        if getattr(field, 'storage', None) != 'bitmap':
+            raise ValueError('{}.{} is not a BooleanField(storage=\'bitmap\')'.format(
+                cls.__name__, field_name))
+        return field
+
+    @classmethod
+    def update(cls, id, _require_exists=False, **data):
+        """
+        Write fields of a model without fetching it first. Creates the model if it
+        doesn't exist, unless _require_exists. Returns whether it was written
+        """
+        return bool(cls.update_many({id: data}, require_exists=_require_exists))
+
+    # Old name
+    set = update
+
+    @classmethod
+    def update_many(cls, updates, require_exists=False, chunk_size=500):
+        """
+        Write fields of many models without fetching them: {id: {field_name: value}},
+        pipelined in chunks of `chunk_size`. Values are validated and encoded like save()
+        does, None values are deleted, and ttl is applied.
+
+        - require_exists: Skip models that don't exist (checked and written atomically
+          by a script) instead of creating them
+
+        Updating an indexed field reads its old values first (one more round trip).
+        The version of versioned models is incremented (so concurrent saves of loaded
+        instances conflict). on_save() isn't called. Returns the list of ids written
+        """
+        conn = cls.get_connection()
+        id_field = cls._get_field(cls._id_field_name)
+
+        written = []
+        for chunk in chunked(updates.items(), chunk_size):
+            op = instrumentation.start(cls, 'update')
+            try:
+                chunk = [(id, cls._get_update_data(data)) for id, data in chunk]
+
+                indexed_ids = [id for id, data in chunk
+                               if any(name in data for name in cls._indexed_field_names)]
+                index_values = cls._get_stored_index_values_many(indexed_ids) if indexed_ids else {}
+
+                pipe = conn.pipeline()
+                script_positions = {}
+                for id, data in chunk:
+                    redis_key = cls.generate_redis_key(id)
+                    cleaned_data, none_keys = cls._encode_data(data)
+
+                    if require_exists:
+                        script_positions[id] = len(pipe)
+                        args = [cls.ttl or 0, cls._version_field_name or '', len(cleaned_data)]
+                        for item in cleaned_data.items():
+                            args.extend(item)
+                        update_if_exists(pipe, keys=[redis_key], args=args + none_keys)
+                    else:
+                        cleaned_data[cls._id_field_name] = id_field.to_redis(id)
+                        pipe.hmset(redis_key, cleaned_data)
+                        if none_keys:
+                            pipe.hdel(redis_key, *none_keys)
+                        if cls._version_field_name:
+                            pipe.hincrby(redis_key, cls._version_field_name, 1)
+                        if cls.ttl:
+                            pipe.expire(redis_key, cls.ttl)
+
+                    if id in indexed_ids and (id in index_values or not require_exists):
+                        stored = index_values.get(id, {})
+                        for field_name in cls._indexed_field_names:
+                            if field_name in data and stored.get(field_name) != data[field_name]:
+                                cls._get_field(field_name).save_index(
+                                    pipe, cls, id, stored.get(field_name), data[field_name])
+
+                if op:
+                    op.mark('encode')
+                    op.record_pipeline(pipe)
+
+                results = pipe.execute()
+
+                if op:
+                    op.mark('network')
+                    op.record_reply(results)
+            finally:
+                # Also record updates that raise
+                if op:
+                    op.finish()
+
+            if require_exists:
+                chunk_written = [id for id, data in chunk if results[script_positions[id]]]
+            else:
+                chunk_written = [id for id, data in chunk]
+
+            if cls.missing_cache_ttl:
+                for id in chunk_written:
+                    negative_cache.discard(cls, id)
+
+            cls._invalidate_shared_cache(chunk_written)
+
+            written.extend(chunk_written)
+
+        return written
+
+    @classmethod
+    def _get_update_data(cls, data):
+        """
+        {real field name: value} for update(). Related models are replaced by their id
+        """
+        update_data = {}
+        for name, val in data.items():
+            field = cls._fields.get(name)
+            if field is None or field.is_primary_key or name == cls._version_field_name:
+                raise FieldValidationError('Cannot update field {!r} of {}'.format(name, cls.__name__))
+
+            if isinstance(field, RelatedModelField):
+                update_data[cls._get_related_id_field_name(name)] = None if val is None else val._id
+            else:
+                update_data[name] = val
+        return update_data
+
+    @classmethod
+    def _get_fields_to_load(cls, fields, include_deferred=False):
+        """
+        The list of fields get() should load, or None to load everything
+        """
+        if not fields and cls._deferred_field_names and not include_deferred:
+            fields = cls._eager_field_names
+
         if fields:
+            fields = list(fields)
             if cls._id_field_name not in fields:
                 # Should also fetch the ID field too..
                 fields.append(cls._id_field_name)
+            if cls._version_field_name and cls._version_field_name not in fields:
+                # ...and the version, which save() checks
+                fields.append(cls._version_field_name)
 
-        partial = bool(fields)
+        return fields or None
 
+    @classmethod
+    def _get_instances(cls, ids, results, fields, allow_create, raise_missing_exception):
+        """
+        The instances get() returns, from the _load_results() of `ids`
+        """
+        instances = cls._build_instances(ids, results, fields)
+
+        if None in instances:
+            if allow_create:
+                instances = cls._create_missing_instances(ids, instances)
+
+            if raise_missing_exception and None in instances:
+                raise DoesNotExist
+
+        current_batch = get_current_batch()
+        if current_batch is not None:
+            current_batch.add(*instances)
+
+        return instances
+
+    @classmethod
+    def _load_results(cls, conn, ids, fields, op=None):
+        """
+        The _queue_get() results for `ids`. Full loads go through the shared cache first
+        """
         pipe = conn.pipeline()
+        finish = cls._queue_load(pipe, ids, fields)
+
+        results = []
+        if len(pipe):
+            if op:
+                op.mark('encode')
+                op.record_pipeline(pipe)
+
+            results = pipe.execute()
+
+            if op:
+                op.mark('network')
+                op.record_reply(results)
+
+        return finish(results)
+
+    @classmethod
+    def _queue_load(cls, pipe, ids, fields):
+        """
+        Queue the loads of the `ids` that aren't in the shared cache. Returns a function
+        that takes the pipeline results of those, and returns the results for all `ids`
+        """
+        shared_cache = cls.shared_cache if not fields else None
+        cached, versions, key_expiry = shared_cache.get_many(cls, ids, with_key_expiry=True) \
+            if shared_cache else ({}, None, {})
+        fetch_ids = [id for id in ids if id not in cached] if cached else ids
+
+        if cls.ttl and cls.refresh_window and key_expiry:
+            # Cache hits keep the expiry of their key, so they're refreshed too
+            now = time.time()
+            cached_ids = list(key_expiry)
+            cls._refresh_expiring(cached_ids, [cached[id] for id in cached_ids],
+                                  [int((key_expiry[id] - now) * 1000) for id in cached_ids])
+
+        cls._queue_get(pipe, fetch_ids, fields)
+
+        # The keys' expiry, to refresh the ones about to expire and so cached entries
+        # don't outlive them
+        check_expiry = bool(cls.ttl and (cls.refresh_window or shared_cache) and fetch_ids)
+        if check_expiry:
+            for id in fetch_ids:
+                pipe.pttl(cls.generate_redis_key(id))
+
+        def finish(results):
+            pttls = []
+            if check_expiry:
+                results, pttls = results[:len(fetch_ids)], results[len(fetch_ids):]
+                if cls.refresh_window:
+                    cls._refresh_expiring(fetch_ids, results, pttls)
+
+            if shared_cache and fetch_ids:
+                now = time.time()
+                expires = {id: now + pttl / 1000.0 for id, pttl in zip(fetch_ids, pttls)
+                           if pttl >= 0}
+                shared_cache.set_many(cls, dict(zip(fetch_ids, results)), versions, expires)
+
+            if cached:
+                results_by_id = dict(zip(fetch_ids, results))
+                results_by_id.update(cached)
+                results = [results_by_id[id] for id in ids]
+            return results
+
+        return finish
+
+    @classmethod
+    def _invalidate_shared_cache(cls, ids):
+        if cls.shared_cache:
+            cls.shared_cache.invalidate(cls, ids)
+
+    @classmethod
+    def _queue_get(cls, pipe, ids, fields):
+        """
+        Queue the commands that load `ids` (one per id)
+        """
         for id in ids:
             redis_key = cls.generate_redis_key(id)
-            if partial:
+            if fields:
                 pipe.hmget(redis_key, fields)
             else:
                 pipe.hgetall(redis_key)
 
-        results = pipe.execute()
+    @classmethod
+    def _build_instances(cls, ids, results, fields):
+        """
+        Create instances from the results of _queue_get(), None for missing ids
+        """
+        partial = bool(fields)
 
         instances = []
         for id, result in zip(ids, results):
@@ -185,25 +804,8 @@ class Model(six.with_metaclass(ModelMetaclass)):
                 exists = bool(result)
 
             if not exists:
-                if allow_create:
-                    # If missing, try to create new model
-                    try:
-                        instance = cls.create_from_id(id)
-                    except:
-                        logger.warning('Could not create object from id %s', id)
-                        if raise_missing_exception:
-                            raise DoesNotExist
-                        else:
-                            instances.append(None)
-                            continue
-                    else:
-                        instances.append(instance)
-                        continue
-                elif raise_missing_exception:
-                    raise DoesNotExist
-                else:
-                    instances.append(None)
-                    continue
+                instances.append(None)
+                continue
 
             # Dictionary of {field_name --> raw redis data}
             if partial:
@@ -215,38 +817,195 @@ class Model(six.with_metaclass(ModelMetaclass)):
             data = {}
             for k, v in raw_data.items():
                 if k in cls._fields:
-                    data[k] = cls._convert_field_from_raw(k, v)
+                    data[k] = cls._convert_loaded_field(k, v)
 
             # Create the Model instance
             instance = cls(_new=False, _partial=partial, **data)
             instances.append(instance)
 
-        if single:
-            return instances[0]
+        return instances
+
+    @classmethod
+    def _create_missing_instances(cls, ids, instances):
+        """
+        Fill in the missing (None) instances with create_from_ids(), called once for all
+        of them. Returns the new list of instances (None where creating failed)
+        """
+        missing_ids = []
+        for id, instance in zip(ids, instances):
+            if instance is None and id not in missing_ids:
+                if cls.missing_cache_ttl and negative_cache.contains(cls, id):
+                    continue
+                missing_ids.append(id)
+
+        if not missing_ids:
+            created = {}
+        elif cls.single_flight:
+            created = loading.single_flight.load(cls, missing_ids, cls._rebuild_missing)
         else:
-            return instances
+            created = cls._rebuild_missing(missing_ids)
+
+        return [created.get(id) if instance is None else instance
+                for id, instance in zip(ids, instances)]
 
     @classmethod
-    def set(cls, id=None, **data):
+    def _rebuild_missing(cls, ids):
         """
-        Write to a Model without fetching first
+        Create and save missing ids, under the cross-process rebuild lock if configured.
+        Returns {id: instance}
         """
-        conn = cls.get_connection()
-        redis_key = cls.generate_redis_key(id)
+        if not cls.rebuild_lock_timeout:
+            return cls._create_and_save(ids)
+
+        lock = RebuildLock(cls, ids, cls.rebuild_lock_timeout)
+        acquired = lock.acquire()
+
+        created = {}
+        try:
+            if acquired:
+                created.update(cls._create_and_save(acquired))
+        finally:
+            lock.release()
+
+        # Someone else is rebuilding the rest
+        others = [id for id in ids if id not in acquired]
+        if others:
+            found, still_missing = wait_for_rebuild(cls, others, cls.rebuild_lock_wait)
+            created.update(found)
+            if still_missing:
+                created.update(cls._create_and_save(still_missing))
+
+        return created
+
+    @classmethod
+    def _refresh_expiring(cls, ids, results, pttls):
+        """
+        Schedule the background refresh of the loaded ids that expire within refresh_window
+        """
+        window_ms = cls.refresh_window * 1000
+        expiring = [id for id, result, pttl in zip(ids, results, pttls)
+                    if result and 0 <= pttl <= window_ms]
+        if expiring:
+            loading.background_refresher.schedule(cls, expiring, cls._refresh)
+
+    @classmethod
+    def _refresh(cls, ids):
+        """
+        Rebuild and save again models about to expire (runs in the background)
+        """
+        if not cls.rebuild_lock_timeout:
+            cls._rebuild_and_update(ids)
+            return
+
+        # Another process refreshing an id already has its lock
+        lock = RebuildLock(cls, ids, cls.rebuild_lock_timeout)
+        try:
+            acquired = lock.acquire()
+            if acquired:
+                cls._rebuild_and_update(acquired)
+        finally:
+            lock.release()
+
+    @classmethod
+    def _rebuild_and_update(cls, ids):
+        """
+        create_from_ids(), then save the created instances over the stored ones, in one
+        pipeline. The stored version and index values are read first (one round trip) and
+        the instances saved as updates: the version keeps counting (with compare-and-set,
+        a conflicting write wins over the refresh) and old index entries are removed.
+        Ids that are gone from Redis meanwhile are created
+        """
+        created = cls.create_from_ids(ids)
+        unsaved = [instance for instance in created.values() if instance is not None and instance._new]
+        if not unsaved:
+            return
+
+        field_names = list(cls._indexed_field_names)
+        if cls._version_field_name:
+            field_names.append(cls._version_field_name)
+        stored = cls._hmget_many([instance._id for instance in unsaved], field_names)
+
+        pipe = cls.get_connection().pipeline()
+        for instance, result in zip(unsaved, stored):
+            if hmget_result_is_nonexistent(result):
+                instance.save(pipe=pipe, force_create=True, _stored_index_values={})
+                continue
+
+            # As if loaded with just these fields: the others are all written
+            instance._new = False
+            values = {name: cls._convert_field_from_raw(name, raw)
+                      for name, raw in zip(field_names, result)}
+            if instance.track_modified_fields:
+                instance._orig_data = values
+            if cls._version_field_name:
+                instance._set_version(values[cls._version_field_name])
+            instance.save(pipe=pipe, _stored_index_values=values)
+
+        try:
+            execute_pipeline(pipe)
+        except ConflictError:
+            # Written meanwhile, which is fresher than the rebuild
+            pass
+
+    @classmethod
+    def _create_and_save(cls, ids):
+        """
+        create_from_ids(), then save the created instances in one pipeline
+        """
+        created = cls.create_from_ids(ids)
+
+        if cls.missing_cache_ttl:
+            for id in ids:
+                if id in created and created[id] is None:
+                    negative_cache.add(cls, id, cls.missing_cache_ttl)
+
+        # Write back the created instances that weren't saved yet, in one pipeline (they
+        # may have been created meanwhile, so their stored index values are read first)
+        unsaved = [instance for instance in created.values() if instance is not None and instance._new]
+        if unsaved:
+            index_values = cls._get_stored_index_values_many([instance._id for instance in unsaved])
+            pipe = cls.get_connection().pipeline()
+            for instance in unsaved:
+                instance.save(pipe=pipe, force_create=True,
+                              _stored_index_values=index_values.get(instance._id, {}))
+            execute_pipeline(pipe)
+
+        return created
+
+    @classmethod
+    def _copy_instance(cls, instance):
+        """
+        Copy of an instance loaded for another caller (None stays None)
+        """
+        return copy.deepcopy(instance)
 
-        if conn.exists(redis_key):
-            raise DoesNotExist
+    @classmethod
+    def create_from_ids(cls, ids):
+        """
+        Create instances for ids missing from Redis, from some other source of truth.
+        Called by get(allow_create=True) once with all missing ids.
 
-        with redis_operation(conn, pipelined=cls.ttl is not None) as _conn:
-            _conn.hmset(redis_key, data)
+        Returns {id: instance}. Unsaved (new) instances are saved by get() in one
+        pipeline. Map an id to None if it doesn't exist in the source (it is then kept in
+        the negative cache, see missing_cache_ttl) and leave it out if loading failed.
 
-            if cls.ttl:
-                _conn.expire()
+        The default implementation calls create_from_id() for each id.
+        """
+        instances = {}
+        for id in ids:
+            try:
+                instances[id] = cls.create_from_id(id)
+            except DoesNotExist:
+                instances[id] = None
+            except Exception:
+                logger.warning('Could not create object from id %s', id)
+        return instances
 
     @classmethod
     def create_from_id(cls, id):
         """
-        Subclass should implement for allow_create=True
+        Subclass should implement for allow_create=True (or create_from_ids()).
+        Raise DoesNotExist if the id doesn't exist in the source of truth
         """
         raise NotImplementedError
 
@@ -255,6 +1014,13 @@ class Model(six.with_metaclass(ModelMetaclass)):
         key = '{}:{}'.format(cls._key_prefix, id)
         return key
 
+    @classmethod
+    def generate_sibling_key(cls, id, name):
+        """
+        Key of a structure that belongs to an instance, stored next to its hash
+        """
+        return '{}:{}:{}'.format(cls._key_prefix, id, name)
+
     @classmethod
     def set_connection(cls, connection):
         """
@@ -266,9 +1032,17 @@ class Model(six.with_metaclass(ModelMetaclass)):
     def set_connection_settings(cls, **settings):
         cls.connection = create_connection(**settings)
 
+    @classmethod
+    def use_connection(cls, alias):
+        """
+        Use the named (shared) connection `alias` for this model
+        """
+        cls.connection = None
+        cls.connection_alias = alias
+
     @classmethod
     def get_connection(cls):
-        return cls.connection or get_default_connection()
+        return cls.connection or get_connection(cls.connection_alias)
 
     @classmethod
     def _convert_field_from_raw(cls, field_name, raw_val):
@@ -279,6 +1053,17 @@ class Model(six.with_metaclass(ModelMetaclass)):
         cleaned = field.from_redis(raw_val)
         return cleaned
 
+    @classmethod
+    def _convert_loaded_field(cls, field_name, raw_val):
+        """
+        Like _convert_field_from_raw(), but a missing value (None) gets the field's default,
+        like a full load does (HMGET returns None where HGETALL has no key)
+        """
+        field = cls._get_field(field_name)
+        if raw_val is None and field.default:
+            return field.get_default_value()
+        return field.from_redis(raw_val)
+
     @classmethod
     def _get_field(cls, name):
         return cls._fields[name]
@@ -311,89 +1096,495 @@ class Model(six.with_metaclass(ModelMetaclass)):
 
         return self.generate_redis_key(id)
 
-    def save(self, modified_only=False, force_create=False, pipe=None):
+    def save(self, modified_only=False, force_create=False, pipe=None, _stored_index_values=None):
         """
         Save model to Redis. Will create new one if it doesn't exist
 
         - force_create: Save if we created a new instance but already exists in Redis
         - modified_only: Only save modified fields
+
+        With modified_only, a JSONField with a small change is updated in place in Redis
+        (only the changed paths are sent, see rohm.jsonpath), unless in a shared pipeline.
+
+        Existing instances of a model with a VersionField are saved with compare-and-set
+        (raises ConflictError if it was changed since loading), and their index and
+        collection updates only happen if the save does. In a shared pipeline the new
+        version is assumed; execute the pipeline with rohm.execute_pipeline() to get a
+        ConflictError and the loaded version back if the save fails (a plain execute()
+        raises a "CONFLICT" ResponseError)
         """
         conn = self.get_connection()
+        op = instrumentation.start(type(self), 'save')
+        try:
+            modified_only = modified_only or self.save_modified_only
 
-        modified_only = modified_only or self.save_modified_only
+            redis_key = self.get_redis_key()
 
-        redis_key = self.get_redis_key()
+            version_field_name = self._version_field_name
+            versioned = version_field_name is not None and not self._new
+            if version_field_name and self._new:
+                setattr(self, version_field_name, 1)
+
+            modified_data = None
+
+            if modified_only and not self._new:
+                modified_data = self._get_modified_fields()
+                cleaned_data, none_keys = self.get_cleaned_data(data=modified_data)
+            else:
+                cleaned_data, none_keys = self.get_cleaned_data()
+
+            if versioned:
+                # The version is checked and incremented by the script
+                cleaned_data.pop(version_field_name, None)
+                none_keys = [name for name in none_keys if name != version_field_name]
 
-        modified_data = None
+            old_index_values = self._get_old_index_values(force_create, _stored_index_values)
 
-        if modified_only and not self._new:
-            modified_data = self._get_modified_fields()
-            cleaned_data, none_keys = self.get_cleaned_data(data=modified_data)
+            if pipe is not None:
+                is_shared_pipeline = True
+            else:
+                pipe = conn.pipeline()
+                is_shared_pipeline = False
+
+            json_patches = {}
+            if modified_data and not versioned and not is_shared_pipeline:
+                json_patches = self._get_json_patches(modified_data, cleaned_data)
+
+            if cleaned_data or none_keys or json_patches or self._pending_collections:
+                try:
+                    if self._new and not force_create and not is_shared_pipeline:
+                        # For a new model, use WATCH to detect if someone else wrote to
+                        # this key in the meantime. This also puts us in normal execution mode
+                        # Don't do this for a multi-object pipelined save
+                        pipe.watch(redis_key)
+
+                        exists = pipe.exists(redis_key)
+                        if op:
+                            op.record_command('WATCH', redis_key)
+                            op.record_command('EXISTS', redis_key)
+
+                        if exists:
+                            pipe.reset()
+                            raise AlreadyExists
+
+                        # Return to buffered MULTI mode
+                        pipe.multi()
+
+                    if versioned:
+                        version_position = len(pipe)
+                        self._queue_versioned_save(pipe, cleaned_data, none_keys, old_index_values)
+                    else:
+                        patch_positions = {}
+                        for field_name, (ops_json, raw) in json_patches.items():
+                            patch_positions[field_name] = len(pipe)
+                            json_patch(pipe, keys=[redis_key], args=[field_name, ops_json])
+
+                        if cleaned_data:
+                            pipe.hmset(redis_key, cleaned_data)
+
+                        if none_keys:
+                            # Delete None values
+                            pipe.hdel(redis_key, *none_keys)
+
+                        if self.ttl:
+                            pipe.expire(redis_key, self.ttl)
+
+                    if not versioned:
+                        self._save_indexes(pipe, old_index_values)
+                        self._save_collections(pipe)
+
+                    # Custom save hook
+                    self.on_save(conn, modified_data=modified_data)
+
+                    if op:
+                        op.mark('encode')
+
+                    if not is_shared_pipeline:
+                        if op:
+                            op.record_pipeline(pipe)
+
+                        results = pipe.execute(raise_on_error=not versioned)
+
+                        if op:
+                            op.mark('network')
+                            op.record_reply(results)
+
+                        if json_patches:
+                            self._rewrite_failed_json_patches(
+                                conn, json_patches,
+                                {field_name: results[position]
+                                 for field_name, position in patch_positions.items()})
+
+                        if versioned:
+                            self._check_versioned_save(results, version_position)
+                    elif versioned:
+                        # Assume the shared pipeline succeeds, execute_pipeline() undoes it if not
+                        loaded_version = self._get_loaded_version()
+                        setattr(self, version_field_name, loaded_version + 1)
+
+                        def finish_versioned_save(results, position=version_position,
+                                                  loaded_version=loaded_version):
+                            result = None if results is None else results[position]
+                            if result is None or isinstance(result, Exception):
+                                self._set_version(loaded_version)
+                                if result is not None and str(result).startswith('CONFLICT'):
+                                    return self._conflict_error(result)
+
+                        _after_execute(pipe, finish_versioned_save)
+
+                    self._invalidate_shared_cache([self._id])
+                    if is_shared_pipeline and self.shared_cache:
+                        # That was before the write, a concurrent load may cache the old data
+                        # meanwhile: invalidate again once execute_pipeline() ran it
+                        _after_execute(
+                            pipe, lambda results: self._invalidate_shared_cache([self._id]))
+                except redis.WatchError:
+                    pipe.reset()
+                    raise AlreadyExists
+                except:
+                    # We only need to do pipe.reset() for exceptions, so putting it in except
+                    # rather than in a finally block. (For a shared transaction save() we want to
+                    # NOT call .reset() or the .command_stack will be cleared)
+                    pipe.reset()
+                    raise
+
+                self._pending_collections = {}
+                if self.track_modified_fields:
+                    self._reset_orig_data()
+            else:
+                pass
+
+            self._new = False
+        finally:
+            # Also record saves that raise (AlreadyExists, ConflictError)
+            if op:
+                op.finish()
+
+    def _get_json_patches(self, modified_data, cleaned_data):
+        """
+        For modified JSONFields whose change is smaller as path operations than as a
+        whole document: {field_name: (operations JSON, whole document)}. Those fields
+        are removed from cleaned_data
+        """
+        patches = {}
+        for field_name, val in modified_data.items():
+            field = self._get_field(field_name)
+            if not isinstance(field, JSONField) or field_name not in cleaned_data:
+                continue
+
+            ops = jsonpath.get_ops(self._orig_data.get(field_name), val)
+            if not ops:
+                continue
+
+            ops_json = json.dumps(ops, cls=field.encoder)
+            raw = cleaned_data[field_name]
+            if len(ops_json) < len(raw):
+                patches[field_name] = (ops_json, cleaned_data.pop(field_name))
+
+        return patches
+
+    def _rewrite_failed_json_patches(self, conn, json_patches, replies):
+        """
+        Write the whole document of the fields the json_patch script couldn't patch, unless
+        they were written since (a later write wins, like it would over a full save)
+        """
+        pipe = conn.pipeline(transaction=False)
+        for field_name, reply in replies.items():
+            if reply != 1:
+                hset_if_unchanged(pipe, keys=[self.get_redis_key()],
+                                  args=[field_name, reply, json_patches[field_name][1]])
+        if len(pipe):
+            pipe.execute()
+
+    def json_set(self, field_name, path, value):
+        """
+        Set one value inside a JSONField document, both here and in place in Redis (one
+        round trip, only the path and value are sent):
+
+            menu.json_set('data', ['items', 3, 'price'], 999)
+
+        Setting the index right after the end of a list appends to it
+        """
+        self._apply_json_ops(field_name, [('set', list(path), value)])
+
+    def json_delete(self, field_name, path):
+        """
+        Delete a dict key or list item inside a JSONField document (see json_set)
+        """
+        self._apply_json_ops(field_name, [('del', list(path))])
+
+    def _apply_json_ops(self, field_name, ops):
+        field = self._get_field(field_name)
+        if not isinstance(field, JSONField):
+            raise ValueError('{}.{} is not a JSONField'.format(type(self).__name__, field_name))
+
+        doc = getattr(self, field_name)
+        if doc is None:
+            raise ValueError('{}.{} is None'.format(type(self).__name__, field_name))
+
+        jsonpath.apply_ops(doc, ops)
+        if self._new:
+            return
+
+        # The stored document gets the same change, and anything else modified
+        # locally stays modified
+        if self.track_modified_fields and field_name in self._orig_data:
+            try:
+                stored = jsonpath.apply_ops(self._orig_data[field_name], ops)
+            except (KeyError, IndexError, TypeError):
+                stored = self._orig_data[field_name] = copy.deepcopy(doc)
         else:
-            cleaned_data, none_keys = self.get_cleaned_data()
+            stored = doc
 
-        if pipe is not None:
-            is_shared_pipeline = True
+        conn = self.get_connection()
+        redis_key = self.get_redis_key()
+        if not jsonpath.is_safe(stored):
+            conn.hset(redis_key, field_name, field.to_redis(stored))
         else:
-            pipe = conn.pipeline()
-            is_shared_pipeline = False
+            reply = json_patch(conn, keys=[redis_key],
+                               args=[field_name, json.dumps(ops, cls=field.encoder)])
+            if reply != 1:
+                self._rewrite_failed_json_patches(
+                    conn, {field_name: (None, field.to_redis(stored))}, {field_name: reply})
+        self._invalidate_shared_cache([self._id])
+
+    def _get_loaded_version(self):
+        name = self._version_field_name
+        version = self._orig_data.get(name) if name in self._orig_data else self._data.get(name)
+        return version or 0
+
+    def _queue_versioned_save(self, pipe, cleaned_data, none_keys, old_index_values):
+        args = [self._version_field_name, self._get_loaded_version(), self.ttl or 0,
+                len(cleaned_data)]
+        for item in cleaned_data.items():
+            args.extend(item)
+        args.append(len(none_keys))
+        args.extend(none_keys)
+
+        # The index and collection updates run in the script, after the version check
+        commands = RecordingPipeline(RecordingConnection())
+        self._save_indexes(commands, old_index_values)
+        self._save_collections(commands)
+
+        keys = [self.get_redis_key()]
+        for command, options in commands.command_stack:
+            args.append(len(command))
+            args.extend(command)
+            key = command_key(command[0].upper(), list(command[1:]))
+            if key is not None and key not in keys:
+                keys.append(key)
+
+        save_if_version(pipe, keys=keys, args=args)
+
+    def _check_versioned_save(self, results, position):
+        for i, result in enumerate(results):
+            if not isinstance(result, Exception):
+                continue
+            if i == position and str(result).startswith('CONFLICT'):
+                raise self._conflict_error(result)
+            raise result
+
+        self._set_version(int(results[position]))
+
+    def _conflict_error(self, result):
+        return ConflictError('{} {}: {}'.format(type(self).__name__, self._id, result))
+
+    def _set_version(self, version):
+        setattr(self, self._version_field_name, version)
+        if self.track_modified_fields:
+            self._orig_data[self._version_field_name] = version
 
-        if cleaned_data or none_keys:
-            try:
-                if self._new and not force_create and not is_shared_pipeline:
-                    # For a new model, use WATCH to detect if someone else wrote to
-                    # this key in the meantime. This also puts us in normal execution mode
-                    # Don't do this for a multi-object pipelined save
-                    pipe.watch(redis_key)
-
-                    exists = pipe.exists(redis_key)
-                    if exists:
-                        pipe.reset()
-                        raise AlreadyExists
-
-                    # Return to buffered MULTI mode
-                    pipe.multi()
-
-                if cleaned_data:
-                    pipe.hmset(redis_key, cleaned_data)
-
-                if none_keys:
-                    # Delete None values
-                    pipe.hdel(redis_key, *none_keys)
-
-                if self.ttl:
-                    pipe.expire(redis_key, self.ttl)
-
-                # Custom save hook
-                self.on_save(conn, modified_data=modified_data)
-
-                if not is_shared_pipeline:
-                    pipe.execute()
-            except redis.WatchError:
-                pipe.reset()
-                raise AlreadyExists
-            except:
-                # We only need to do pipe.reset() for exceptions, so putting it in except
-                # rather than in a finally block. (For a shared transaction save() we want to
-                # NOT call .reset() or the .command_stack will be cleared)
-                pipe.reset()
-                raise
-
-            if self.track_modified_fields:
-                self._reset_orig_data()
+    @classmethod
+    def update_with_retry(cls, id_or_instance, mutate, max_retries=3):
+        """
+        Apply mutate(instance) and save(). On a ConflictError (needs a VersionField),
+        re-fetch and apply it again, up to max_retries times. If given an instance, the
+        first attempt uses it as is (no fetch). Returns the saved instance
+        """
+        if isinstance(id_or_instance, Model):
+            instance = id_or_instance
         else:
-            pass
+            instance = cls.get(id_or_instance)
 
-        self._new = False
+        for attempt in range(max_retries + 1):
+            mutate(instance)
+            try:
+                instance.save()
+                return instance
+            except ConflictError:
+                if attempt == max_retries:
+                    raise
+                instance = cls.get(instance._id)
 
     def delete(self):
         conn = self.get_connection()
+        op = instrumentation.start(type(self), 'delete')
+        try:
+            redis_key = self.get_redis_key()
 
-        redis_key = self.get_redis_key()
+            pipe = conn.pipeline()
+            pipe.delete(redis_key)
+
+            if self._sibling_key_names:
+                pipe.delete(*[self.generate_sibling_key(self._id, name)
+                              for name in self._sibling_key_names])
+
+            for field_name, val in self._get_stored_index_values().items():
+                self._get_field(field_name).delete_index(pipe, type(self), self._id, val)
+
+            self.on_delete(conn=pipe)
+
+            if op:
+                op.mark('encode')
+                op.record_pipeline(pipe)
+
+            results = pipe.execute()
+            self._invalidate_shared_cache([self._id])
+
+            if op:
+                op.mark('network')
+                op.record_reply(results)
+        finally:
+            # Also record deletes that raise
+            if op:
+                op.finish()
+
+    @classmethod
+    def delete_many(cls, ids_or_instances, chunk_size=500):
+        """
+        Delete many models, in chunks of `chunk_size` per pipeline. Uses UNLINK (frees
+        memory in the background) when the server supports it. Index entries are
+        removed and on_delete_many() is called in the same pipeline.
+        Returns the number of models that existed.
+        """
+        conn = cls.get_connection()
+        delete_command = 'UNLINK' if supports_unlink(conn) else 'DEL'
+
+        # Without a batched hook, the per-instance on_delete() hooks need instances
+        needs_instances = (_overrides(cls, 'on_delete', Model) and
+                           not _overrides(cls, 'on_delete_many', Model))
+
+        deleted = 0
+        for chunk in chunked(ids_or_instances, chunk_size):
+            op = instrumentation.start(cls, 'delete_many')
+            try:
+                if all(isinstance(item, Model) for item in chunk):
+                    instances = chunk
+                    ids = [instance._id for instance in chunk]
+                else:
+                    instances = None
+                    ids = [item._id if isinstance(item, Model) else item for item in chunk]
+
+                if instances is None and needs_instances:
+                    instances = [instance for instance in
+                                 cls.get(ids, raise_missing_exception=False) if instance]
+
+                index_values = cls._get_stored_index_values_many(ids, instances)
 
-        with redis_operation(conn, pipelined=True) as _conn:
-            _conn.delete(redis_key)
-            self.on_delete(conn=_conn)
+                pipe = conn.pipeline()
+                pipe.execute_command(delete_command, *[cls.generate_redis_key(id) for id in ids])
+
+                if cls._sibling_key_names:
+                    pipe.execute_command(delete_command, *[
+                        cls.generate_sibling_key(id, name)
+                        for id in ids for name in cls._sibling_key_names])
+
+                for id in ids:
+                    for field_name, val in index_values.get(id, {}).items():
+                        cls._get_field(field_name).delete_index(pipe, cls, id, val)
+
+                cls.on_delete_many(pipe, ids, instances=instances)
+
+                if op:
+                    op.mark('encode')
+                    op.record_pipeline(pipe)
+
+                results = pipe.execute()
+                deleted += results[0]
+                cls._invalidate_shared_cache(ids)
+
+                if op:
+                    op.mark('network')
+                    op.record_reply(results)
+            finally:
+                # Also record deletes that raise
+                if op:
+                    op.finish()
+
+        return deleted
+
+    @classmethod
+    def delete_by_scan(cls, match=None, count=1000, chunk_size=500):
+        """
+        Delete every model whose key matches `match` (default: all of this model's keys,
+        "<prefix>:*"), found with SCAN. Keys that don't look like "<prefix>:<id>" are skipped.
+        Returns the number of models deleted.
+        """
+        deleted = 0
+        for ids in chunked(cls._scan_ids(match, count), chunk_size):
+            deleted += cls.delete_many(ids, chunk_size=chunk_size)
+        return deleted
+
+    @classmethod
+    def _scan_ids(cls, match=None, count=1000):
+        """
+        Yield the ids of the model keys matching `match` (see delete_by_scan())
+        """
+        conn = cls.get_connection()
+        prefix = '{}:'.format(cls._key_prefix)
+        id_field = cls._get_field(cls._id_field_name)
+
+        for key in conn.scan_iter(match=match or prefix + '*', count=count):
+            raw_id = key[len(prefix):] if key.startswith(prefix) else None
+            if not raw_id or ':' in raw_id:
+                continue
+            try:
+                yield id_field.from_redis(raw_id)
+            except ValueError:
+                continue
+
+    @classmethod
+    def preload(cls, ids=None, match=None, fields=None, allow_create=False, chunk_size=500,
+                concurrency=4, count=1000, progress=None):
+        """
+        Warm up at process start: load `ids`, or every model whose key matches `match`
+        (found with SCAN, see delete_by_scan()), with get() in chunks of `chunk_size`,
+        `concurrency` pipelines at a time on a thread pool. This fills the model's
+        shared_cache, and the instances are added to the current rohm.batch() if any.
+
+        - allow_create: Create missing ids, see get()
+        - progress: Called with (ids processed, models loaded) after each chunk
+
+        Only `concurrency` chunks are in flight at a time (SCAN included). Returns the
+        number of models loaded
+        """
+        if ids is None:
+            ids = cls._scan_ids(match, count)
+
+        def load(chunk):
+            return cls.get(chunk, fields=fields, allow_create=allow_create,
+                           raise_missing_exception=False)
+
+        # The batch is per thread, so add the instances from here
+        current_batch = get_current_batch()
+
+        processed = loaded = 0
+        pool = ThreadPool(concurrency)
+        try:
+            for chunks in chunked(chunked(ids, chunk_size), concurrency):
+                for chunk, instances in zip(chunks, pool.map(load, chunks)):
+                    instances = [instance for instance in instances if instance is not None]
+                    if current_batch is not None:
+                        current_batch.add(*instances)
+
+                    processed += len(chunk)
+                    loaded += len(instances)
+                    if progress:
+                        progress(processed, loaded)
+        finally:
+            pool.terminate()
+
+        return loaded
 
     def on_save(self, conn, modified_data=None):
         """ User-specified save code """
@@ -403,6 +1594,113 @@ class Model(six.with_metaclass(ModelMetaclass)):
         """ User-specified delete code """
         pass
 
+    @classmethod
+    def on_delete_many(cls, conn, ids, instances=None):
+        """
+        Batched delete hook, called by delete_many() once per chunk with the shared
+        pipeline. `instances` is None if only ids were given (and on_delete isn't overridden).
+        By default calls on_delete() of each instance
+        """
+        for instance in instances or []:
+            instance.on_delete(conn=conn)
+
+    def _get_old_index_values(self, force_create=False, stored=None):
+        """
+        {field_name: value stored in Redis} of the indexed fields save() writes (the ones
+        that are set). None for a new instance, unless force_create (it may exist).
+        `stored` ({field_name: value}, from a batched read) saves reading them
+        """
+        field_names = [name for name in self._indexed_field_names if name in self._data]
+        if self._new and not force_create:
+            return {name: None for name in field_names}
+        if stored is not None:
+            return {name: stored.get(name) for name in field_names}
+        return self._get_stored_index_values(field_names)
+
+    def _save_indexes(self, pipe, old_values):
+        """
+        Update index entries of indexed fields that changed, from their `old_values`
+        (see _get_old_index_values())
+        """
+        for field_name, old_val in old_values.items():
+            new_val = self._data[field_name]
+            if old_val == new_val:
+                continue
+
+            self._get_field(field_name).save_index(pipe, type(self), self._id, old_val, new_val)
+
+    def _save_collections(self, pipe):
+        """
+        Replace assigned collection fields, and keep the ttl on collection keys
+        """
+        for field_name, field in self._collection_fields.items():
+            key = self.generate_sibling_key(self._id, field_name)
+            if field_name in self._pending_collections:
+                field.queue_replace(pipe, key, self._pending_collections[field_name])
+            if self.ttl:
+                pipe.expire(key, self.ttl)
+
+    def _get_known_index_values(self, field_names):
+        """
+        ({field_name: stored value} known without asking Redis, [the other field names]).
+        A stored value is known if it was loaded and tracked (in _orig_data)
+        """
+        values = {}
+        unknown = []
+        for field_name in field_names:
+            if not self._new and self.track_modified_fields and field_name in self._orig_data:
+                values[field_name] = self._orig_data[field_name]
+            else:
+                unknown.append(field_name)
+        return values, unknown
+
+    def _get_stored_index_values(self, field_names=None):
+        """
+        {field_name: value} of indexed fields, as they are stored in Redis (i.e. the
+        original value if the instance has been modified since loading). Values that
+        weren't loaded, or aren't tracked, are read from Redis (one round trip)
+        """
+        if field_names is None:
+            field_names = self._indexed_field_names
+
+        values, unknown = self._get_known_index_values(field_names)
+        if unknown:
+            result = self._hmget_many([self._id], unknown)[0]
+            values.update((name, self._convert_field_from_raw(name, raw))
+                          for name, raw in zip(unknown, result))
+        return values
+
+    @classmethod
+    def _get_stored_index_values_many(cls, ids, instances=None):
+        """
+        {id: {field_name: stored value}} of indexed fields. Read from `instances` if
+        given, otherwise fetched from Redis in one pipeline
+        """
+        if not cls._indexed_field_names:
+            return {}
+
+        if instances is not None:
+            values = {}
+            fetch_ids = []
+            for instance in instances:
+                values[instance._id], unknown = instance._get_known_index_values(
+                    cls._indexed_field_names)
+                if unknown:
+                    fetch_ids.append(instance._id)
+
+            for id, stored in cls._get_stored_index_values_many(fetch_ids).items():
+                stored.update(values[id])
+                values[id] = stored
+            return values
+
+        values = {}
+        field_names = cls._indexed_field_names
+        for id, result in zip(ids, cls._hmget_many(ids, field_names)):
+            if not hmget_result_is_nonexistent(result):
+                values[id] = {name: cls._convert_field_from_raw(name, raw)
+                              for name, raw in zip(field_names, result)}
+        return values
+
     def get_cleaned_data(self, data=None, separate_none=True):
         """
         Clean data to prepare to send to Redis.
@@ -411,16 +1709,23 @@ class Model(six.with_metaclass(ModelMetaclass)):
         - separate_none: move any None values into a separate list, and return
           (non_none_data, none_keys)
         """
-        cleaned_data = {}
-        none_keys = []
-
         if data is None:
             data = self._data
         else:
             data = data or {}
 
+        return self._encode_data(data, separate_none=separate_none)
+
+    @classmethod
+    def _encode_data(cls, data, separate_none=True):
+        """
+        Validate and encode {field_name: value} (see get_cleaned_data)
+        """
+        cleaned_data = {}
+        none_keys = []
+
         for name, val in data.items():
-            field = self._get_field(name)
+            field = cls._get_field(name)
             field.validate(val)
             cleaned_val = field.to_redis(val)
 
@@ -443,26 +1748,121 @@ class Model(six.with_metaclass(ModelMetaclass)):
     # ---------------
     def _get_field_from_redis(self, field_name):
         conn = self.get_connection()
+        op = instrumentation.start(type(self), 'load_field')
 
         redis_key = self.get_redis_key()
+        if op:
+            op.mark('encode')
+            op.record_command('HGET', redis_key, field_name)
+
         raw = conn.hget(redis_key, field_name)
-        cleaned = self._convert_field_from_raw(field_name, raw)
+
+        if op:
+            op.mark('network')
+            op.record_reply(raw)
+
+        cleaned = self._convert_loaded_field(field_name, raw)
+
+        if op:
+            op.mark('decode')
+            op.finish()
+
         return cleaned
 
     def _load_field_from_redis(self, field_name):
+        peers = self._get_batch_peers(
+            lambda instance: field_name not in instance._loaded_field_names)
+
+        field_names = [field_name]
+        if field_name in self._deferred_field_names:
+            # Load all the (still unloaded) deferred fields together
+            field_names = [name for name in self._deferred_field_names
+                           if name not in self._loaded_field_names]
+
+        if len(peers) > 1 or len(field_names) > 1:
+            self._load_fields_for_instances(peers, field_names)
+            return self._data.get(field_name)
+
         val = self._get_field_from_redis(field_name)
-        setattr(self, field_name, val)
+        self._set_loaded_field(field_name, val)
         return val
 
+    @classmethod
+    def _load_fields_for_instances(cls, instances, field_names):
+        """
+        Load `field_names` for several instances in one pipeline
+        """
+        conn = cls.get_connection()
+        op = instrumentation.start(cls, 'load_field')
+
+        pipe = conn.pipeline()
+        for instance in instances:
+            pipe.hmget(instance.get_redis_key(), field_names)
+
+        if op:
+            op.mark('encode')
+            op.record_pipeline(pipe)
+
+        results = pipe.execute()
+
+        if op:
+            op.mark('network')
+            op.record_reply(results)
+
+        for instance, result in zip(instances, results):
+            for field_name, raw in zip(field_names, result):
+                instance._set_loaded_field(field_name, cls._convert_loaded_field(field_name, raw))
+
+        if op:
+            op.mark('decode')
+            op.finish()
+
+    def _set_loaded_field(self, field_name, val):
+        """
+        Set a lazily loaded value, as loaded (not modified)
+        """
+        setattr(self, field_name, val)
+        if self.track_modified_fields:
+            self._orig_data[field_name] = copy.deepcopy(val)
+
+    def _get_batch_peers(self, needs_load):
+        """
+        Instances of this model in the current batch() for which needs_load(instance)
+        is true, always including self (first). Just [self] outside of a batch
+        """
+        current_batch = get_current_batch()
+        if current_batch is None:
+            return [self]
+
+        peers = [self]
+        for instance in current_batch.peers(self):
+            if instance is not self and not instance._new and needs_load(instance):
+                peers.append(instance)
+        return peers
+
     def _load_related_field(self, field_name):
+        peers = self._get_batch_peers(
+            lambda instance: field_name not in instance._loaded_related_field_data)
+
+        if len(peers) > 1:
+            self._load_related_field_for_instances(peers, field_name)
+            return self._loaded_related_field_data[field_name]
+
         related_field = self._get_field(field_name)
         id_field_name = self._get_related_id_field_name(field_name)
         id = getattr(self, id_field_name)
 
         # NOW GET RELATED MODEL
         if id:
+            # Commands and bytes are reported by the related model's own 'get'
+            op = instrumentation.start(type(self), 'load_related')
+
             model_cls = related_field.model_cls
             instance = self._get_related_model_by_id(model_cls, id)
+
+            if op:
+                op.mark('network')
+                op.finish()
         else:
             # Handle case of no id
             instance = None
@@ -470,13 +1870,50 @@ class Model(six.with_metaclass(ModelMetaclass)):
         self._loaded_related_field_data[field_name] = instance
         return instance
 
+    def _load_related_field_for_instances(self, instances, field_name):
+        """
+        Load a related field for several instances with a single multi-get. Instances
+        related to the same id share the loaded instance
+        """
+        model_cls = self._get_field(field_name).model_cls
+        id_field_name = self._get_related_id_field_name(field_name)
+
+        # Reading the id fields may itself be a (batched) lazy load
+        related_ids = [getattr(instance, id_field_name) for instance in instances]
+        unique_ids = list(set(id for id in related_ids if id))
+
+        op = instrumentation.start(type(self), 'load_related')
+
+        related_by_id = {}
+        if unique_ids:
+            related = self._get_related_models_by_ids(model_cls, unique_ids)
+            related_by_id = dict(zip(unique_ids, related))
+
+        if op:
+            op.mark('network')
+            op.finish()
+
+        for instance, id in zip(instances, related_ids):
+            instance._loaded_related_field_data[field_name] = related_by_id.get(id) if id else None
+
     def _get_related_model_by_id(self, model_cls, id):
         """
         Can override this to customize related model fetching (e.g. LiteModel)
         """
         return model_cls.get(id, allow_create=True, raise_missing_exception=False)
 
-    def _get_related_id_field_name(self, field_name):
+    def _get_related_models_by_ids(self, model_cls, ids):
+        """
+        Multi-id version of _get_related_model_by_id(), used inside batch().
+        Returns a list of instances (or None) in the same order as ids. If only
+        _get_related_model_by_id() is overridden, it is called for each id
+        """
+        if _overrides(type(self), '_get_related_model_by_id', Model):
+            return [self._get_related_model_by_id(model_cls, id) for id in ids]
+        return model_cls.get(list(ids), allow_create=True, raise_missing_exception=False)
+
+    @classmethod
+    def _get_related_id_field_name(cls, field_name):
         return '{}_id'.format(field_name)
 
     def _reset_orig_data(self):
@@ -509,3 +1946,151 @@ class Model(six.with_metaclass(ModelMetaclass)):
 
     def __str__(self):
         return str(self._id)
+
+
+def _overrides(cls, method_name, base):
+    """
+    Does `cls` override `base`'s method?
+    """
+    method = getattr(cls, method_name)
+    base_method = getattr(base, method_name)
+    return getattr(method, '__func__', method) is not getattr(base_method, '__func__', base_method)
+
+
+def _after_execute(pipe, callback):
+    """
+    Have execute_pipeline(pipe) call callback(pipeline results, or None if it raised).
+    The callback can return an exception for execute_pipeline() to raise
+    """
+    _get_after_execute(pipe).append(callback)
+
+
+def _get_after_execute(pipe):
+    """
+    The callbacks registered for the commands queued in `pipe`. They are tied to its
+    command stack, which execute() and reset() replace, so callbacks of commands run
+    or discarded without execute_pipeline() are dropped
+    """
+    stack, callbacks = getattr(pipe, '_rohm_after_execute', (None, None))
+    if stack is not pipe.command_stack:
+        callbacks = []
+        pipe._rohm_after_execute = (pipe.command_stack, callbacks)
+    return callbacks
+
+
+def execute_pipeline(pipe, raise_on_error=True):
+    """
+    Execute a pipeline that models were saved in (save(pipe=pipe)), and finish those
+    saves once their outcome is known: a versioned instance whose save failed gets its
+    loaded version back, a ConflictError is raised for a conflict, and the saved
+    instances' shared cache entries are invalidated again (after the write)
+    """
+    callbacks = _get_after_execute(pipe)
+    pipe._rohm_after_execute = (None, None)
+
+    try:
+        results = pipe.execute(raise_on_error=False)
+    except Exception:
+        for callback in callbacks:
+            callback(None)
+        raise
+
+    errors = [callback(results) for callback in callbacks]
+    if raise_on_error:
+        errors.extend(result for result in results if isinstance(result, Exception))
+    errors = [error for error in errors if error is not None]
+    if errors:
+        raise errors[0]
+
+    return results
+
+
+GET_MANY_OPTIONS = ('fields', 'include_deferred', 'allow_create', 'raise_missing_exception')
+
+
+def get_many(requests):
+    """
+    Get models of several classes at once, in one round trip (one pipeline per
+    connection):
+
+        orders, store, customer = rohm.get_many([
+            (Order, [1, 2]),
+            (Store, 7, {'fields': ['name']}),
+            (Customer, 3),
+        ])
+
+    Each request is (model class, id or ids) or (model class, id or ids, get() options:
+    fields, include_deferred, allow_create, raise_missing_exception). Returns what get()
+    would return for each request, in order.
+
+    Each request is instrumented as a 'get' operation with its part of the pipeline
+    (the network time of the pipelines is counted for each)
+    """
+    requests = list(requests)
+    for request in requests:
+        options = request[2] if len(request) > 2 else {}
+        unknown = set(options) - set(GET_MANY_OPTIONS)
+        if unknown:
+            raise TypeError('Unknown get_many() options for {}: {}'.format(
+                request[0].__name__, ', '.join(sorted(unknown))))
+
+    pipes = {}      # {connection: pipeline}
+    pending = []
+    ops = []
+    try:
+        for request in requests:
+            model_cls, ids = request[:2]
+            options = request[2] if len(request) > 2 else {}
+
+            single = not isinstance(ids, (list, tuple))
+            ids = [ids] if single else list(ids)
+            fields = model_cls._get_fields_to_load(options.get('fields'),
+                                                   options.get('include_deferred', False))
+
+            # Like get(), nothing to load isn't an operation
+            op = instrumentation.start(model_cls, 'get') if ids else None
+            if op:
+                ops.append(op)
+
+            conn = model_cls.get_connection()
+            if conn not in pipes:
+                pipes[conn] = conn.pipeline()
+            pipe = pipes[conn]
+
+            start = len(pipe)
+            finish = model_cls._queue_load(pipe, ids, fields)
+            if op:
+                op.mark('encode')
+                op.record_pipeline(pipe, start, len(pipe))
+            pending.append((model_cls, ids, fields, single, options, op, pipe, start, len(pipe),
+                            finish))
+
+        for op in ops:
+            op.resume()
+        replies = {pipe: pipe.execute() for pipe in pipes.values() if len(pipe)}
+        for op in ops:
+            op.mark('network')
+
+        results = []
+        for model_cls, ids, fields, single, options, op, pipe, start, end, finish in pending:
+            reply = replies[pipe][start:end] if end > start else []
+            if op:
+                op.resume()
+                op.record_reply(reply)
+
+            load_results = finish(reply)
+
+            raise_missing_exception = options.get('raise_missing_exception')
+            instances = model_cls._get_instances(
+                ids, load_results, fields, options.get('allow_create', False),
+                single if raise_missing_exception is None else raise_missing_exception)
+
+            if op:
+                op.mark('decode')
+
+            results.append(instances[0] if single else instances)
+    finally:
+        for op in ops:
+            op.finish()
+
+    return results
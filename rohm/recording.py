@@ -0,0 +1,258 @@
+"""
+Dry-run recording of the Redis commands issued by model code.
+
+RecordingConnection implements the client/pipeline API that Model uses, but
+instead of talking to Redis it records every command (name, key, args, size on
+the wire) and answers with fake replies. explain() swaps it in for every
+model for the duration of a block:
+
+    from rohm.recording import explain
+
+    with explain(replies={'HGETALL': {'id': '1', 'name': 'foo'}}) as recorder:
+        foo = Foo.get(1)
+        foo.name = 'bar'
+        foo.save()
+
+    print(recorder.describe())
+"""
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+
+import six
+
+from rohm.connection import override_connection
+from rohm.instrumentation import command_size
+
+
+RecordedCommand = namedtuple('RecordedCommand', ['name', 'key', 'args', 'size', 'round_trip'])
+
+# Commands with no key argument
+keyless_commands = {'PING', 'INFO', 'MULTI', 'EXEC', 'DISCARD', 'UNWATCH', 'FLUSHDB', 'SCAN'}
+
+
+def default_reply(name, args):
+    """
+    Replies for a Redis that is empty
+    """
+    if name == 'HGETALL':
+        return {}
+    elif name == 'HMGET':
+        return [None] * (len(args) - 1)
+    elif name in ('HGET', 'GET'):
+        return None
+    elif name in ('EXISTS', 'HEXISTS', 'SISMEMBER'):
+        return False
+    elif name in ('SMEMBERS',):
+        return set()
+    elif name in ('LRANGE', 'ZRANGE', 'ZRANGEBYLEX', 'ZRANGEBYSCORE', 'KEYS', 'GEORADIUS'):
+        return []
+    elif name == 'SCAN':
+        return (0, [])
+    elif name == 'PTTL':
+        return -2
+    elif name == 'BITFIELD':
+        return [0] * (len(args) // 3)
+    elif name in ('DELETE', 'DEL', 'UNLINK', 'HDEL', 'SCARD', 'ZCARD', 'LLEN', 'TTL', 'GETBIT',
+                  'BITCOUNT'):
+        return 0
+    else:
+        return True
+
+
+def flatten_args(args, kwargs=None):
+    """
+    Turn redis-py style arguments (mappings, lists, option kwargs) into flat
+    command arguments
+    """
+    flat = []
+    for arg in args:
+        if isinstance(arg, dict):
+            for k, v in arg.items():
+                flat.extend([k, v])
+        elif isinstance(arg, (list, tuple, set)):
+            flat.extend(arg)
+        else:
+            flat.append(arg)
+
+    for option, val in sorted((kwargs or {}).items()):
+        if val is True:
+            flat.append(option.upper())
+        elif val is not None and val is not False:
+            flat.extend([option.upper(), val])
+
+    return flat
+
+
+def command_key(name, args):
+    if name in keyless_commands or not args:
+        return None
+    if name in ('EVAL', 'EVALSHA'):
+        # EVAL script numkeys key [key...] arg [arg...]
+        return args[2] if len(args) > 2 and int(args[1]) > 0 else None
+    return args[0]
+
+
+class RecordingConnection(object):
+    """
+    Fake client that records commands instead of sending them.
+
+    - replies: {COMMAND NAME: reply}. A reply can be a callable, it gets called with the
+      flattened command args (not including the command name)
+    """
+    def __init__(self, replies=None):
+        self.replies = {name.upper(): reply for name, reply in (replies or {}).items()}
+        self.reset()
+
+    def reset(self):
+        self.commands = []
+        self.round_trips = 0
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return RecordingPipeline(self, transaction=transaction)
+
+    def execute_command(self, *args, **options):
+        self.round_trips += 1
+        return self._record(args)
+
+    def _command_method(self, name):
+        def method(*args, **kwargs):
+            return self.execute_command(name, *flatten_args(args, kwargs))
+        return method
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self._command_method(name)
+
+    def delete(self, *names):
+        return self.execute_command('DEL', *names)
+
+    def _record(self, args):
+        name = args[0].upper()
+        cmd_args = list(args[1:])
+
+        self.commands.append(RecordedCommand(
+            name=name,
+            key=command_key(name, cmd_args),
+            args=cmd_args,
+            size=command_size(args),
+            round_trip=self.round_trips,
+        ))
+        return self._reply(name, cmd_args)
+
+    def _reply(self, name, args):
+        if name in self.replies:
+            reply = self.replies[name]
+            if callable(reply):
+                return reply(*args)
+            return reply
+        return default_reply(name, args)
+
+    # ---------
+    # Reporting
+    # ---------
+    @property
+    def bytes_sent(self):
+        return sum(command.size for command in self.commands)
+
+    @property
+    def keys(self):
+        return {command.key for command in self.commands if command.key is not None}
+
+    def summary(self):
+        return {
+            'round_trips': self.round_trips,
+            'commands': Counter(command.name for command in self.commands),
+            'total_commands': len(self.commands),
+            'bytes_sent': self.bytes_sent,
+            'keys': sorted(self.keys),
+        }
+
+    def describe(self):
+        lines = ['{} round trips, {} commands, {} bytes'.format(
+            self.round_trips, len(self.commands), self.bytes_sent)]
+
+        for command in self.commands:
+            args = ' '.join(_truncate(arg) for arg in command.args)
+            lines.append('  [{}] {} {} ({} bytes)'.format(
+                command.round_trip, command.name, args, command.size))
+        return '\n'.join(lines)
+
+
+def _truncate(arg, length=40):
+    if not isinstance(arg, six.string_types):
+        arg = str(arg)
+    return arg if len(arg) <= length else arg[:length] + '...'
+
+
+class RecordingPipeline(object):
+    """
+    Pipeline counterpart of RecordingConnection. Follows redis-py semantics: after
+    watch() commands run immediately until multi() is called
+    """
+    def __init__(self, connection, transaction=True):
+        self.connection = connection
+        self.transaction = transaction
+        self.reset()
+
+    def reset(self):
+        self.command_stack = []
+        self.watching = False
+        self.explicit_transaction = False
+
+    def watch(self, *names):
+        self.watching = True
+        return self.connection.execute_command('WATCH', *names)
+
+    def multi(self):
+        self.explicit_transaction = True
+
+    def execute_command(self, *args, **options):
+        if self.watching and not self.explicit_transaction:
+            return self.connection.execute_command(*args, **options)
+
+        self.command_stack.append((args, options))
+        return self
+
+    def execute(self, raise_on_error=True):
+        stack = self.command_stack
+        if not stack:
+            self.reset()
+            return []
+
+        self.connection.round_trips += 1
+        results = [self.connection._record(args) for args, options in stack]
+        self.reset()
+        return results
+
+    def _command_method(self, name):
+        def method(*args, **kwargs):
+            return self.execute_command(name, *flatten_args(args, kwargs))
+        return method
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self._command_method(name)
+
+    def delete(self, *names):
+        return self.execute_command('DEL', *names)
+
+    def __len__(self):
+        return len(self.command_stack)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reset()
+
+
+@contextmanager
+def explain(replies=None):
+    """
+    Run a block against a RecordingConnection (for every model, in this thread) and
+    yield it for inspection. Nothing is sent to Redis.
+    """
+    with override_connection(RecordingConnection(replies=replies)) as recorder:
+        yield recorder
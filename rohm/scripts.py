@@ -0,0 +1,194 @@
+"""
+Lua scripts run server-side by rohm.
+
+Scripts are sent with EVAL rather than EVALSHA: they're small, it's always one
+round trip, and it avoids NOSCRIPT errors in the middle of a MULTI pipeline
+(e.g. after a failover or SCRIPT FLUSH). Redis caches the compiled script either way.
+"""
+
+
+class Script(object):
+    def __init__(self, name, lua):
+        self.name = name
+        self.lua = lua
+
+    def __call__(self, conn, keys=(), args=()):
+        """
+        Run on a client, or queue on a pipeline
+        """
+        keys = list(keys)
+        return conn.eval(self.lua, len(keys), *(keys + list(args)))
+
+    def __repr__(self):
+        return '<Script {}>'.format(self.name)
+
+
+# Delete a lock only if we still own it
+release_lock = Script('release_lock', """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+
+# Update a model hash only if it exists.
+# ARGV: ttl (0 for none), field to increment ('' for none), number of fields to set,
+#       field, value, ..., fields to delete...
+update_if_exists = Script('update_if_exists', """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+if ARGV[2] ~= '' then
+    redis.call('HINCRBY', KEYS[1], ARGV[2], 1)
+end
+local num_set = tonumber(ARGV[3])
+local last_set = 3 + num_set * 2
+if num_set > 0 then
+    redis.call('HMSET', KEYS[1], unpack(ARGV, 4, last_set))
+end
+if #ARGV > last_set then
+    redis.call('HDEL', KEYS[1], unpack(ARGV, last_set + 1))
+end
+local ttl = tonumber(ARGV[1])
+if ttl > 0 then
+    redis.call('EXPIRE', KEYS[1], ttl)
+end
+return 1
+""")
+
+
+# Compare-and-set save of a versioned model: write only if the stored version is the
+# expected one, and increment it. Then run the given commands (index and collection
+# updates), so they happen if and only if the save does. Returns the new version, or a
+# CONFLICT error.
+# KEYS: the hash, then the keys of the commands
+# ARGV: version field, expected version, ttl (0 for none), number of fields to set,
+#       field, value, ..., number of fields to delete, field, ...,
+#       then commands: number of words, command, arg, ...
+save_if_version = Script('save_if_version', """
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+if not current then
+    if redis.call('EXISTS', KEYS[1]) == 0 then
+        return redis.error_reply('CONFLICT deleted')
+    end
+    current = '0'
+end
+if current ~= ARGV[2] then
+    return redis.error_reply('CONFLICT stored version ' .. current)
+end
+local version = tonumber(current) + 1
+redis.call('HSET', KEYS[1], ARGV[1], version)
+local num_set = tonumber(ARGV[4])
+local last_set = 4 + num_set * 2
+if num_set > 0 then
+    redis.call('HMSET', KEYS[1], unpack(ARGV, 5, last_set))
+end
+local num_delete = tonumber(ARGV[last_set + 1])
+local last_delete = last_set + 1 + num_delete
+if num_delete > 0 then
+    redis.call('HDEL', KEYS[1], unpack(ARGV, last_set + 2, last_delete))
+end
+local ttl = tonumber(ARGV[3])
+if ttl > 0 then
+    redis.call('EXPIRE', KEYS[1], ttl)
+end
+local i = last_delete + 1
+while i <= #ARGV do
+    local num_words = tonumber(ARGV[i])
+    redis.call(unpack(ARGV, i + 1, i + num_words))
+    i = i + num_words + 1
+end
+return version
+""")
+
+
+# Apply path operations to a JSON document stored in a hash field. Returns 1, or if
+# they don't apply or cjson can't re-encode the result faithfully, the SHA1 of the
+# stored value ('' if none), for the caller to write the whole document with
+# hset_if_unchanged.
+# ARGV: hash field, JSON list of ["set", path, value] / ["del", path]
+json_patch = Script('json_patch', """
+local raw = redis.call('HGET', KEYS[1], ARGV[1])
+if not raw then
+    return redis.sha1hex('')
+end
+local doc = cjson.decode(raw)
+
+local function safe(value)
+    if type(value) == 'number' then
+        return value == math.floor(value) and math.abs(value) < 1e14
+    elseif type(value) == 'table' then
+        if next(value) == nil then
+            return false
+        end
+        for _, v in pairs(value) do
+            if not safe(v) then
+                return false
+            end
+        end
+    end
+    return true
+end
+
+local function is_array(node)
+    return next(node) == nil or node[1] ~= nil
+end
+
+for _, op in ipairs(cjson.decode(ARGV[2])) do
+    local path = op[2]
+    local node = doc
+    for i = 1, #path do
+        if type(node) ~= 'table' then
+            return redis.sha1hex(raw)
+        end
+        local step = path[i]
+        if type(step) == 'number' then
+            if not is_array(node) then
+                return redis.sha1hex(raw)
+            end
+            step = step + 1
+        elseif is_array(node) and next(node) ~= nil then
+            return redis.sha1hex(raw)
+        end
+
+        if i < #path then
+            node = node[step]
+        elseif op[1] == 'set' then
+            if type(step) == 'number' and step > #node + 1 then
+                return redis.sha1hex(raw)
+            end
+            node[step] = op[3]
+        elseif type(step) == 'number' then
+            if step > #node then
+                return redis.sha1hex(raw)
+            end
+            table.remove(node, step)
+        else
+            node[step] = nil
+        end
+    end
+end
+
+if not safe(doc) then
+    return redis.sha1hex(raw)
+end
+redis.call('HSET', KEYS[1], ARGV[1], cjson.encode(doc))
+return 1
+""")
+
+
+# Write a hash field only if its value is still the one json_patch saw (by SHA1, of ''
+# if none) and the hash exists. Returns 1 if written.
+# ARGV: hash field, SHA1, value
+hset_if_unchanged = Script('hset_if_unchanged', """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+if redis.sha1hex(current or '') ~= ARGV[2] then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[3])
+return 1
+""")
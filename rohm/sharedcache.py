@@ -0,0 +1,214 @@
+"""
+Host-level cache of model hashes in shared memory, for prefork servers whose
+workers all load the same hot (reference) models.
+
+The cache is a memory-mapped file (put it on a tmpfs such as /dev/shm) split
+into fixed-size slots. Each model key maps to one slot (by hash), which holds
+the key and the raw hash as loaded from Redis. Every process that opens the
+same path shares the slots, so one Redis read serves all the workers on the host:
+
+    from rohm.sharedcache import SharedMemoryCache
+
+    class Store(Model):
+        shared_cache = SharedMemoryCache('/dev/shm/myapp-rohm', ttl=60)
+
+Model.get() (full loads only) reads the cache first and stores what it loads on a
+miss. save(), update() and delete() on this host invalidate the entries they
+touch; writes from other hosts are only seen once entries expire (`ttl`). Saves in
+a shared pipeline invalidate again after the write if the pipeline is executed with
+rohm.execute_pipeline(). Entries of models with a Redis `ttl` expire with their key,
+which is also kept in the slot so hits can be refreshed before it (refresh_window).
+
+Slots are seqlocks: a writer (holding a per-slot file lock) makes the slot's
+sequence number odd while writing and even again after, and readers, which
+never lock, retry as a miss if the sequence moved while they read. The sequence
+also versions the slot: an entry loaded from Redis is only stored if the slot
+wasn't written or invalidated since the lookup, so a slow reader can't put back
+a value that was invalidated meanwhile.
+"""
+from collections import Counter
+import marshal
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+MAGIC = b'ROHMSHM2'
+FILE_HEADER = struct.Struct('<8sII')          # magic, num_slots, slot_size
+# sequence, key length, payload length, expiry, expiry of the Redis key
+SLOT_HEADER = struct.Struct('<IHIdd')
+SEQUENCE = struct.Struct('<I')
+
+
+class SharedMemoryCache(object):
+    """
+    - path: File to map (created if needed), shared by every process using the cache
+    - num_slots, slot_size: Geometry, must be the same for every process using `path`.
+      Entries bigger than a slot aren't cached
+    - ttl: Seconds an entry is served for (bounds staleness from other hosts' writes)
+    """
+    def __init__(self, path, num_slots=4096, slot_size=4096, ttl=60):
+        try:
+            import fcntl
+        except ImportError:   # pragma: no cover
+            raise ImportError('SharedMemoryCache needs fcntl (POSIX)')
+        self._fcntl = fcntl
+
+        self.path = path
+        self.num_slots = num_slots
+        self.slot_size = slot_size
+        self.ttl = ttl
+        self.stats = Counter()      # hits, misses, stores, invalidations (this process)
+
+        self._write_lock = threading.Lock()    # file locks don't exclude threads
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = FILE_HEADER.size + num_slots * slot_size
+
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+            self._mm = mmap.mmap(self._fd, size)
+
+            magic, stored_slots, stored_size = FILE_HEADER.unpack_from(self._mm, 0)
+            if magic != MAGIC:
+                # New, or written by another version: start empty
+                self._mm[FILE_HEADER.size:size] = b'\0' * (size - FILE_HEADER.size)
+                FILE_HEADER.pack_into(self._mm, 0, MAGIC, num_slots, slot_size)
+            elif (stored_slots, stored_size) != (num_slots, slot_size):
+                raise ValueError('{} has {} slots of {} bytes'.format(path, stored_slots, stored_size))
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def close(self):
+        self._mm.close()
+        os.close(self._fd)
+
+    # -------
+    # Lookups
+    # -------
+    def get_many(self, model_cls, ids, with_key_expiry=False):
+        """
+        Returns ({id: raw hash} of hits, {id: slot version} of misses). Pass the versions
+        to set_many() with what was loaded. with_key_expiry adds a third item,
+        {id: timestamp} of the hits whose Redis key expires (see set_many())
+        """
+        hits = {}
+        versions = {}
+        key_expiry = {}
+        now = time.time()
+        for id in ids:
+            key = model_cls.generate_redis_key(id)
+            raw, version, key_expires = self._read(key, now)
+            if raw is None:
+                versions[id] = version
+            else:
+                hits[id] = raw
+                if key_expires != float('inf'):
+                    key_expiry[id] = key_expires
+
+        self.stats['hits'] += len(hits)
+        self.stats['misses'] += len(versions)
+        if with_key_expiry:
+            return hits, versions, key_expiry
+        return hits, versions
+
+    def _slot_offset(self, key):
+        return FILE_HEADER.size + (zlib.crc32(key) & 0xffffffff) % self.num_slots * self.slot_size
+
+    def _read(self, key, now):
+        """ (raw hash or None, slot version, Redis key expiry) """
+        offset = self._slot_offset(key)
+        mm = self._mm
+
+        sequence, key_len, payload_len, expires, key_expires = SLOT_HEADER.unpack_from(mm, offset)
+        if sequence & 1 or not key_len or expires < now:
+            return None, sequence, None
+
+        start = offset + SLOT_HEADER.size
+        stored_key = mm[start:start + key_len]
+        payload = mm[start + key_len:start + key_len + payload_len]
+
+        if SEQUENCE.unpack_from(mm, offset)[0] != sequence or stored_key != key:
+            # Written meanwhile, or another key's slot
+            return None, sequence, None
+
+        return marshal.loads(payload), sequence, key_expires
+
+    # ------
+    # Writes
+    # ------
+    def set_many(self, model_cls, raw_by_id, versions=None, expires_by_id=None):
+        """
+        Store raw hashes {id: raw hash}. With `versions` (from get_many()), an id is only
+        stored if its slot hasn't changed since. `expires_by_id` ({id: timestamp}) is the
+        expiry of the Redis keys: entries don't outlive their key, and get_many() returns it
+        """
+        default_expires = time.time() + self.ttl if self.ttl else float('inf')
+        for id, raw in raw_by_id.items():
+            if not raw:
+                continue
+
+            key_expires = float('inf')
+            if expires_by_id and id in expires_by_id:
+                key_expires = expires_by_id[id]
+            expires = min(default_expires, key_expires)
+
+            key = model_cls.generate_redis_key(id)
+            payload = marshal.dumps(raw)
+            if SLOT_HEADER.size + len(key) + len(payload) > self.slot_size:
+                self.stats['too_big'] += 1
+                continue
+
+            version = versions.get(id) if versions is not None else None
+            if self._write(key, payload, (expires, key_expires), version):
+                self.stats['stores'] += 1
+
+    def invalidate(self, model_cls, ids):
+        for id in ids:
+            self._write(model_cls.generate_redis_key(id), None, (0, 0), None)
+            self.stats['invalidations'] += 1
+
+    def clear(self):
+        for i in range(self.num_slots):
+            self._write_slot(FILE_HEADER.size + i * self.slot_size, None, None, (0, 0), None)
+
+    def _write(self, key, payload, expires, version):
+        """ `expires`: (entry expiry, Redis key expiry) """
+        offset = self._slot_offset(key)
+        if payload is None:
+            # Only invalidate the slot if it holds this key
+            return self._write_slot(offset, key, None, expires, version, only_key=key)
+        return self._write_slot(offset, key, payload, expires, version)
+
+    def _write_slot(self, offset, key, payload, expires, version, only_key=None):
+        fcntl = self._fcntl
+        mm = self._mm
+        with self._write_lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self.slot_size, offset)
+            try:
+                sequence, key_len = SLOT_HEADER.unpack_from(mm, offset)[:2]
+                if version is not None and sequence != version:
+                    return False
+
+                start = offset + SLOT_HEADER.size
+                if only_key is not None and mm[start:start + key_len] != only_key:
+                    # Keep the other key's entry, but still fail pending stores of this one
+                    SEQUENCE.pack_into(mm, offset, (sequence + 2) & 0xffffffff)
+                    return False
+
+                # Odd while writing
+                SEQUENCE.pack_into(mm, offset, (sequence + 1) & 0xffffffff)
+                if payload is None:
+                    SLOT_HEADER.pack_into(mm, offset, (sequence + 1) & 0xffffffff, 0, 0, 0, 0)
+                else:
+                    mm[start:start + len(key)] = key
+                    mm[start + len(key):start + len(key) + len(payload)] = payload
+                    SLOT_HEADER.pack_into(mm, offset, (sequence + 1) & 0xffffffff,
+                                          len(key), len(payload), *expires)
+                SEQUENCE.pack_into(mm, offset, (sequence + 2) & 0xffffffff)
+                return True
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self.slot_size, offset)
@@ -0,0 +1,169 @@
+"""
+Test helpers for asserting how much Redis I/O a block of code does, to catch
+N+1 regressions (e.g. lazy field or related model access inside a loop)
+
+    from rohm.testing import assert_max_round_trips
+
+    with assert_max_round_trips(2):
+        orders = Order.get(order_ids)
+        stores = [order.store for order in orders]
+
+Or with the pytest fixture (add `from rohm.testing import round_trips` to conftest.py):
+
+    def test_view(round_trips):
+        render_view()
+        assert round_trips.round_trips <= 2
+        assert round_trips.commands['HGETALL'] == 50
+
+Counting works by wrapping redis-py's client and pipeline classes, so it sees every
+command issued in the process (all threads, all clients) while active.
+"""
+from collections import Counter
+from contextlib import contextmanager
+import threading
+
+from redis.client import StrictRedis, BasePipeline
+
+_active_counters = []
+_patch_lock = threading.Lock()
+_originals = {}
+
+
+class RoundTripCounter(object):
+    """
+    - round_trips: Number of network round trips (a pipeline execute is one)
+    - commands: Counter of {command name: times issued}
+    - pipelines: Number of pipelines executed
+    - log: List of round trips, each a list of the command names sent
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.round_trips = 0
+        self.pipelines = 0
+        self.commands = Counter()
+        self.log = []
+
+    @property
+    def total_commands(self):
+        return sum(self.commands.values())
+
+    def _record_command(self, name):
+        self.commands[name] += 1
+
+    def _record_round_trip(self, names, pipeline=False):
+        self.round_trips += 1
+        if pipeline:
+            self.pipelines += 1
+        self.log.append(list(names))
+
+    def describe(self):
+        lines = ['{} round trips, {} commands'.format(self.round_trips, self.total_commands)]
+        for i, names in enumerate(self.log, 1):
+            lines.append('  {}: {}'.format(i, ' '.join(names)))
+        return '\n'.join(lines)
+
+    def assert_max_round_trips(self, max_round_trips):
+        assert self.round_trips <= max_round_trips, \
+            'Expected at most {} round trips, got {}'.format(max_round_trips, self.describe())
+
+    def assert_max_commands(self, max_commands, command=None):
+        count = self.commands[command.upper()] if command else self.total_commands
+        assert count <= max_commands, \
+            'Expected at most {} {} commands, got {}'.format(
+                max_commands, command or 'total', self.describe())
+
+
+def _command_name(args):
+    return str(args[0]).upper()
+
+
+def _client_execute_command(self, *args, **options):
+    name = _command_name(args)
+    for counter in _active_counters:
+        counter._record_command(name)
+        counter._record_round_trip([name])
+    return _originals['execute_command'](self, *args, **options)
+
+
+def _immediate_execute_command(self, *args, **options):
+    # WATCH and the commands after it (before MULTI) run immediately
+    name = _command_name(args)
+    for counter in _active_counters:
+        counter._record_command(name)
+        counter._record_round_trip([name])
+    return _originals['immediate_execute_command'](self, *args, **options)
+
+
+def _pipeline_execute(self, *args, **kwargs):
+    if self.command_stack:
+        names = [_command_name(cmd_args) for cmd_args, options in self.command_stack]
+        for counter in _active_counters:
+            for name in names:
+                counter._record_command(name)
+            counter._record_round_trip(names, pipeline=True)
+    return _originals['execute'](self, *args, **kwargs)
+
+
+def _patch():
+    _originals['execute_command'] = StrictRedis.__dict__['execute_command']
+    _originals['immediate_execute_command'] = BasePipeline.__dict__['immediate_execute_command']
+    _originals['execute'] = BasePipeline.__dict__['execute']
+
+    StrictRedis.execute_command = _client_execute_command
+    BasePipeline.immediate_execute_command = _immediate_execute_command
+    BasePipeline.execute = _pipeline_execute
+
+
+def _unpatch():
+    StrictRedis.execute_command = _originals.pop('execute_command')
+    BasePipeline.immediate_execute_command = _originals.pop('immediate_execute_command')
+    BasePipeline.execute = _originals.pop('execute')
+
+
+@contextmanager
+def count_round_trips():
+    """
+    Context manager yielding a RoundTripCounter that counts all Redis I/O inside the block
+    """
+    counter = RoundTripCounter()
+
+    with _patch_lock:
+        if not _active_counters:
+            _patch()
+        _active_counters.append(counter)
+
+    try:
+        yield counter
+    finally:
+        with _patch_lock:
+            _active_counters.remove(counter)
+            if not _active_counters:
+                _unpatch()
+
+
+@contextmanager
+def assert_max_round_trips(max_round_trips, max_commands=None):
+    """
+    Fail if the block does more than `max_round_trips` round trips (or more than
+    `max_commands` commands)
+    """
+    with count_round_trips() as counter:
+        yield counter
+
+    counter.assert_max_round_trips(max_round_trips)
+    if max_commands is not None:
+        counter.assert_max_commands(max_commands)
+
+
+try:
+    import pytest
+except ImportError:   # pragma: no cover
+    pass
+else:
+    @pytest.yield_fixture
+    def round_trips():
+        """ pytest fixture: a RoundTripCounter active for the whole test """
+        with count_round_trips() as counter:
+            yield counter
@@ -2,6 +2,7 @@ from contextlib import contextmanager
 from datetime import datetime
 
 from pytz import utc
+from redis.exceptions import ResponseError
 
 
 def utcnow():
@@ -46,6 +47,40 @@ def safe_string(value, encoding='utf-8'):
     return value
 
 
+def chunked(iterable, size):
+    """
+    Yield lists of (at most) `size` items
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+_unlink_support = {}
+
+
+def supports_unlink(conn):
+    """
+    Does the server support UNLINK (Redis >= 4.0)? Checked once per connection pool
+    """
+    cache_key = id(getattr(conn, 'connection_pool', conn))
+    if cache_key not in _unlink_support:
+        try:
+            conn.execute_command('UNLINK', '__rohm_unlink_check__')
+        except ResponseError:
+            _unlink_support[cache_key] = False
+        else:
+            _unlink_support[cache_key] = True
+
+    return _unlink_support[cache_key]
+
+
 def hmget_result_is_nonexistent(result):
     """
     HMGET returns an array of [None, None...] for a non-existent key.
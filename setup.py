@@ -32,6 +32,9 @@ setup(
         'redis>=2.10.3',
         'six>=1.9.0',
     ],
+    extras_require={
+        'numpy': ['numpy'],
+    },
     long_description=read('README.md'),
     classifiers=[
         "Development Status :: 3 - Alpha",
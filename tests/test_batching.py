@@ -0,0 +1,102 @@
+import pytest
+
+import rohm
+from rohm.batching import get_current_batch
+from rohm.models import Model
+from rohm import fields
+from rohm.testing import count_round_trips
+
+
+@pytest.fixture
+def Order():
+    class Order(Model):
+        name = fields.CharField()
+        num = fields.IntegerField()
+        store = fields.RelatedModelField('Store')
+
+    class Store(Model):
+        name = fields.CharField()
+        owner = fields.RelatedModelField('Owner')
+
+    class Owner(Model):
+        name = fields.CharField()
+
+    for i in range(1, 3):
+        Owner(id=i, name='owner{}'.format(i)).save()
+    for i in range(1, 4):
+        Store(id=i, name='store{}'.format(i), owner_id=(i % 2) + 1).save()
+    for i in range(1, 11):
+        Order(id=i, name='order{}'.format(i), num=i, store_id=(i % 3) + 1).save()
+    # Order with no store
+    Order(id=11, name='order11', num=11).save()
+
+    return Order
+
+
+def test_batch_related(Order):
+    with count_round_trips() as counter:
+        with rohm.batch():
+            orders = Order.get(list(range(1, 12)))
+            store_names = [order.store.name if order.store else None for order in orders]
+            owner_names = [order.store.owner.name for order in orders if order.store]
+
+    assert counter.round_trips == 3
+    assert store_names == ['store{}'.format((i % 3) + 1) for i in range(1, 11)] + [None]
+    assert owner_names[0] == 'owner1'
+
+    # Same stores are shared
+    assert orders[0].store is orders[3].store
+
+
+def test_batch_custom_related_fetch(Order, monkeypatch):
+    fetched = []
+
+    def get_related_model_by_id(self, model_cls, id):
+        fetched.append(id)
+        return model_cls.get(id)
+    monkeypatch.setattr(Order, '_get_related_model_by_id', get_related_model_by_id)
+
+    with rohm.batch():
+        orders = Order.get([1, 2, 3, 4])
+        assert orders[0].store.name == 'store2'
+        assert [order.store.id for order in orders] == [2, 3, 1, 2]
+
+    # Batched loads still go through the override, once per id
+    assert sorted(fetched) == [1, 2, 3]
+
+
+def test_batch_partial_fields(Order):
+    with count_round_trips() as counter:
+        with rohm.batch():
+            orders = Order.get(list(range(1, 11)), fields=['name'])
+            nums = [order.num for order in orders]
+            stores = [order.store for order in orders]
+
+    assert nums == list(range(1, 11))
+    assert stores[0].id == 2
+
+    # get, then num for all, then store_id for all, then stores
+    assert counter.round_trips == 4
+    assert counter.commands['HMGET'] == 30
+    assert orders[0]._loaded_field_names == {'id', 'name', 'num', 'store_id'}
+
+
+def test_no_batch(Order):
+    with count_round_trips() as counter:
+        orders = Order.get(list(range(1, 11)))
+        [order.store for order in orders]
+
+    assert counter.round_trips == 11
+
+
+def test_batch_explicit_instances(Order):
+    orders = Order.get(list(range(1, 11)))
+
+    with count_round_trips() as counter:
+        with rohm.batch(orders) as current:
+            assert get_current_batch() is current
+            assert len(current) == 10
+            [order.store for order in orders]
+
+    assert counter.round_trips == 1
+    assert get_current_batch() is None
@@ -0,0 +1,55 @@
+import datetime
+
+import pytest
+from pytz import utc
+
+from rohm.models import Model
+from rohm import fields
+
+np = pytest.importorskip('numpy')
+
+
+@pytest.fixture
+def Store():
+    class Store(Model):
+        name = fields.CharField()
+        num_orders = fields.IntegerField()
+        rating = fields.FloatField()
+        is_open = fields.BooleanField()
+        opened_at = fields.DateTimeField()
+
+    Store(id=1, name='a', num_orders=10, rating=4.5, is_open=True,
+          opened_at=utc.localize(datetime.datetime(2015, 1, 2, 3, 4, 5, 6))).save()
+    Store(id=2, name='b', num_orders=20, is_open=False).save()
+    return Store
+
+
+def test_get_columns(Store):
+    columns = Store.get_columns([1, 2, 3], ['num_orders', 'rating', 'is_open', 'opened_at'])
+
+    num_orders = columns['num_orders']
+    assert num_orders.dtype == np.int64
+    assert num_orders.tolist() == [10, 20, None]
+
+    rating = columns['rating']
+    assert rating.dtype == np.float64
+    assert rating.tolist() == [4.5, None, None]
+
+    assert columns['is_open'].tolist() == [True, False, None]
+
+    opened_at = columns['opened_at']
+    assert opened_at.dtype == np.dtype('datetime64[us]')
+    assert opened_at[0] == np.datetime64('2015-01-02T03:04:05.000006')
+    assert list(opened_at.mask) == [False, True, True]
+
+
+def test_get_columns_chunked(Store):
+    columns = Store.get_columns([3, 2, 1], ['num_orders'], chunk_size=2)
+    assert columns['num_orders'].tolist() == [None, 20, 10]
+
+    assert Store.get_columns([], ['num_orders'])['num_orders'].tolist() == []
+
+
+def test_get_columns_unsupported(Store):
+    with pytest.raises(TypeError):
+        Store.get_columns([1], ['name'])
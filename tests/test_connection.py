@@ -0,0 +1,92 @@
+import os
+
+import pytest
+from redis.exceptions import ConnectionError
+
+from rohm import connection as rohm_connection
+from rohm.connection import (
+    RohmConnectionPool, register_connection, get_connection, get_pool_stats,
+)
+from rohm.exceptions import ConnectionNotConfigured
+from rohm.models import Model
+from rohm import fields
+
+pytestmark = pytest.mark.skipif(os.environ.get('ROHM_TEST_BACKEND') == 'memory',
+                                reason='Connection pools need a redis-server')
+
+
+@pytest.yield_fixture
+def cache_alias():
+    register_connection('cache', max_connections=2, pool_timeout=0.05)
+    yield 'cache'
+    rohm_connection.connections.pop('cache', None)
+
+
+def test_unknown_alias():
+    with pytest.raises(ConnectionNotConfigured):
+        get_connection('nope')
+
+
+def test_models_share_alias(cache_alias):
+    class Foo(Model):
+        connection_alias = cache_alias
+        name = fields.CharField()
+
+    class Bar(Model):
+        name = fields.CharField()
+
+    Bar.use_connection(cache_alias)
+
+    assert Foo.get_connection() is Bar.get_connection()
+    assert Foo.get_connection() is not get_connection()
+
+    Foo(id=1, name='foo').save()
+    assert Foo.get(1).name == 'foo'
+
+
+def test_pool_stats(cache_alias):
+    conn = get_connection(cache_alias)
+    conn.ping()
+
+    stats = get_pool_stats(cache_alias)
+    assert stats['max_connections'] == 2
+    assert stats['created'] == 1
+    assert stats['in_use'] == 0
+    assert stats['idle'] == 1
+    assert stats['checkouts'] == 1
+
+    assert cache_alias in get_pool_stats()
+
+
+def test_pool_is_bounded(cache_alias):
+    pool = get_connection(cache_alias).connection_pool
+    c1 = pool.get_connection('ping')
+    c2 = pool.get_connection('ping')
+
+    assert pool.get_stats()['in_use'] == 2
+
+    with pytest.raises(ConnectionError):
+        pool.get_connection('ping')
+
+    assert pool.get_stats()['timeouts'] == 1
+
+    pool.release(c1)
+    pool.release(c2)
+    assert pool.get_stats()['in_use'] == 0
+
+
+def test_pool_reset_after_fork():
+    pool = RohmConnectionPool(max_connections=2)
+    connection = pool.get_connection('ping')
+    connection.connect()
+    inherited_sock = connection._sock
+    pool.release(connection)
+
+    # Pretend we're in a forked child
+    pool.pid = -1
+
+    new_connection = pool.get_connection('ping')
+    assert new_connection is not connection
+    assert connection._sock is None
+    assert inherited_sock is not None
+    assert pool.get_stats()['created'] == 1
@@ -1,3 +1,4 @@
+import pytest
 
 from rohm.models import Model
 from rohm import fields
@@ -67,3 +68,351 @@ def test_float_field():
 
     assert bar.x == float_val
     assert FloatModel.get(id=2).x == float_val
+
+
+def test_bitmap_boolean_field(conn):
+    from rohm.testing import count_round_trips
+
+    class Store(Model):
+        name = fields.CharField()
+        is_open = fields.BooleanField(storage='bitmap')
+
+    for i in range(1, 11):
+        Store(id=i, name='store{}'.format(i), is_open=i % 3 == 0).save()
+
+    assert conn.getbit('store:_bitmap:is_open', 3) == 1
+    assert Store.get(3).is_open is True
+
+    with count_round_trips() as counter:
+        flags = Store.get_flags('is_open', [3, 4, 6, 100])
+        count = Store.count_flag('is_open')
+    assert flags == [True, False, True, False]
+    assert count == 3
+    assert counter.commands == {'BITFIELD': 1, 'BITCOUNT': 1}
+
+    store = Store.get(4)
+    store.is_open = True
+    store.save()
+    Store.update(9, is_open=False)
+    Store.get(6).delete()
+    Store.delete_many([3])
+    assert Store.get_flags('is_open', range(1, 11), chunk_size=3) == \
+        [i == 4 for i in range(1, 11)]
+
+    with pytest.raises(ValueError):
+        Store.get_flags('name', [1])
+    with pytest.raises(ValueError):
+        fields.BooleanField(storage='nope')
+
+    # Bits would outlive expiring hashes
+    with pytest.raises(ValueError):
+        class Expiring(Model):
+            ttl = 60
+            is_open = fields.BooleanField(storage='bitmap')
+
+    Store.ttl = 60
+    with pytest.raises(ValueError):
+        Store(id=20, is_open=True).save()
+    assert not conn.exists('store:20')
+
+
+class TestCollectionFields(object):
+
+    @pytest.fixture
+    def Foo(self):
+        class Foo(Model):
+            name = fields.CharField()
+            tags = fields.SetField()
+            events = fields.ListField(fields.IntegerField())
+            scores = fields.SortedSetField()
+            counts = fields.HashField(fields.IntegerField())
+
+        return Foo
+
+    def test_collections(self, Foo, conn):
+        from rohm.testing import count_round_trips
+
+        foo = Foo(id=1, name='foo', tags={'a', 'b'}, events=[1, 2])
+        foo.save()
+        assert conn.hgetall('foo:1') == {'id': '1', 'name': 'foo'}
+        assert conn.smembers('foo:1:tags') == {'a', 'b'}
+
+        foo = Foo.get(1)
+        with count_round_trips() as counter:
+            foo.tags.add('c')
+            foo.tags.remove('a')
+            foo.events.push(3, 4)
+            foo.scores.add({'x': 1.5, 'y': 3})
+            foo.scores.increment('x', 2)
+            foo.counts.increment('views')
+            foo.counts.update({'likes': 5})
+        assert counter.round_trips == 7
+        assert counter.commands['HMSET'] == 1
+
+        assert foo.tags.all() == {'b', 'c'}
+        assert 'b' in foo.tags
+        assert len(foo.tags) == 2
+        assert foo.events.range(1, 2) == [2, 3]
+        assert foo.events.pop() == 4
+        assert list(foo.events) == [1, 2, 3]
+        assert foo.scores.score('x') == 3.5
+        assert foo.scores.range(desc=True, withscores=True) == [('x', 3.5), ('y', 3.0)]
+        assert foo.scores.range_by_score(3.2) == ['x']
+        assert foo.counts.all() == {'views': 1, 'likes': 5}
+        assert foo.counts.get('nope', 0) == 0
+
+        # Assigning replaces on save
+        foo.tags = ['z']
+        foo.save()
+        assert foo.tags.all() == {'z'}
+
+        foo.delete()
+        assert not conn.keys('foo:*')
+
+        Foo(id=2, tags={'a'}).save()
+        Foo.delete_many([2])
+        assert not conn.keys('foo:*')
+
+    def test_ttl(self, conn):
+        class Foo(Model):
+            ttl = 30
+            tags = fields.SetField()
+            log = fields.ListField()
+
+        foo = Foo(id=1, tags={'a'})
+        foo.save()
+        assert 0 < conn.ttl('foo:1:tags') <= 30
+
+        # Created after the save, still gets the ttl
+        foo.log.push('started')
+        assert 0 < conn.ttl('foo:1:log') <= 30
+
+
+class TestJSONPaths(object):
+
+    @pytest.fixture
+    def Menu(self):
+        class Menu(Model):
+            name = fields.CharField()
+            data = fields.JSONField()
+
+        return Menu
+
+    def make_data(self):
+        return {
+            'title': 'Lunch',
+            'items': [{'name': 'item {}'.format(i), 'price': 100 + i, 'tags': ['a']}
+                      for i in range(50)],
+        }
+
+    def test_get_ops(self):
+        from rohm.jsonpath import get_ops, apply_ops
+
+        old = self.make_data()
+        new = self.make_data()
+        new['items'][3]['price'] = 999
+        new['items'].append({'name': 'new'})
+        del new['title']
+        new['note'] = u'caf\xe9'
+
+        ops = get_ops(old, new)
+        assert ops == [
+            ('del', ['title']),
+            ('set', ['items', 3, 'price'], 999),
+            ('set', ['items', 50], {'name': 'new'}),
+            ('set', ['note'], u'caf\xe9'),
+        ]
+        assert apply_ops(old, ops) == new
+
+        # Not expressible safely
+        assert get_ops({'a': 1}, {'a': 1.5}) is None
+        assert get_ops({'a': 1}, {'a': []}) is None
+        assert get_ops({'a': 1}, [1]) is None
+
+    def test_save_sends_delta(self, Menu, conn):
+        from rohm.testing import count_round_trips
+
+        Menu(id=1, name='menu', data=self.make_data()).save()
+        menu = Menu.get(1)
+        menu.data['items'][3]['price'] = 999
+        menu.name = 'lunch menu'
+
+        with count_round_trips() as counter:
+            menu.save()
+        assert counter.commands['EVAL'] == 1
+        assert counter.round_trips == 1
+
+        expected = self.make_data()
+        expected['items'][3]['price'] = 999
+        assert Menu.get(1).data == expected
+        assert Menu.get(1).name == 'lunch menu'
+
+    def test_save_fallback(self, Menu, conn):
+        data = self.make_data()
+        data['ratio'] = 0.5
+        Menu(id=1, data=data).save()
+
+        # The stored document has a float, the script refuses and the document is rewritten
+        menu = Menu.get(1)
+        menu.data['items'][0]['price'] = 1
+        menu.save()
+
+        data['items'][0]['price'] = 1
+        assert Menu.get(1).data == data
+
+        # Bigger diff than document
+        Menu(id=2, data={'a': 1}).save()
+        menu = Menu.get(2)
+        menu.data['b'] = 2
+        menu.save()
+        assert conn.hget('menu:2', 'data') == '{"a": 1, "b": 2}'
+
+    def test_json_set(self, Menu, conn):
+        from rohm.testing import count_round_trips
+
+        Menu(id=1, data=self.make_data()).save()
+        menu = Menu.get(1)
+        menu.name = 'unsaved'
+
+        with count_round_trips() as counter:
+            menu.json_set('data', ['items', 3, 'price'], 999)
+            menu.json_delete('data', ['items', 49])
+        assert counter.commands == {'EVAL': 2}
+
+        assert menu.data['items'][3]['price'] == 999
+        assert menu._get_modified_field_names() == ['name']
+
+        stored = Menu.get(1)
+        assert stored.data == menu.data
+        assert stored.name is None
+
+        menu.json_set('data', ['ratio'], 0.5)
+        assert Menu.get(1).data['ratio'] == 0.5
+
+    def test_number_precision(self, Menu, conn):
+        # cjson keeps 14 significant digits: bigger numbers aren't patched in place
+        Menu(id=1, data={'ts': 123456789012345, 'a': 1, 'b': [1]}).save()
+        menu = Menu.get(1)
+        menu.data['a'] = 2
+        menu.save()
+        assert Menu.get(1).data == {'ts': 123456789012345, 'a': 2, 'b': [1]}
+
+        menu.json_set('data', ['big'], 9007199254740991)
+        menu.json_set('data', ['b', 0], 99999999999999)
+        assert Menu.get(1).data == menu.data
+        assert Menu.get(1).data['big'] == 9007199254740991
+
+    def test_stored_document_changed(self, Menu, conn):
+        import json
+        from rohm.scripts import hset_if_unchanged
+
+        Menu(id=1, data=self.make_data()).save()
+        menu = Menu.get(1)
+
+        # Written meanwhile, with a number the script can't re-encode: the patch is
+        # refused and the whole document is written
+        conn.hset('menu:1', 'data', json.dumps({'ts': 123456789012345, 'items': []}))
+        menu.data['items'][0]['price'] = 1
+        menu.save()
+        assert Menu.get(1).data == menu.data
+
+        # The fallback write doesn't overwrite a write made after the patch was refused
+        assert hset_if_unchanged(conn, keys=['menu:1'], args=['data', 'stale sha1', '{}']) == 0
+        assert Menu.get(1).data == menu.data
+
+        with pytest.raises(ValueError):
+            menu.json_set('name', ['a'], 1)
+
+
+def test_geo_field(conn):
+    from rohm.testing import count_round_trips
+
+    class Driver(Model):
+        name = fields.CharField()
+        location = fields.GeoField()
+
+    # Along the equator, ~111km per degree
+    for i in range(1, 6):
+        Driver(id=i, name='driver{}'.format(i), location=(i * 0.01, 0)).save()
+    Driver(id=6, name='off duty').save()
+
+    assert Driver.get(2).location == (0.02, 0.0)
+
+    with count_round_trips() as counter:
+        assert Driver.nearby(0, 0, 3.5, unit='km') == [1, 2, 3]
+    assert counter.round_trips == 1
+
+    nearest = Driver.nearby(0.035, 0, 10, unit='km', limit=2, with_distance=True, load=True)
+    assert [(driver.name, round(distance, 1)) for driver, distance in nearest] == \
+        [('driver3', 0.6), ('driver4', 0.6)]
+
+    # Moved and deleted drivers leave the index
+    driver = Driver.get(1)
+    driver.location = (10, 10)
+    driver.save()
+    Driver.get(2).delete()
+    Driver.update(3, location=None)
+    assert Driver.nearby(0, 0, 10, unit='km') == [4, 5]
+
+    with pytest.raises(ValueError):
+        Driver(id=7, location=(0, 90)).save()
+
+    # GEO members would outlive expiring hashes
+    with pytest.raises(ValueError):
+        class Expiring(Model):
+            ttl = 60
+            location = fields.GeoField()
+
+    Driver.ttl = 60
+    with pytest.raises(ValueError):
+        Driver(id=8, location=(0, 0)).save()
+    assert not conn.exists('driver:8')
+
+
+def test_prefix_index(conn):
+    from rohm.testing import count_round_trips
+
+    class Store(Model):
+        name = fields.CharField(prefix_index=True)
+
+    names = [u'Burger Barn', u'burrito bar', u'Bagel Shop', u'Caf\xe9 Bleu', u'Burger']
+    for i, name in enumerate(names, 1):
+        Store(id=i, name=name).save()
+    Store(id=10).save()
+
+    with count_round_trips() as counter:
+        stores = Store.search_prefix('name', 'BUR')
+    assert counter.round_trips == 2
+    assert [store.name for store in stores] == [u'Burger', u'Burger Barn', u'burrito bar']
+
+    assert Store.search_prefix('name', u'caf\xe9', load=False) == [4]
+    assert Store.search_prefix('name', 'bur', limit=1, load=False) == [5]
+
+    # Renames use the original value to update the index
+    store = Store.get(1)
+    store.name = u'Taco Town'
+    store.save()
+    Store.get(2).delete()
+    assert Store.search_prefix('name', 'bur', load=False) == [5]
+    assert Store.search_prefix('name', 'taco', load=False) == [1]
+
+    store = Store.get(1, fields=['id'])
+    store.name = u'Pizza Place'
+    store.save()
+    assert Store.search_prefix('name', 'taco', load=False) == []
+
+    assert Store.search_prefix('name', 'b', limit=None, load=False) == [3, 5]
+
+    with pytest.raises(ValueError):
+        Store.search_prefix('id', '1')
+
+    # Index entries would outlive expiring hashes
+    with pytest.raises(ValueError):
+        class Expiring(Model):
+            ttl = 60
+            name = fields.CharField(prefix_index=True)
+
+    Store.ttl = 60
+    with pytest.raises(ValueError):
+        Store(id=20, name='Bistro').save()
+    assert not conn.exists('store:20')
@@ -0,0 +1,159 @@
+import pytest
+
+from rohm import instrumentation
+from rohm.instrumentation import HistogramCollector, StatsdCollector
+from rohm.models import Model
+from rohm import fields
+
+
+@pytest.yield_fixture
+def collector():
+    collector = HistogramCollector()
+    instrumentation.add_collector(collector)
+    yield collector
+    instrumentation.remove_collector(collector)
+
+
+@pytest.fixture
+def Foo():
+    class Foo(Model):
+        name = fields.CharField()
+        num = fields.IntegerField()
+        bar = fields.RelatedModelField('Bar')
+
+    class Bar(Model):
+        title = fields.CharField()
+
+    return Foo
+
+
+def test_disabled():
+    class Foo(Model):
+        pass
+
+    assert instrumentation.start(Foo, 'get') is None
+
+
+def test_operations(Foo, collector):
+    bar = Foo._get_field('bar').model_cls(id=1, title='bar')
+    bar.save()
+
+    foo = Foo(id=1, name='foo', num=1, bar=bar)
+    foo.save()
+
+    foos = Foo.get([1, 2], raise_missing_exception=False)
+    foo = foos[0]
+    assert foo.bar.title == 'bar'
+
+    foo = Foo.get(1, fields=['name'])
+    assert foo.num == 1
+
+    foo.delete()
+
+    summary = collector.summary()
+    assert set(summary.keys()) == {
+        ('Bar', 'save'), ('Bar', 'get'),
+        ('Foo', 'save'), ('Foo', 'get'), ('Foo', 'load_related'),
+        ('Foo', 'load_field'), ('Foo', 'delete'),
+    }
+
+    get_commands = collector.get('Foo', 'get', 'commands')
+    assert get_commands.count == 2
+    assert get_commands.max == 2     # multi-get of 2 ids
+
+    assert collector.get('Foo', 'get', 'round_trips').max == 1
+    assert collector.get('Foo', 'get', 'bytes_received').min > 0
+    assert collector.get('Foo', 'get', 'network_time').count == 2
+
+    # New instance save does WATCH + EXISTS + MULTI/EXEC
+    assert collector.get('Foo', 'save', 'round_trips').max == 3
+    assert collector.get('Foo', 'load_field', 'commands').max == 1
+
+
+def test_get_edge_cases(Foo, collector):
+    from rohm.exceptions import DoesNotExist
+
+    # Nothing to load isn't an operation
+    assert Foo.get([]) == []
+    assert collector.summary() == {}
+
+    # A load that raises is still recorded
+    with pytest.raises(DoesNotExist):
+        Foo.get(1)
+    assert collector.get('Foo', 'get', 'round_trips').count == 1
+
+
+def test_failed_writes(Foo, collector):
+    from rohm.exceptions import AlreadyExists
+
+    Foo(id=1, name='foo').save()
+    with pytest.raises(AlreadyExists):
+        Foo(id=1, name='other').save()
+    assert collector.get('Foo', 'save', 'round_trips').count == 2
+
+    def broken(conn):
+        raise RuntimeError('hook')
+    foo = Foo.get(1)
+    foo.on_delete = broken
+    with pytest.raises(RuntimeError):
+        foo.delete()
+    with pytest.raises(RuntimeError):
+        Foo.delete_many([foo])
+    assert collector.get('Foo', 'delete', 'round_trips').count == 1
+    assert collector.get('Foo', 'delete_many', 'round_trips').count == 1
+
+
+def test_get_many(Foo, collector):
+    import rohm
+
+    Foo(id=1, name='foo').save()
+    Foo(id=2, name='foo').save()
+    collector.reset()
+
+    rohm.get_many([(Foo, [1, 2]), (Foo, 2, {'fields': ['name']}), (Foo, [])])
+
+    # One operation per request, the round trip goes to one of them
+    assert collector.get('Foo', 'get', 'commands').count == 2
+    assert collector.get('Foo', 'get', 'commands').max == 2
+    assert collector.get('Foo', 'get', 'round_trips').max == 1
+    assert collector.get('Foo', 'get', 'round_trips').min == 0
+    assert collector.get('Foo', 'get', 'bytes_received').min > 0
+
+    with pytest.raises(TypeError):
+        rohm.get_many([(Foo, 1, {'field': ['name']})])
+
+
+def test_statsd_collector(Foo):
+    class FakeStatsd(object):
+        def __init__(self):
+            self.calls = []
+
+        def incr(self, name, count):
+            self.calls.append(('incr', name, count))
+
+        def timing(self, name, ms):
+            self.calls.append(('timing', name, ms))
+
+    statsd = FakeStatsd()
+    collector = StatsdCollector(statsd, prefix='app')
+    instrumentation.add_collector(collector)
+    try:
+        Foo(id=1, name='foo').save()
+    finally:
+        instrumentation.remove_collector(collector)
+
+    names = {name for _, name, _ in statsd.calls}
+    assert 'app.foo.save.calls' in names
+    assert 'app.foo.save.round_trips' in names
+    assert 'app.foo.save.network_time' in names
+
+
+def test_histogram_percentiles():
+    hist = instrumentation.Histogram([1, 2, 4, 8])
+    for val in [1, 1, 3, 3, 7, 100]:
+        hist.add(val)
+
+    assert hist.count == 6
+    assert hist.percentile(50) == 4
+    assert hist.percentile(100) == 100
+    assert hist.summary()['max'] == 100
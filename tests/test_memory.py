@@ -0,0 +1,140 @@
+import threading
+
+import pytest
+import redis
+
+from rohm.memory import MemoryRedis, FakeClock
+from rohm.models import Model
+from rohm.exceptions import AlreadyExists
+from rohm import fields
+
+
+@pytest.fixture
+def clock():
+    return FakeClock(now=1000000)
+
+
+@pytest.fixture
+def mem(clock):
+    return MemoryRedis(clock=clock)
+
+
+def test_commands(mem):
+    assert mem.set('a', 1) is True
+    assert mem.set('a', 2, nx=True) is None
+    assert mem.get('a') == '1'
+
+    mem.hmset('h', {'x': 1, 'y': u'caf\xe9'})
+    assert mem.hgetall('h') == {'x': '1', 'y': 'caf\xc3\xa9'}
+    assert mem.hmget('h', ['x', 'z']) == ['1', None]
+    assert mem.hdel('h', 'x', 'y') == 2
+    assert not mem.exists('h')
+
+    assert mem.zadd('z', 1, 'a', 2.5, 'b') == 2
+    assert mem.zrange('z', 0, -1, withscores=True) == [('a', 1.0), ('b', 2.5)]
+    assert mem.zrangebyscore('z', '(1', '+inf') == ['b']
+
+    with pytest.raises(redis.ResponseError) as exc:
+        mem.hget('z', 'a')
+    assert 'WRONGTYPE' in str(exc.value)
+
+    with pytest.raises(redis.ResponseError):
+        mem.execute_command('OBJECT', 'ENCODING', 'z')
+
+
+def test_expiry(mem, clock):
+    mem.set('a', 1)
+    mem.expire('a', 10)
+    assert mem.ttl('a') == 10
+
+    clock.advance(9.9)
+    assert mem.exists('a')
+    clock.advance(0.1)
+    assert not mem.exists('a')
+    assert mem.ttl('a') == -2
+
+
+def test_watch(mem):
+    pipe = mem.pipeline()
+    pipe.watch('a')
+    pipe.multi()
+    pipe.set('a', 1)
+
+    mem.set('a', 2)
+    with pytest.raises(redis.WatchError):
+        pipe.execute()
+    assert mem.get('a') == '2'
+    assert not mem.server.watchers
+
+
+def test_watch_expiry(mem, clock):
+    mem.set('a', 1)
+    mem.expire('a', 10)
+
+    pipe = mem.pipeline()
+    pipe.watch('a')
+    pipe.multi()
+    pipe.set('b', 1)
+    clock.advance(10)
+    with pytest.raises(redis.WatchError):
+        pipe.execute()
+    assert not mem.exists('b')
+
+    # Watching a key that's already gone doesn't
+    pipe.watch('a')
+    pipe.multi()
+    pipe.set('b', 1)
+    assert pipe.execute() == [True]
+    assert not mem.server.watchers
+
+
+def test_arity(mem):
+    with pytest.raises(redis.ResponseError) as exc:
+        mem.execute_command('GET', 'a', 'b')
+    assert 'wrong number of arguments' in str(exc.value)
+    with pytest.raises(redis.ResponseError):
+        mem.execute_command('HSET', 'h')
+
+    # Bugs in the backend aren't reported as the client's mistake
+    def broken(*args):
+        raise TypeError('bug')
+    mem.server.cmd_get = broken
+    with pytest.raises(TypeError):
+        mem.get('a')
+
+
+def test_scan_while_deleting(mem):
+    for i in range(25):
+        mem.set('key:{:02}'.format(i), i)
+
+    seen = []
+    for key in mem.scan_iter(match='key:*', count=5):
+        seen.append(key)
+        mem.delete(key)
+    assert len(seen) == 25
+
+
+def test_models_in_parallel():
+    errors = []
+
+    def run():
+        class Foo(Model):
+            name = fields.CharField()
+
+        Foo.set_connection(MemoryRedis())
+        try:
+            for i in range(1, 51):
+                Foo(id=i, name='foo').save()
+            assert len(Foo.get(range(1, 51))) == 50
+            with pytest.raises(AlreadyExists):
+                Foo(id=1).save()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
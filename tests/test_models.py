@@ -1,11 +1,14 @@
 
+import threading
+import time
+
 import pytest
 from mock import call
 
 from rohm.models import Model
 from rohm import fields
 from rohm.connection import get_connection
-from rohm.exceptions import DoesNotExist, AlreadyExists
+from rohm.exceptions import DoesNotExist, AlreadyExists, FieldValidationError, ConflictError
 
 
 @pytest.fixture
@@ -375,3 +378,771 @@ def test_atomic_transaction_multiple_saves(Foo, conn, pipe):
 
     assert Foo.get(id=1).name == 'foo10'
     assert Foo.get(id=2).name == 'foo20'
+
+
+class TestDeferredFields(object):
+
+    @pytest.fixture
+    def Menu(self):
+        class Menu(Model):
+            name = fields.CharField()
+            items = fields.JSONField(lazy=True)
+            extra = fields.JSONField(lazy=True, default=lambda: {})
+
+        return Menu
+
+    def test_deferred_load(self, Menu, conn, pipe):
+        items = [{'name': 'item', 'price': 100}]
+        Menu(id=1, name='menu', items=items, extra={'a': 1}).save()
+
+        pipe.reset_mock()
+        menu = Menu.get(1)
+
+        pipe.hmget.assert_called_with('menu:1', ['id', 'name'])
+        assert pipe.hgetall.call_count == 0
+        assert menu._loaded_field_names == {'id', 'name'}
+
+        # Accessing one deferred field loads all of them
+        pipe.reset_mock()
+        assert menu.items == items
+        pipe.hmget.assert_called_with('menu:1', ['extra', 'items'])
+        assert menu._loaded_field_names == {'id', 'name', 'items', 'extra'}
+
+        pipe.reset_mock()
+        assert menu.extra == {'a': 1}
+        assert pipe.hmget.call_count == 0
+        assert pipe.hget.call_count == 0
+
+    def test_include_deferred(self, Menu, pipe):
+        Menu(id=1, name='menu', items=[]).save()
+
+        pipe.reset_mock()
+        menu = Menu.get(1, include_deferred=True)
+        pipe.hgetall.assert_called_with('menu:1')
+        assert menu._loaded_field_names == {'id', 'name', 'items', 'extra'}
+
+    def test_deferred_save_modified_only(self, Menu, conn, pipe):
+        Menu(id=1, name='menu', items=[1, 2], extra={'a': 1}).save()
+
+        menu = Menu.get(1)
+        menu.name = 'new'
+        pipe.reset_mock()
+        menu.save()
+
+        pipe.hmset.assert_called_with('menu:1', {'name': 'new'})
+        assert pipe.hdel.call_count == 0
+
+        menu = Menu.get(1, include_deferred=True)
+        assert menu.items == [1, 2]
+        assert menu.extra == {'a': 1}
+
+    def test_deferred_missing(self, Menu):
+        with pytest.raises(DoesNotExist):
+            Menu.get(1)
+
+    def test_deferred_not_modified(self, Menu, pipe):
+        Menu(id=1, name='menu', items=[1, 2]).save()
+
+        menu = Menu.get(1)
+        assert menu.items == [1, 2]
+        menu.name = 'x'
+        assert menu._get_modified_fields() == {'name': 'x'}
+
+        pipe.reset_mock()
+        menu.save()
+        pipe.hmset.assert_called_with('menu:1', {'name': 'x'})
+
+    def test_deferred_eager_defaults(self):
+        class Menu(Model):
+            name = fields.CharField()
+            flag = fields.BooleanField(default=True)
+            items = fields.JSONField(lazy=True, default=lambda: [])
+
+        Menu(id=1, name='menu', flag=None, items=None).save()
+
+        menu = Menu.get(1)
+        assert menu.flag is True
+        assert menu.items == []
+
+
+class TestValues(object):
+
+    @pytest.fixture
+    def Foo(self):
+        class Foo(Model):
+            name = fields.CharField()
+            num = fields.IntegerField()
+            bar = fields.RelatedModelField('Bar')
+
+        Foo(id=1, name='foo', num=1, bar_id=5).save()
+        Foo(id=2, name='bar').save()
+        return Foo
+
+    def test_values(self, Foo, pipe):
+        pipe.reset_mock()
+        rows = Foo.values([1, 2, 3], ['name', 'num', 'bar_id'])
+
+        assert rows == [
+            {'name': 'foo', 'num': 1, 'bar_id': 5},
+            {'name': 'bar', 'num': None, 'bar_id': None},
+            None,
+        ]
+        assert pipe.hmget.call_args_list == [
+            call('foo:1', ['name', 'num', 'bar_id', 'id']),
+            call('foo:2', ['name', 'num', 'bar_id', 'id']),
+            call('foo:3', ['name', 'num', 'bar_id', 'id']),
+        ]
+        assert pipe.execute.call_count == 1
+
+        missing = object()
+        assert Foo.values([3], ['id'], missing=missing) == [missing]
+
+    def test_values_list(self, Foo):
+        assert Foo.values_list([1, 2, 3], ['id', 'name']) == [(1, 'foo'), (2, 'bar'), None]
+        assert Foo.values_list([2, 1], ['num'], flat=True) == [None, 1]
+
+        with pytest.raises(ValueError):
+            Foo.values_list([1], ['id', 'name'], flat=True)
+
+
+class TestDeleteMany(object):
+
+    @pytest.fixture
+    def Foo(self):
+        class Foo(Model):
+            name = fields.CharField()
+
+        for i in range(1, 6):
+            Foo(id=i, name='foo{}'.format(i)).save()
+        return Foo
+
+    def test_delete(self, Foo, conn):
+        foo = Foo.get(1)
+        foo.delete()
+        assert not conn.exists('foo:1')
+
+    def test_delete_many(self, Foo, conn):
+        from rohm.testing import count_round_trips
+
+        with count_round_trips() as counter:
+            deleted = Foo.delete_many([1, 2, 3, 10], chunk_size=2)
+
+        assert deleted == 3
+        assert counter.pipelines == 2
+        assert counter.log[-2:] == [['UNLINK'], ['UNLINK']]
+        assert Foo.get([1, 2, 3, 4], raise_missing_exception=False)[:3] == [None, None, None]
+        assert conn.exists('foo:4')
+
+        foos = Foo.get([4, 5])
+        assert Foo.delete_many(foos) == 2
+        assert conn.keys('foo:*') == []
+
+    def test_delete_many_hooks(self, conn):
+        deleted_names = []
+
+        class Foo(Model):
+            name = fields.CharField()
+
+            def on_delete(self, conn):
+                deleted_names.append(self.name)
+                conn.srem('names', self.name)
+
+        class Bar(Model):
+            @classmethod
+            def on_delete_many(cls, conn, ids, instances=None):
+                assert instances is None
+                conn.srem('bars', *ids)
+
+        for i in range(1, 4):
+            Foo(id=i, name='foo{}'.format(i)).save()
+            Bar(id=i).save()
+        conn.sadd('names', 'foo1', 'foo2', 'foo3')
+        conn.sadd('bars', 1, 2, 3)
+
+        # Per-instance hooks still get called when deleting by id
+        assert Foo.delete_many([1, 2]) == 2
+        assert sorted(deleted_names) == ['foo1', 'foo2']
+        assert conn.smembers('names') == {'foo3'}
+
+        assert Bar.delete_many([1, 3]) == 2
+        assert conn.smembers('bars') == {'2'}
+
+    def test_delete_by_scan(self, Foo, conn):
+        conn.set('foo:1:other', 'x')
+        conn.set('foobar:1', 'x')
+
+        assert Foo.delete_by_scan(count=2, chunk_size=2) == 5
+        assert sorted(conn.keys('foo*')) == ['foo:1:other', 'foobar:1']
+
+
+class TestPreload(object):
+
+    @pytest.fixture
+    def Foo(self):
+        class Foo(Model):
+            name = fields.CharField()
+
+            @classmethod
+            def create_from_id(cls, id):
+                return cls(id=id, name='created{}'.format(id)) if id < 20 else None
+
+        for i in range(1, 11):
+            Foo(id=i, name='foo{}'.format(i)).save()
+        return Foo
+
+    def test_preload_ids(self, Foo):
+        import rohm
+
+        calls = []
+        with rohm.batch() as current_batch:
+            loaded = Foo.preload(ids=[1, 2, 3, 30, 4], chunk_size=2, concurrency=2,
+                                 progress=lambda *args: calls.append(args))
+
+        assert loaded == 4
+        assert calls == [(2, 2), (4, 3), (5, 4)]
+        assert sorted(foo.id for foo in current_batch.peers(Foo(id=1))) == [1, 2, 3, 4]
+
+        assert Foo.preload(ids=[11, 12, 30], allow_create=True) == 2
+        assert Foo.get(12).name == 'created12'
+
+    def test_preload_scan(self, Foo, conn):
+        conn.set('foo:1:other', 'x')
+        assert Foo.preload(chunk_size=3, concurrency=2, count=2) == 10
+
+
+class TestGetMany(object):
+
+    def test_get_many(self, Foo):
+        import rohm
+        from rohm.memory import MemoryRedis
+        from rohm.testing import count_round_trips
+
+        class Bar(Model):
+            connection = MemoryRedis()
+            name = fields.CharField()
+            num = fields.IntegerField()
+
+        for i in range(1, 4):
+            Foo(id=i, name='foo{}'.format(i), num=i).save()
+        Bar(id=1, name='bar', num=1).save()
+
+        with count_round_trips() as counter:
+            foos, foo, bar, nothing = rohm.get_many([
+                (Foo, [1, 2, 10]),
+                (Foo, 3, {'fields': ['name']}),
+                (Bar, 1),
+                (Bar, []),
+            ])
+
+        # One pipeline per connection
+        assert counter.pipelines == 2
+        assert [f and f.name for f in foos] == ['foo1', 'foo2', None]
+        assert foo.name == 'foo3' and 'num' not in foo._data
+        assert (bar.name, bar.num) == ('bar', 1)
+        assert nothing == []
+
+        with pytest.raises(DoesNotExist):
+            rohm.get_many([(Foo, 1), (Bar, 2)])
+        assert rohm.get_many([(Bar, 2, {'raise_missing_exception': False})]) == [None]
+
+
+class TestCreateFromIds(object):
+
+    @pytest.fixture
+    def Foo(self):
+        source = {i: 'foo{}'.format(i) for i in range(1, 100)}
+        calls = []
+
+        class Foo(Model):
+            missing_cache_ttl = 60
+            name = fields.CharField()
+
+            @classmethod
+            def create_from_ids(cls, ids):
+                calls.append(list(ids))
+                return {id: cls(id=id, name=source[id]) if id in source else None for id in ids}
+
+        Foo.calls = calls
+        return Foo
+
+    @pytest.yield_fixture(autouse=True)
+    def clear_negative_cache(self):
+        from rohm.loading import negative_cache
+        negative_cache.clear()
+        yield
+        negative_cache.clear()
+
+    def test_create_from_ids(self, Foo, conn):
+        from rohm.testing import count_round_trips
+
+        Foo(id=1, name='existing').save()
+
+        with count_round_trips() as counter:
+            foos = Foo.get([1, 2, 3, 200], allow_create=True)
+
+        assert [foo.name if foo else None for foo in foos] == ['existing', 'foo2', 'foo3', None]
+        assert Foo.calls == [[2, 3, 200]]
+
+        # One pipeline to read, one to write back the created instances
+        assert counter.round_trips == 2
+        assert conn.hgetall('foo:2') == {'id': '2', 'name': 'foo2'}
+        assert not foos[1]._new
+
+        # 200 is in the negative cache
+        assert Foo.get([2, 200], allow_create=True)[1] is None
+        assert Foo.calls == [[2, 3, 200]]
+
+        with pytest.raises(DoesNotExist):
+            Foo.get(200, allow_create=True)
+
+    def test_negative_cache_expires(self, Foo):
+        from rohm.loading import negative_cache
+
+        Foo.missing_cache_ttl = 0.01
+        assert Foo.get(200, allow_create=True, raise_missing_exception=False) is None
+        assert negative_cache.contains(Foo, 200)
+
+        import time
+        time.sleep(0.02)
+        assert not negative_cache.contains(Foo, 200)
+
+        Foo.get(200, allow_create=True, raise_missing_exception=False)
+        assert Foo.calls == [[200], [200]]
+
+    def test_create_from_id_fallback(self, conn):
+        class Foo(Model):
+            missing_cache_ttl = 60
+            name = fields.CharField()
+
+            @classmethod
+            def create_from_id(cls, id):
+                if id == 2:
+                    raise DoesNotExist
+                if id == 3:
+                    raise Exception('Source is down')
+                return cls(id=id, name='foo')
+
+        foos = Foo.get([1, 2, 3], allow_create=True)
+        assert foos[0].name == 'foo'
+        assert foos[1:] == [None, None]
+        assert conn.hgetall('foo:1') == {'id': '1', 'name': 'foo'}
+
+        from rohm.loading import negative_cache
+        assert negative_cache.contains(Foo, 2)
+        assert not negative_cache.contains(Foo, 3)
+
+    def test_create_indexed(self, conn):
+        from rohm.testing import count_round_trips
+
+        class Thing(Model):
+            name = fields.CharField(prefix_index=True)
+
+            @classmethod
+            def create_from_ids(cls, ids):
+                if 30 in ids:
+                    # Another process creates it meanwhile
+                    Thing(id=30, name='other').save()
+                return {id: cls(id=id, name='thing{}'.format(id)) for id in ids}
+
+        # Get, read the stored index values of all the created ids, write back
+        with count_round_trips() as counter:
+            Thing.get(list(range(1, 21)), allow_create=True)
+        assert counter.round_trips == 3
+
+        assert Thing.get(30, allow_create=True).name == 'thing30'
+        assert Thing.search_prefix('name', 'other', load=False) == []
+        assert Thing.search_prefix('name', 'thing30', load=False) == [30]
+
+
+class TestStampedeProtection(object):
+
+    @pytest.fixture
+    def Foo(self):
+        calls = []
+
+        class Foo(Model):
+            name = fields.CharField()
+
+            @classmethod
+            def create_from_ids(cls, ids):
+                calls.append(list(ids))
+                time.sleep(0.05)
+                return {id: cls(id=id, name='foo{}'.format(id)) for id in ids}
+
+        Foo.calls = calls
+        return Foo
+
+    def test_single_flight(self, Foo):
+        from rohm.loading import stampede_stats
+
+        Foo.single_flight = True
+        stampede_stats.clear()
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(Foo.get(1, allow_create=True)))
+                   for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert Foo.calls == [[1]]
+        assert [foo.name for foo in results] == ['foo1'] * 5
+        # Waiters get their own copies
+        assert len({id(foo) for foo in results}) == 5
+        assert stampede_stats['loads'] == 1
+        assert stampede_stats['collapsed'] == 4
+
+    def test_rebuild_lock(self, Foo, conn):
+        from rohm.loading import stampede_stats
+
+        Foo.rebuild_lock_timeout = 5
+        Foo.rebuild_lock_wait = 0.2
+        stampede_stats.clear()
+
+        # Another process is rebuilding 1 and finishes while we wait; nobody rebuilds 2
+        conn.set('foo:1:rebuild_lock', 'other', px=5000)
+        conn.set('foo:2:rebuild_lock', 'other', px=5000)
+        timer = threading.Timer(0.05, lambda: Foo(id=1, name='rebuilt').save())
+        timer.start()
+
+        foos = Foo.get([1, 2, 3], allow_create=True)
+        timer.join()
+
+        assert [foo.name for foo in foos] == ['rebuilt', 'foo2', 'foo3']
+        assert Foo.calls == [[3], [2]]
+        assert stampede_stats['locks_acquired'] == 1
+        assert stampede_stats['lock_wait_hits'] == 1
+        assert stampede_stats['lock_timeouts'] == 1
+
+        # Our lock is released, the other process' locks aren't ours to release
+        assert not conn.exists('foo:3:rebuild_lock')
+        assert conn.get('foo:1:rebuild_lock') == 'other'
+
+    def test_refresh_window(self, Foo, conn):
+        from rohm.loading import background_refresher
+
+        Foo.ttl = 100
+        Foo.refresh_window = 10
+        Foo(id=1, name='old').save()
+        Foo(id=2, name='old').save()
+
+        # Not expiring soon
+        assert Foo.get(1).name == 'old'
+        assert background_refresher.wait(timeout=5)
+        assert Foo.calls == []
+
+        # Within the window: served as is, refreshed once in the background
+        conn.expire('foo:1', 5)
+        assert [foo.name for foo in Foo.get([1, 1, 2])] == ['old', 'old', 'old']
+        assert Foo.get(1).name == 'old'
+        assert background_refresher.wait(timeout=5)
+
+        assert Foo.calls == [[1]]
+        assert Foo.get(1).name == 'foo1'
+        assert conn.ttl('foo:1') > 10
+
+        # Another process holds the rebuild lock: leave it to them
+        Foo.rebuild_lock_timeout = 5
+        conn.expire('foo:2', 5)
+        conn.set('foo:2:rebuild_lock', 'other', px=5000)
+        Foo.get(2)
+        assert background_refresher.wait(timeout=5)
+        assert Foo.calls == [[1]]
+
+    def test_refresh_is_an_update(self, conn):
+        from rohm.loading import background_refresher
+
+        class Keeper(Model):
+            name = fields.CharField()
+
+        class Foo(Model):
+            ttl = 100
+            refresh_window = 10
+            name = fields.CharField()
+            keeper = fields.RelatedModelField(Keeper, related_name='foos')
+            version = fields.VersionField()
+
+            @classmethod
+            def create_from_ids(cls, ids):
+                return {id: cls(id=id, name='rebuilt', keeper_id=2) for id in ids}
+
+        foo = Foo(id=1, name='new')
+        foo.save()
+        foo.keeper_id = 1
+        foo.save()
+        stale = Foo.get(1)
+        assert stale.version == 2
+
+        conn.expire('foo:1', 5)
+        Foo.get(1)
+        assert background_refresher.wait(timeout=5)
+
+        # The version keeps counting, and the old keeper's reverse index is updated
+        foo = Foo.get(1)
+        assert (foo.name, foo.version) == ('rebuilt', 3)
+        assert conn.smembers('keeper:1:foos') == set()
+        assert conn.smembers('keeper:2:foos') == {'1'}
+
+        stale.name = 'stale'
+        with pytest.raises(ConflictError):
+            stale.save()
+
+    def test_refresher_after_fork(self, Foo):
+        from rohm.loading import BackgroundRefresher
+
+        refreshed = []
+        refresher = BackgroundRefresher(num_threads=1)
+        refresher.schedule(Foo, [1], refreshed.extend)
+        assert refresher.wait(timeout=5)
+
+        # As if forked while the parent was refreshing 2, with the lock held
+        refresher._pending.add((Foo._key_prefix, 2))
+        refresher._lock.acquire()
+        refresher._pid = -1
+
+        assert refresher.schedule(Foo, [2], refreshed.extend) == [2]
+        assert refresher.wait(timeout=5)
+        assert refreshed == [1, 2]
+
+
+class TestUpdate(object):
+
+    @pytest.fixture
+    def Foo(self):
+        class Foo(Model):
+            ttl = 30
+            name = fields.CharField()
+            num = fields.IntegerField()
+            data = fields.JSONField()
+
+        return Foo
+
+    def test_update(self, Foo, conn):
+        from rohm.testing import count_round_trips
+
+        Foo(id=1, name='foo', num=1).save()
+
+        with count_round_trips() as counter:
+            assert Foo.update(1, num=2, data={'a': 1}, name=None)
+        assert counter.round_trips == 1
+
+        assert conn.hgetall('foo:1') == {'id': '1', 'num': '2', 'data': '{"a": 1}'}
+        assert 0 < conn.ttl('foo:1') <= 30
+
+        foo = Foo.get(1)
+        assert (foo.name, foo.num, foo.data) == (None, 2, {'a': 1})
+
+        # Upsert
+        assert Foo.set(2, name='bar')
+        assert Foo.get(2).name == 'bar'
+
+        with pytest.raises(Exception):
+            Foo.update(1, num='not a number')
+        with pytest.raises(FieldValidationError):
+            Foo.update(1, nope=1)
+
+    def test_require_exists(self, Foo, conn):
+        Foo(id=1, name='foo').save()
+
+        assert not Foo.update(2, _require_exists=True, name='bar')
+        assert not conn.exists('foo:2')
+
+        assert Foo.update(1, _require_exists=True, name='bar', num=None)
+        assert conn.hgetall('foo:1') == {'id': '1', 'name': 'bar'}
+        assert 0 < conn.ttl('foo:1') <= 30
+
+    def test_update_many(self, Foo, conn):
+        from rohm.testing import count_round_trips
+
+        Foo(id=1, name='foo').save()
+
+        with count_round_trips() as counter:
+            written = Foo.update_many({1: {'num': 1}, 2: {'num': 2}, 3: {'name': 'c'}},
+                                      require_exists=True)
+        assert written == [1]
+        assert counter.round_trips == 1
+
+        written = Foo.update_many({i: {'num': i} for i in range(1, 6)}, chunk_size=2)
+        assert sorted(written) == [1, 2, 3, 4, 5]
+        assert Foo.values_list(range(1, 6), ['num'], flat=True) == [1, 2, 3, 4, 5]
+
+    def test_update_related(self, conn):
+        class Bar(Model):
+            title = fields.CharField()
+
+        class Foo(Model):
+            bar = fields.RelatedModelField(Bar, related_name='foos')
+
+        bar1 = Bar(id=1)
+        bar1.save()
+        Foo(id=1, bar=bar1).save()
+
+        Foo.update(1, bar=Bar(id=2))
+        assert Foo.get(1).bar_id == 2
+        assert conn.smembers('bar:1:foos') == set()
+        assert conn.smembers('bar:2:foos') == {'1'}
+
+        Foo.update(1, bar_id=None)
+        assert conn.smembers('bar:2:foos') == set()
+
+
+class TestVersionField(object):
+
+    @pytest.fixture
+    def Foo(self):
+        class Foo(Model):
+            ttl = 30
+            name = fields.CharField()
+            num = fields.IntegerField()
+            version = fields.VersionField()
+
+        return Foo
+
+    def test_compare_and_set(self, Foo, conn):
+        from rohm.testing import count_round_trips
+
+        foo = Foo(id=1, name='foo', num=1)
+        foo.save()
+        assert foo.version == 1
+
+        foo1 = Foo.get(1)
+        foo2 = Foo.get(1, fields=['num'])
+        assert foo2._data['version'] == 1
+
+        foo1.name = 'foo1'
+        with count_round_trips() as counter:
+            foo1.save()
+        assert counter.round_trips == 1
+        assert foo1.version == 2
+        assert conn.hgetall('foo:1') == {'id': '1', 'name': 'foo1', 'num': '1', 'version': '2'}
+        assert 0 < conn.ttl('foo:1') <= 30
+
+        foo2.num = 2
+        with pytest.raises(ConflictError):
+            foo2.save()
+        assert Foo.get(1).num == 1
+
+        # Blind updates bump the version too
+        Foo.update(1, num=5)
+        foo1.num = 6
+        with pytest.raises(ConflictError):
+            foo1.save()
+
+        # Deleted meanwhile
+        foo3 = Foo.get(1)
+        foo3.delete()
+        foo3.num = 7
+        with pytest.raises(ConflictError):
+            foo3.save()
+
+    def test_update_with_retry(self, Foo, conn):
+        Foo(id=1, num=0).save()
+        stale = Foo.get(1)
+        Foo.update(1, num=10)
+
+        calls = []
+
+        def increment(foo):
+            calls.append(foo.num)
+            foo.num += 1
+
+        foo = Foo.update_with_retry(stale, increment)
+        assert calls == [0, 10]
+        assert foo.num == 11
+        assert Foo.get(1).version == 3
+
+        foo = Foo.update_with_retry(1, increment)
+        assert foo.num == 12
+
+        stale = Foo.get(1)
+        Foo.update(1, num=0)
+        with pytest.raises(ConflictError):
+            Foo.update_with_retry(stale, increment, max_retries=0)
+
+    def test_versioned_indexes(self, conn):
+        class Bar(Model):
+            pass
+
+        class Foo(Model):
+            bar = fields.RelatedModelField(Bar, related_name='foos')
+            version = fields.VersionField()
+
+        Foo(id=1, bar_id=1).save()
+        foo1 = Foo.get(1)
+        foo2 = Foo.get(1)
+
+        foo1.bar_id = 2
+        foo1.save()
+
+        # The conflicting save doesn't touch the index
+        foo2.bar_id = 3
+        with pytest.raises(ConflictError):
+            foo2.save()
+        assert conn.smembers('bar:2:foos') == {'1'}
+        assert not conn.exists('bar:3:foos')
+        assert not conn.exists('bar:1:foos')
+
+    def test_versioned_indexes_in_script(self, conn):
+        from rohm.testing import count_round_trips
+
+        class Bar(Model):
+            pass
+
+        class Foo(Model):
+            bar = fields.RelatedModelField(Bar, related_name='foos')
+            tags = fields.SetField()
+            version = fields.VersionField()
+
+        Foo(id=1, bar_id=1).save()
+        foo = Foo.get(1)
+        foo.bar_id = 2
+        foo.tags = {'a', 'b'}
+
+        # One round trip: the index and collection updates run in the save script
+        with count_round_trips() as counter:
+            foo.save()
+        assert counter.commands == {'EVAL': 1}
+        assert conn.smembers('bar:2:foos') == {'1'}
+        assert not conn.exists('bar:1:foos')
+        assert conn.smembers('foo:1:tags') == {'a', 'b'}
+
+    def test_shared_pipeline(self, Foo, conn):
+        import rohm
+
+        Foo(id=1, num=1).save()
+        Foo(id=2, num=1).save()
+        foo1 = Foo.get(1)
+        foo2 = Foo.get(2)
+        Foo.update(2, num=5)
+
+        pipe = conn.pipeline()
+        foo1.num = 2
+        foo1.save(pipe=pipe)
+        foo2.num = 2
+        foo2.save(pipe=pipe)
+        assert (foo1.version, foo2.version) == (2, 2)
+
+        with pytest.raises(ConflictError):
+            rohm.execute_pipeline(pipe)
+
+        # The failed save gets its loaded version back
+        assert (foo1.version, foo2.version) == (2, 1)
+        assert Foo.get(1).num == 2
+        assert Foo.get(2).num == 5
+
+        foo1.num = 3
+        foo1.save(pipe=pipe)
+        rohm.execute_pipeline(pipe)
+        assert Foo.get(1).version == 3
+
+        # A plain execute() drops the callbacks of what it ran
+        foo1.num = 4
+        pipe.ping()
+        foo1.save(pipe=pipe)
+        pipe.execute()
+        foo2 = Foo.get(2)
+        foo2.num = 6
+        foo2.save(pipe=pipe)
+        rohm.execute_pipeline(pipe)
+        assert (Foo.get(1).version, Foo.get(2).version) == (4, 3)
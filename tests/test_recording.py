@@ -0,0 +1,105 @@
+from rohm.models import Model
+from rohm import fields
+from rohm.recording import RecordingConnection, explain
+from rohm.testing import count_round_trips
+
+
+def test_explain_get_save_delete():
+    class Foo(Model):
+        name = fields.CharField()
+        num = fields.IntegerField()
+
+        def on_save(self, conn, modified_data=None):
+            conn.sadd('foo:names', self.name)
+
+        def on_delete(self, conn):
+            conn.srem('foo:names', self.name)
+
+    replies = {'HGETALL': {'id': '1', 'name': 'foo', 'num': '10'}}
+
+    with count_round_trips() as counter:
+        with explain(replies=replies) as recorder:
+            foo = Foo.get(1)
+            assert foo.name == 'foo'
+            assert foo.num == 10
+
+            foo.name = 'bar'
+            foo.save()
+            foo.delete()
+
+    # Nothing went to Redis
+    assert counter.round_trips == 0
+
+    assert [(c.name, c.key) for c in recorder.commands] == [
+        ('HGETALL', 'foo:1'),
+        ('SADD', 'foo:names'),
+        ('HMSET', 'foo:1'),
+        ('DEL', 'foo:1'),
+        ('SREM', 'foo:names'),
+    ]
+    assert recorder.commands[2].args == ['foo:1', 'name', 'bar']
+
+    summary = recorder.summary()
+    assert summary['round_trips'] == 4
+    assert summary['commands']['HGETALL'] == 1
+    assert summary['keys'] == ['foo:1', 'foo:names']
+    assert summary['bytes_sent'] == sum(c.size for c in recorder.commands)
+
+    assert 'HMSET foo:1 name bar' in recorder.describe()
+
+    # Model connections are restored
+    assert not isinstance(Foo.get_connection(), RecordingConnection)
+
+
+def test_explain_new_save():
+    class Foo(Model):
+        ttl = 60
+        name = fields.CharField()
+
+    with explain() as recorder:
+        Foo(id=1, name='foo').save()
+
+    names = [c.name for c in recorder.commands]
+    assert names == ['WATCH', 'EXISTS', 'HMSET', 'EXPIRE']
+    assert recorder.round_trips == 3
+
+
+def test_callable_replies():
+    conn = RecordingConnection(replies={
+        'HMGET': lambda key, *fields: ['x' for field in fields],
+    })
+
+    pipe = conn.pipeline()
+    pipe.hmget('foo:1', ['a', 'b'])
+    pipe.set('lock', 'token', px=100, nx=True)
+    assert pipe.execute() == [['x', 'x'], True]
+    assert conn.commands[1].args == ['lock', 'token', 'NX', 'PX', 100]
+
+
+def test_explain_connection_overrides():
+    import threading
+    from rohm.memory import MemoryRedis
+
+    other = MemoryRedis()
+
+    class Foo(Model):
+        connection = other
+
+    class Bar(Model):
+        @classmethod
+        def get_connection(cls):
+            return other
+
+    with explain() as recorder:
+        assert Foo.get_connection() is recorder
+        assert Bar.get_connection() is recorder
+
+        # Only for this thread
+        connections = []
+        thread = threading.Thread(target=lambda: connections.append(Bar.get_connection()))
+        thread.start()
+        thread.join()
+        assert connections == [other]
+
+    assert Foo.get_connection() is other
+    assert Bar.get_connection() is other
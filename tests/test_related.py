@@ -115,3 +115,122 @@ def test_related_partial(Foo, Bar, conn, pipe):
     assert foo._data == dict(id=1, name='foo', bar_id=2)
 
     str(foo.bar)
+
+
+class TestReverseRelation(object):
+
+    @pytest.fixture
+    def Bar(self):
+        class Foo(Model):
+            name = fields.CharField()
+            bar = fields.RelatedModelField('Bar', related_name='foos')
+
+        # Defined after Foo, so the reverse relation is installed when Bar is created
+        class Bar(Model):
+            title = fields.CharField()
+
+        return Bar
+
+    def test_reverse_relation(self, Bar, conn):
+        from rohm.testing import count_round_trips
+        Foo = Bar.foos.model_cls
+
+        bar1 = Bar(id=1, title='bar1')
+        bar1.save()
+        bar2 = Bar(id=2, title='bar2')
+        bar2.save()
+
+        for i in range(1, 4):
+            Foo(id=i, name='foo{}'.format(i), bar=bar1).save()
+        Foo(id=4, name='foo4').save()
+
+        assert conn.smembers('bar:1:foos') == {'1', '2', '3'}
+
+        bar1 = Bar.get(1)
+        with count_round_trips() as counter:
+            assert bar1.foos.count() == 3
+        assert counter.commands == {'SCARD': 1}
+
+        assert bar1.foos.ids() == [1, 2, 3]
+
+        with count_round_trips() as counter:
+            foos = list(bar1.foos)
+        assert [foo.name for foo in foos] == ['foo1', 'foo2', 'foo3']
+        assert counter.round_trips == 2
+
+        # Move one to bar2, using the tracked original bar_id
+        foo = Foo.get(1)
+        foo.bar = bar2
+        foo.save()
+        assert conn.smembers('bar:1:foos') == {'2', '3'}
+        assert conn.smembers('bar:2:foos') == {'1'}
+
+        # Unset
+        foo = Foo.get(2)
+        foo.bar_id = None
+        foo.save()
+        assert conn.smembers('bar:1:foos') == {'3'}
+        assert len(Bar.get(1).foos) == 1
+
+        # Deleting removes it from the index
+        Foo.get(3).delete()
+        assert not conn.exists('bar:1:foos')
+
+        Foo.delete_many([1])
+        assert not conn.exists('bar:2:foos')
+
+    def test_stored_value_not_loaded(self, Bar, conn):
+        Foo = Bar.foos.model_cls
+
+        Foo(id=1, name='foo', bar_id=1).save()
+
+        # Partial load: the stored bar_id is read before updating the index
+        foo = Foo.get(1, fields=['name'])
+        foo.bar_id = 2
+        foo.save()
+        assert conn.smembers('bar:1:foos') == set()
+        assert conn.smembers('bar:2:foos') == {'1'}
+
+        # Untracked models too
+        Foo.track_modified_fields = False
+        Foo.save_modified_only = False
+        foo = Foo.get(1)
+        foo.bar_id = 3
+        foo.save()
+        assert conn.smembers('bar:2:foos') == set()
+
+        # ...and delete_many() of modified instances
+        foo.bar_id = 4
+        Foo.delete_many([foo])
+        assert not conn.exists('bar:3:foos')
+
+        # A forced create over an existing model
+        Foo(id=2, bar_id=1).save()
+        Foo(id=2, bar_id=2).save(force_create=True)
+        assert conn.smembers('bar:1:foos') == set()
+        assert conn.smembers('bar:2:foos') == {'2'}
+
+    def test_delete_target(self, Bar, conn):
+        Foo = Bar.foos.model_cls
+
+        Bar(id=1).save()
+        Bar(id=2).save()
+        Foo(id=1, bar_id=1).save()
+        Foo(id=2, bar_id=2).save()
+
+        Bar.get(1).delete()
+        assert not conn.exists('bar:1:foos')
+
+        Bar.delete_many([2])
+        assert not conn.exists('bar:2:foos')
+
+    def test_reverse_relation_defined_first(self, conn):
+        class Bar(Model):
+            title = fields.CharField()
+
+        class Foo(Model):
+            bar = fields.RelatedModelField(Bar, related_name='foos')
+
+        Bar(id=1).save()
+        Foo(id=1, bar_id=1).save()
+        assert Bar.get(1).foos.ids() == [1]
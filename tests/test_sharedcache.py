@@ -0,0 +1,193 @@
+import os
+import time
+
+import pytest
+
+import rohm
+from rohm.models import Model
+from rohm.sharedcache import SharedMemoryCache
+from rohm.testing import count_round_trips
+from rohm import fields
+
+
+@pytest.fixture
+def cache(tmpdir):
+    cache = SharedMemoryCache(str(tmpdir.join('cache')), num_slots=64, slot_size=512, ttl=60)
+    yield cache
+    cache.close()
+
+
+@pytest.fixture
+def Store(cache):
+    class Store(Model):
+        shared_cache = cache
+        name = fields.CharField()
+        num = fields.IntegerField()
+    return Store
+
+
+def test_get_uses_cache(Store, cache):
+    Store(id=1, name='one', num=1).save()
+    Store(id=2, name='two', num=2).save()
+
+    assert [store.name for store in Store.get([1, 2])] == ['one', 'two']
+    assert cache.stats['misses'] == 2
+    assert cache.stats['stores'] == 2
+
+    with count_round_trips() as counter:
+        stores = Store.get([2, 1])
+    assert counter.round_trips == 0
+    assert [(store.name, store.num) for store in stores] == [('two', 2), ('one', 1)]
+
+    # Only the misses are loaded from Redis
+    Store(id=3, name='three').save()
+    with count_round_trips() as counter:
+        stores = Store.get([1, 3, 4], raise_missing_exception=False)
+    assert counter.commands['HGETALL'] == 2
+    assert [store and store.name for store in stores] == ['one', 'three', None]
+
+    # Partial loads don't use it
+    with count_round_trips() as counter:
+        assert Store.get(1, fields=['name']).name == 'one'
+    assert counter.round_trips == 1
+
+
+def test_invalidation(Store, cache):
+    store = Store(id=1, name='one')
+    store.save()
+    Store.get(1)
+
+    store.name = 'uno'
+    store.save()
+    assert Store.get(1).name == 'uno'
+
+    Store.update(1, num=5)
+    assert Store.get(1).num == 5
+
+    Store.get(1).delete()
+    assert Store.get(1, raise_missing_exception=False) is None
+
+    Store(id=2, name='two').save()
+    Store.get(2)
+    Store.delete_many([2])
+    assert Store.get(2, raise_missing_exception=False) is None
+
+
+def test_stale_store_is_dropped(Store, cache):
+    Store(id=1, name='one').save()
+
+    # A load that started before an invalidation doesn't store what it read
+    hits, versions = cache.get_many(Store, [1])
+    cache.invalidate(Store, [1])
+    cache.set_many(Store, {1: {'id': '1', 'name': 'old'}}, versions)
+    assert cache.get_many(Store, [1])[0] == {}
+
+
+def test_ttl(Store, cache, monkeypatch):
+    Store(id=1, name='one').save()
+    Store.get(1)
+    assert 1 in cache.get_many(Store, [1])[0]
+
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 61)
+    assert cache.get_many(Store, [1])[0] == {}
+
+
+def test_shared_between_processes(Store, cache):
+    if not hasattr(os, 'fork'):
+        pytest.skip('needs fork')
+
+    Store(id=1, name='one').save()
+
+    pid = os.fork()
+    if pid == 0:
+        # The child loads it into the shared cache
+        try:
+            Store.get(1)
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+
+    assert cache.get_many(Store, [1])[0] == {1: {'id': '1', 'name': 'one'}}
+
+    # Another mapping of the same file sees it too
+    other = SharedMemoryCache(cache.path, num_slots=64, slot_size=512)
+    assert 1 in other.get_many(Store, [1])[0]
+    with pytest.raises(ValueError):
+        SharedMemoryCache(cache.path, num_slots=32, slot_size=512)
+    other.close()
+
+
+def test_preload_fills_cache(Store, cache):
+    for i in range(1, 6):
+        Store(id=i, name='store{}'.format(i)).save()
+
+    assert Store.preload(chunk_size=2) == 5
+    with count_round_trips() as counter:
+        Store.get([1, 2, 3, 4, 5])
+    assert counter.round_trips == 0
+
+
+def test_shared_pipeline_invalidation(Store, cache):
+    store = Store(id=1, name='one')
+    store.save()
+
+    pipe = Store.get_connection().pipeline()
+    store.name = 'uno'
+    store.save(pipe=pipe)
+
+    # A load between the save and the write caches the old data...
+    assert Store.get(1).name == 'one'
+    # ...which is invalidated once the pipeline ran
+    rohm.execute_pipeline(pipe)
+    assert Store.get(1).name == 'uno'
+
+
+def test_expires_with_key(cache, monkeypatch):
+    class Session(Model):
+        shared_cache = cache
+        ttl = 10
+        name = fields.CharField()
+
+    Session(id=1, name='one').save()
+    Session.get(1)
+    assert 1 in cache.get_many(Session, [1])[0]
+
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 11)
+    assert cache.get_many(Session, [1])[0] == {}
+
+
+def test_refresh_cache_hits(tmpdir, monkeypatch):
+    from rohm.loading import background_refresher
+
+    cache = SharedMemoryCache(str(tmpdir.join('refresh')), num_slots=64, slot_size=512, ttl=0)
+    calls = []
+
+    class Session(Model):
+        shared_cache = cache
+        ttl = 100
+        refresh_window = 10
+        name = fields.CharField()
+
+        @classmethod
+        def create_from_ids(cls, ids):
+            calls.append(list(ids))
+            return {id: cls(id=id, name='rebuilt') for id in ids}
+
+    Session(id=1, name='one').save()
+    Session.get(1)
+    assert background_refresher.wait(timeout=5)
+    assert calls == []
+
+    # Served from the cache, but its key is about to expire
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 95)
+    assert Session.get(1).name == 'one'
+    assert cache.stats['hits'] == 1
+    assert background_refresher.wait(timeout=5)
+    assert calls == [[1]]
+
+    monkeypatch.undo()
+    assert Session.get(1).name == 'rebuilt'
+    cache.close()
@@ -0,0 +1,89 @@
+import pytest
+
+from rohm.models import Model
+from rohm import fields
+from rohm.testing import count_round_trips, assert_max_round_trips
+
+
+@pytest.fixture
+def Foo():
+    class Foo(Model):
+        name = fields.CharField()
+        num = fields.IntegerField()
+        bar = fields.RelatedModelField('Bar')
+
+    class Bar(Model):
+        title = fields.CharField()
+
+    for i in range(1, 4):
+        Bar(id=i, title='bar{}'.format(i)).save()
+        Foo(id=i, name='foo{}'.format(i), num=i, bar_id=i).save()
+
+    return Foo
+
+
+def test_count_round_trips(Foo):
+    with count_round_trips() as counter:
+        foos = Foo.get([1, 2, 3])
+
+    assert counter.round_trips == 1
+    assert counter.pipelines == 1
+    assert counter.commands['HGETALL'] == 3
+    assert counter.total_commands == 3
+
+    # N+1: one round trip per related access
+    with count_round_trips() as counter:
+        [foo.bar for foo in foos]
+
+    assert counter.round_trips == 3
+
+
+def test_lazy_field_round_trips(Foo):
+    foos = Foo.get([1, 2, 3], fields=['name'])
+
+    with count_round_trips() as counter:
+        [foo.num for foo in foos]
+
+    assert counter.round_trips == 3
+    assert counter.commands == {'HGET': 3}
+    assert counter.pipelines == 0
+
+
+def test_save_round_trips(Foo):
+    with count_round_trips() as counter:
+        Foo(id=10, name='new').save()
+
+    # WATCH, EXISTS, then MULTI/HMSET/EXEC
+    assert counter.round_trips == 3
+    assert counter.log[:2] == [['WATCH'], ['EXISTS']]
+
+
+def test_assert_max_round_trips(Foo):
+    with assert_max_round_trips(1):
+        Foo.get([1, 2, 3])
+
+    with pytest.raises(AssertionError) as excinfo:
+        with assert_max_round_trips(1):
+            foos = Foo.get([1, 2, 3])
+            [foo.bar for foo in foos]
+
+    assert '4 round trips' in str(excinfo.value)
+
+    with pytest.raises(AssertionError):
+        with assert_max_round_trips(1, max_commands=2):
+            Foo.get([1, 2, 3])
+
+
+def test_nested_counters(Foo):
+    with count_round_trips() as outer:
+        Foo.get(1)
+        with count_round_trips() as inner:
+            Foo.get(2)
+
+    assert outer.round_trips == 2
+    assert inner.round_trips == 1
+
+
+def test_fixture(Foo, round_trips):
+    Foo.get(1)
+    assert round_trips.round_trips == 1